@@ -36,7 +36,12 @@
 
 import time
 
-import adafruit_bus_device.i2c_device as ada_busdev
+try:
+    import adafruit_bus_device.i2c_device as ada_busdev
+except ImportError:
+    # The hardware modules are not available on hosts used for offline
+    # processing. Simulated devices can still be used.
+    ada_busdev = None
 
 
 # Register and other configuration values:
@@ -68,6 +73,11 @@ ADS111x_CONFIG_GAIN = {
 }
 ADS111x_CONFIG_MODE_CONTINUOUS  = 0x0000
 ADS111x_CONFIG_MODE_SINGLE      = 0x0100
+# Mapping of the conversion modes to config register values.
+ADS111x_CONFIG_MODE = {
+    'singleshot': ADS111x_CONFIG_MODE_SINGLE,
+    'continuous': ADS111x_CONFIG_MODE_CONTINUOUS
+}
 # Mapping of data/sample rate to config register values for ADS1115 (slower).
 ADS111x_CONFIG_DR = {
     8:    0x0000,
@@ -88,16 +98,185 @@ ADS111x_CONFIG_COMP_QUE = {
     4: 0x0002
 }
 ADS111x_CONFIG_COMP_QUE_DISABLE = 0x0003
+# The threshold register values activating the conversion ready function of
+# the ALERT/RDY pin (MSB of the high threshold set, MSB of the low threshold
+# cleared).
+ADS111x_CONVERSION_READY_HIGH_THRESHOLD = 0x8000
+ADS111x_CONVERSION_READY_LOW_THRESHOLD  = 0x0000
+# Mapping of the ADS1115 input multiplexer settings to the config register
+# mux values.
+ADS1115_CONFIG_MUX = {
+    'AIN0-AIN1': 0,
+    'AIN0-AIN3': 1,
+    'AIN1-AIN3': 2,
+    'AIN2-AIN3': 3,
+    'AIN0':      4,
+    'AIN1':      5,
+    'AIN2':      6,
+    'AIN3':      7
+}
+# The relative tolerance of the internal oscillator of the ADS111x (see the
+# electrical characteristics in the datasheet).
+ADS111x_OSCILLATOR_TOLERANCE = 0.1
+# The number of I2C bytes needed to switch the multiplexer (address, pointer
+# and the two config bytes) and to read the conversion result (address and
+# pointer followed by a repeated start, address and two data bytes).
+ADS111x_MUX_SWITCH_BYTES = 4
+ADS111x_READ_RESULT_BYTES = 5
+# The number of conversions per input of a multiplexed scan. The first
+# conversion after a mux switch is discarded.
+ADS111x_SCAN_CONVERSIONS = 2
+
+
+def scan_rate(data_rate, n_inputs, i2c_clock = 400000, latency = 0.0002,
+              oscillator_tolerance = ADS111x_OSCILLATOR_TOLERANCE):
+    """ Compute the highest achievable per-input sampling rate of a
+    multiplexed ADS1115 scan.
+
+    The datasheet doesn't specify if writing the config register in
+    continuous mode restarts the running conversion or lets it finish with
+    the old mux setting. The first conversion after a mux switch is
+    therefore discarded. A scan slot consists of the latency of the DRDY
+    interrupt handler, the I2C transfer of the new mux setting and two
+    conversions, assuming that the conversion is restarted. If it isn't
+    restarted, the slot is shorter by the latency and the I2C transfer.
+    Reading the result of the previous slot overlaps with the conversions.
+
+    :param data_rate: The ADC data rate (one of ADS111x_CONFIG_DR).
+    :param n_inputs: The number of scanned inputs.
+    :param i2c_clock: The I2C bus clock frequency [Hz].
+    :param latency: The latency from the DRDY edge to the start of the I2C
+        transfer [s].
+    :param oscillator_tolerance: The relative deviation of the ADC
+        oscillator below its nominal frequency. The default gives the rate
+        achievable with the slowest oscillator, 0 gives the rate of a
+        nominal oscillator.
+    :return: The per-input sampling rate [sps].
+    """
+    if data_rate not in ADS111x_CONFIG_DR:
+        raise ValueError('Data rate must be one of: 8, 16, 32, 64, 128, 250, 475, 860')
+    # 9 clock cycles per byte (8 data bits and the ACK) and 2 cycles for the
+    # start and stop conditions.
+    switch_time = (ADS111x_MUX_SWITCH_BYTES * 9 + 2) / i2c_clock
+    read_time = (ADS111x_READ_RESULT_BYTES * 9 + 3) / i2c_clock
+    conversion_time = 1. / (data_rate * (1 - oscillator_tolerance))
+    # The result has to be read before the next conversion is finished.
+    slot_time = latency + switch_time + max(ADS111x_SCAN_CONVERSIONS * conversion_time, read_time)
+    return 1. / (n_inputs * slot_time)
+
+
+def scan_rates(n_inputs, i2c_clock = 400000, latency = 0.0002):
+    """ Compute the per-input sampling rate of a multiplexed ADS1115 scan for
+    each supported data rate.
+
+    :return: A dictionary with the data rate as key and the per-input
+        sampling rate as value.
+    """
+    return {x: scan_rate(data_rate = x,
+                         n_inputs = n_inputs,
+                         i2c_clock = i2c_clock,
+                         latency = latency) for x in sorted(ADS111x_CONFIG_DR)}
+
+
+class ADS111xConfig(object):
+    """ The register configuration of an ADS111x ADC.
+
+    The values of the config and threshold registers and the I2C write
+    buffers of the registers are computed once when the configuration is
+    created. They are written to the ADC using ADS111x.apply_config.
+    """
+
+    def __init__(self, mux = 0, gain = '1', data_rate = 128, mode = 'continuous',
+                 conversion_ready = True):
+        """ Initialization of the instance.
+
+        :param mux: The input multiplexer setting (0 to 7).
+        :param gain: The PGA gain (one of ADS111x_CONFIG_GAIN).
+        :param data_rate: The data rate (one of ADS111x_CONFIG_DR).
+        :param mode: The conversion mode (singleshot or continuous).
+        :param conversion_ready: If True, the comparator queue and the
+            threshold registers are set to use the ALERT/RDY pin as
+            conversion ready pin. Otherwise the comparator is disabled and
+            the threshold registers are not changed.
+        """
+        if mux not in ADS1115_CONFIG_MUX.values():
+            raise ValueError("The mux has to be in the range 0 to 7.")
+        if gain not in ADS111x_CONFIG_GAIN:
+            raise ValueError('Gain must be one of: 2/3, 1, 2, 4, 8, 16')
+        if data_rate not in ADS111x_CONFIG_DR:
+            raise ValueError('Data rate must be one of: 8, 16, 32, 64, 128, 250, 475, 860')
+        if mode not in ADS111x_CONFIG_MODE:
+            raise ValueError("Mode has to be singleshot or continuous.")
+
+        self.mux = mux
+
+        self.gain = gain
+
+        self.data_rate = data_rate
+
+        self.mode = mode
+
+        self.conversion_ready = conversion_ready
+
+        # The value of the config register.
+        self.config_word = (mux & 0x07) << ADS111x_CONFIG_MUX_OFFSET
+        self.config_word |= ADS111x_CONFIG_GAIN[gain]
+        self.config_word |= ADS111x_CONFIG_MODE[mode]
+        self.config_word |= ADS111x_CONFIG_DR[data_rate]
+        if not conversion_ready:
+            self.config_word |= ADS111x_CONFIG_COMP_QUE_DISABLE
+
+        # The values of the managed registers. The threshold registers are
+        # written before the config register.
+        self.registers = {}
+        if conversion_ready:
+            self.registers[ADS111x_POINTER_HIGH_THRESHOLD] = ADS111x_CONVERSION_READY_HIGH_THRESHOLD
+            self.registers[ADS111x_POINTER_LOW_THRESHOLD] = ADS111x_CONVERSION_READY_LOW_THRESHOLD
+        self.registers[ADS111x_POINTER_CONFIG] = self.config_word
+
+        # The I2C write buffers (pointer and big endian register value) of
+        # the registers.
+        self.buffers = {x: bytearray([x, (y >> 8) & 0xFF, y & 0xFF]) for x, y in self.registers.items()}
+
+
+    def __eq__(self, other):
+        return isinstance(other, ADS111xConfig) and self.registers == other.registers
+
+
+    def __ne__(self, other):
+        return not self.__eq__(other)
+
+
+    def __repr__(self):
+        return ("ADS111xConfig(mux = %d, gain = '%s', data_rate = %d, mode = '%s', "
+                "conversion_ready = %s)") % (self.mux, self.gain, self.data_rate,
+                                             self.mode, self.conversion_ready)
+
+
+    def replace(self, **kwargs):
+        """ Create a copy of the configuration with the given parameters
+        changed.
+        """
+        params = {'mux': self.mux,
+                  'gain': self.gain,
+                  'data_rate': self.data_rate,
+                  'mode': self.mode,
+                  'conversion_ready': self.conversion_ready}
+        params.update(kwargs)
+        return ADS111xConfig(**params)
 
 
 class ADS111x(object):
     """Base functionality for ADS1x15.py analog to digital converters."""
 
-    def __init__(self, i2c_bus, address=ADS111x_DEFAULT_ADDRESS, **kwargs):
+    def __init__(self, i2c_bus, address=ADS111x_DEFAULT_ADDRESS, device=None, **kwargs):
 
-        # The ADC device on the I2C bus.
-        self._device = ada_busdev.I2CDevice(i2c_bus,
-                                            address)
+        # The ADC device on the I2C bus. An already created device (e.g. a
+        # simulated device) can be passed using the device argument.
+        if device is None:
+            device = ada_busdev.I2CDevice(i2c_bus,
+                                          address)
+        self._device = device
 
         # The i2c write buffer.
         self._writebuf = bytearray(3)
@@ -108,6 +287,19 @@ class ADS111x(object):
         # The ADC default configuration.
         self._config = ADS111x_CONFIG_DEFAULT
 
+        # The last applied configuration (ADS111xConfig).
+        self.config = None
+
+        # The last known values of the config and threshold registers. The
+        # OS bit of the config register is not included.
+        self.registers = {}
+
+        # The pointer write buffers of the registers.
+        self._pointer_buffers = {x: bytearray([x]) for x in (ADS111x_POINTER_CONVERSION,
+                                                             ADS111x_POINTER_CONFIG,
+                                                             ADS111x_POINTER_LOW_THRESHOLD,
+                                                             ADS111x_POINTER_HIGH_THRESHOLD)}
+
 
     def _data_rate_config(self, data_rate):
         """Subclasses should override this function and return a 16-bit value
@@ -162,66 +354,66 @@ class ADS111x(object):
 
 
     def configure(self, mux, gain, data_rate, mode):
-        """ Configure the ADC.
-        """
-        cur_config = 0x00
-        # Specify mux value.
-        cur_config |= (mux & 0x07) << ADS111x_CONFIG_MUX_OFFSET
-        # Validate the passed in gain and then set it in the config.
-        if gain not in ADS111x_CONFIG_GAIN:
-            raise ValueError('Gain must be one of: 2/3, 1, 2, 4, 8, 16')
-        cur_config |= ADS111x_CONFIG_GAIN[gain]
-        # Set the mode (continuous or single shot).
-        cur_config |= mode
-        # Set the data rate (this is controlled by the subclass)
-        cur_config |= self._data_rate_config(data_rate)
-        cur_config |= ADS111x_CONFIG_COMP_QUE_DISABLE  # Disble comparator mode.
-        # Send the config value to start the ADC conversion.
-        # Explicitly break the 16-bit value down to a big endian pair of bytes.
-        self._writebuf = bytearray([ADS111x_POINTER_CONFIG,
-                                    (cur_config >> 8) & 0xFF,
-                                    cur_config & 0xFF])
-        self._device.write(self._writebuf)
-
-        self._config = self.read_config()
-        # Clear the OS bit.
-        self._config &= ~(0x1 << 16)
-        if self._config == cur_config:
-            return True
-        else:
-            return False
+        """ Configure the ADC with the comparator disabled.
 
+        :param mode: The conversion mode (singleshot or continuous).
+        :return: True if the configuration has been verified.
+        """
+        config = ADS111xConfig(mux = mux,
+                               gain = gain,
+                               data_rate = data_rate,
+                               mode = mode,
+                               conversion_ready = False)
+        return self.apply_config(config)
 
 
     def enable_conversion_ready_pin(self):
         """ Set the configuration activate the RDY pin.
         """
-        # Set the MSB in the high and low threshold.
-        high_threshold = 0x8000
-        low_threshold = 0x0
-        self._writebuf = bytearray([ADS111x_POINTER_HIGH_THRESHOLD,
-                                    (high_threshold >> 8) & 0xFF,
-                                    high_threshold & 0xFF])
-        self._device.write(self._writebuf)
-        self._writebuf = bytearray([ADS111x_POINTER_LOW_THRESHOLD,
-                                    (low_threshold >> 8) & 0xFF,
-                                    low_threshold & 0xFF])
-        self._device.write(self._writebuf)
+        if self.config is None:
+            raise RuntimeError("The ADC has not been configured.")
+        return self.apply_config(self.config.replace(conversion_ready = True))
 
-        # Set the comp_que in the config register to 00.
-        cur_config = self._config
-        cur_config &= ~(0x1)
-        cur_config &= ~(0x1 << 1)
-        self._writebuf = bytearray([ADS111x_POINTER_CONFIG,
-                                    (cur_config >> 8) & 0xFF,
-                                    cur_config & 0xFF])
-        self._device.write(self._writebuf)
-        self._config = self.read_config()
-        self._config &= ~(0x1 << 16)
-        if (self._config & 0x7FFF) == (cur_config & 0x7FFF):
-            return True
-        else:
-            return False
+
+    def apply_config(self, config, verify = True):
+        """ Write the registers of the configuration to the ADC.
+
+        All registers are written and read back while holding the I2C bus.
+        The ADS111x has no register auto increment, so each register is
+        transferred separately. Threshold registers matching the cached
+        register state are not written. The config register is always
+        written, because it restarts the conversion. If the registers read
+        back don't match, the differing registers are written once again.
+
+        :param config: The configuration (ADS111xConfig).
+        :param verify: If True, the registers are read back and compared to
+            the configuration.
+        :return: True if the configuration has been verified.
+        """
+        self.config = config
+        self._config = config.config_word
+        with self._device:
+            for k in range(2):
+                for cur_pointer, cur_value in config.registers.items():
+                    if cur_pointer != ADS111x_POINTER_CONFIG and self.registers.get(cur_pointer) == cur_value:
+                        continue
+                    self._device.write(config.buffers[cur_pointer])
+                    self.registers[cur_pointer] = cur_value
+
+                if not verify:
+                    return True
+
+                valid = True
+                for cur_pointer, cur_value in config.registers.items():
+                    read_value = self._read_register(cur_pointer)
+                    if cur_pointer == ADS111x_POINTER_CONFIG:
+                        read_value &= ~ADS111x_CONFIG_OS_SINGLE
+                    self.registers[cur_pointer] = read_value
+                    if read_value != cur_value:
+                        valid = False
+                if valid:
+                    return True
+        return False
 
 
     def stop_adc(self):
@@ -232,6 +424,8 @@ class ADS111x(object):
                                     (config >> 8) & 0xFF,
                                     config & 0xFF])
         self._device.write(self._writebuf)
+        self.registers[ADS111x_POINTER_CONFIG] = config & ~ADS111x_CONFIG_OS_SINGLE
+        self.config = None
 
 
     def get_last_result(self):
@@ -250,11 +444,18 @@ class ADS111x(object):
     def read_config(self):
         """ Read the configuration register.
         """
-        self._device.write_then_readinto(bytearray([ADS111x_POINTER_CONFIG]),
+        result = self._read_register(ADS111x_POINTER_CONFIG)
+        self.registers[ADS111x_POINTER_CONFIG] = result & ~ADS111x_CONFIG_OS_SINGLE
+        return result
+
+
+    def _read_register(self, pointer):
+        """ Read the 16-bit value of a register.
+        """
+        self._device.write_then_readinto(self._pointer_buffers[pointer],
                                          self._readbuf,
                                          in_end = 2)
-        result = ((self._readbuf[0] & 0xFF) << 8) | (self._readbuf[1] & 0xFF)
-        return result
+        return ((self._readbuf[0] & 0xFF) << 8) | (self._readbuf[1] & 0xFF)
 
 
 
@@ -278,15 +479,73 @@ class ADS1114(ADS111x):
             value -= 1 << 16
         return value
 
-    def configure(self, gain = 1, data_rate = 128, mode = 'singleshot'):
+    def configure(self, gain = '1', data_rate = 128, mode = 'singleshot'):
         ''' Start the ADC in continuous differential mode.
 
         The ADS1114 is a single channel ADC, therefore, the differential option is fixed to 0.
         '''
-        if mode == 'singleshot':
-            adc_mode = ADS111x_CONFIG_MODE_SINGLE
-        elif mode == 'continuous':
-            adc_mode = ADS111x_CONFIG_MODE_CONTINUOUS
-        else:
-            raise ValueError("Mode has to be singleshot or continuous.")
-        super(ADS1114, self).configure(mux = 0, gain = gain, data_rate = data_rate, mode = adc_mode)
+        return super(ADS1114, self).configure(mux = 0, gain = gain, data_rate = data_rate, mode = mode)
+
+
+
+
+class ADS1115(ADS111x):
+    """ADS1115 16-bit analog to digital converter with 4 input multiplexer."""
+
+    def __init__(self, *args, **kwargs):
+        super(ADS1115, self).__init__(*args, **kwargs)
+
+        # The configurations of the scan inputs.
+        self.scan_configs = []
+
+        # The precomputed config register writes used to switch the
+        # multiplexer during a scan.
+        self._scan_buffers = []
+
+    def _data_rate_config(self, data_rate):
+        if data_rate not in ADS111x_CONFIG_DR:
+            raise ValueError('Data rate must be one of: 8, 16, 32, 64, 128, 250, 475, 860')
+        return ADS111x_CONFIG_DR[data_rate]
+
+    def _conversion_value(self, low, high):
+        # Convert to 16-bit signed value.
+        value = ((high & 0xFF) << 8) | (low & 0xFF)
+        # Check for sign bit and turn into a negative value if set.
+        if value & 0x8000 != 0:
+            value -= 1 << 16
+        return value
+
+    def configure(self, mux = 4, gain = '1', data_rate = 128, mode = 'singleshot'):
+        ''' Configure the ADC using the input multiplexer setting mux.
+        '''
+        return super(ADS1115, self).configure(mux = mux, gain = gain,
+                                              data_rate = data_rate, mode = mode)
+
+    def prepare_scan(self, mux_list, gain_list, data_rate):
+        ''' Precompute the configurations and config register writes for a
+        continuous mode scan over the inputs in mux_list.
+
+        The comparator queue is set to 00 to keep the conversion ready pin
+        active (see enable_conversion_ready_pin).
+
+        :return: The list of the configurations (ADS111xConfig) of the
+            inputs.
+        '''
+        self.scan_configs = [ADS111xConfig(mux = cur_mux,
+                                           gain = cur_gain,
+                                           data_rate = data_rate,
+                                           mode = 'continuous',
+                                           conversion_ready = True) for cur_mux, cur_gain in zip(mux_list, gain_list)]
+        self._scan_buffers = [x.buffers[ADS111x_POINTER_CONFIG] for x in self.scan_configs]
+        return self.scan_configs
+
+    def select_input(self, index):
+        ''' Switch the multiplexer to the scan input with the given index.
+
+        It is not specified if writing the config register restarts the
+        running conversion or if the conversion finishes with the old
+        setting. The first conversion after the switch has to be
+        discarded. The conversion register keeps the last result until the
+        next conversion has finished.
+        '''
+        self._device.write(self._scan_buffers[index])
@@ -0,0 +1,139 @@
+# -*- coding: utf-8 -*-
+# LICENSE
+#
+# This file is part of mss_record.
+#
+# If you use mss_record in any program or publication, please inform and
+# acknowledge its author Stefan Mertl (stefan@mertl-research.at).
+#
+# mss_record is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import random
+import time
+
+import mss_record.adc.ads111x as mss_ads111x
+
+
+class SimulatedI2CDevice(object):
+    ''' A simulated ADS111x device on the I2C bus.
+
+    The device implements the subset of the adafruit_bus_device I2CDevice
+    interface used by the ADS111x classes. It can be passed to the ADS111x
+    classes using the device argument.
+    '''
+
+    def __init__(self, address = mss_ads111x.ADS111x_DEFAULT_ADDRESS, signal = None,
+                 i2c_clock = 400000, simulate_timing = False):
+        ''' Initialization of the instance.
+
+        :param signal: A callable returning the next conversion result. If
+            None, gaussian noise is returned.
+        :param i2c_clock: The simulated I2C bus clock frequency [Hz].
+        :param simulate_timing: If True, each transfer blocks for the
+            duration of the transfer on the simulated bus.
+        '''
+        self.address = address
+
+        # The register values of the device.
+        self.registers = {mss_ads111x.ADS111x_POINTER_CONVERSION: 0x0000,
+                          mss_ads111x.ADS111x_POINTER_CONFIG: mss_ads111x.ADS111x_CONFIG_DEFAULT,
+                          mss_ads111x.ADS111x_POINTER_LOW_THRESHOLD: 0x8000,
+                          mss_ads111x.ADS111x_POINTER_HIGH_THRESHOLD: 0x7FFF}
+
+        # The register addressed by the pointer register.
+        self.pointer = mss_ads111x.ADS111x_POINTER_CONVERSION
+
+        if signal is None:
+            signal = lambda: int(random.gauss(0, 10))
+        self.signal = signal
+
+        self.i2c_clock = i2c_clock
+
+        self.simulate_timing = simulate_timing
+
+        # The number of I2C transactions and transferred bytes.
+        self.n_transactions = 0
+        self.n_bytes = 0
+
+
+    def __enter__(self):
+        return self
+
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        return False
+
+
+    def _transfer(self, n_bytes):
+        ''' Account for a transaction with n_bytes bytes including the address.
+        '''
+        self.n_transactions += 1
+        self.n_bytes += n_bytes
+        if self.simulate_timing:
+            # 9 clock cycles per byte and 2 cycles for start and stop.
+            end = time.perf_counter() + (n_bytes * 9 + 2) / self.i2c_clock
+            while time.perf_counter() < end:
+                pass
+
+
+    def _read_register(self, pointer):
+        ''' Get the value of the register.
+        '''
+        if pointer == mss_ads111x.ADS111x_POINTER_CONVERSION:
+            return self.signal() & 0xFFFF
+        value = self.registers[pointer]
+        if pointer == mss_ads111x.ADS111x_POINTER_CONFIG:
+            # The OS bit reads 1 if no conversion is running.
+            if value & mss_ads111x.ADS111x_CONFIG_MODE_SINGLE:
+                value |= mss_ads111x.ADS111x_CONFIG_OS_SINGLE
+            else:
+                value &= ~mss_ads111x.ADS111x_CONFIG_OS_SINGLE
+        return value
+
+
+    def write(self, buf, *, start = 0, end = None):
+        ''' Write the bytes of buf to the device.
+        '''
+        buf = buf[start:end]
+        self._transfer(len(buf) + 1)
+        self.pointer = buf[0] & 0x03
+        if len(buf) >= 3 and self.pointer != mss_ads111x.ADS111x_POINTER_CONVERSION:
+            self.registers[self.pointer] = ((buf[1] & 0xFF) << 8) | (buf[2] & 0xFF)
+
+
+    def readinto(self, buf, *, start = 0, end = None):
+        ''' Read the register addressed by the pointer into buf.
+        '''
+        if end is None:
+            end = len(buf)
+        self._transfer(end - start + 1)
+        value = self._read_register(self.pointer)
+        buf[start] = (value >> 8) & 0xFF
+        if end - start > 1:
+            buf[start + 1] = value & 0xFF
+
+
+    def write_then_readinto(self, out_buffer, in_buffer, *, out_start = 0, out_end = None,
+                            in_start = 0, in_end = None):
+        ''' Write the pointer and read the register using a repeated start.
+        '''
+        out_buffer = out_buffer[out_start:out_end]
+        if in_end is None:
+            in_end = len(in_buffer)
+        self._transfer(len(out_buffer) + in_end - in_start + 2)
+        self.pointer = out_buffer[0] & 0x03
+        value = self._read_register(self.pointer)
+        in_buffer[in_start] = (value >> 8) & 0xFF
+        if in_end - in_start > 1:
+            in_buffer[in_start + 1] = value & 0xFF
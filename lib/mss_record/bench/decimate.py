@@ -0,0 +1,86 @@
+# -*- coding: utf-8 -*-
+# LICENSE
+#
+# This file is part of mss_record.
+#
+# If you use mss_record in any program or publication, please inform and
+# acknowledge its author Stefan Mertl (stefan@mertl-research.at).
+#
+# mss_record is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+''' Benchmark of the multi-rate decimation.
+
+Compare the CPU time of the cascaded decimation of the 100 sps data to all
+output rates with the resampling of the data to each rate separately
+(scipy.signal.resample of each 1 s block, as used for the 100 sps data).
+
+Usage: python3 -m mss_record.bench.decimate
+'''
+
+import argparse
+import time
+
+import numpy as np
+import obspy
+import scipy as sp
+import scipy.signal
+
+import mss_record.core.decimate
+
+
+def main():
+    parser = argparse.ArgumentParser(description = 'Benchmark the multi-rate decimation.')
+    parser.add_argument('--rates', type = str, default = '20,1',
+                        help = 'The comma separated output rates [sps].')
+    parser.add_argument('--duration', type = int, default = 3600,
+                        help = 'The duration of the processed data [s].')
+    args = parser.parse_args()
+
+    sps = 100.
+    rates = [float(x) for x in args.rates.split(',')]
+    rng = np.random.default_rng(0)
+    blocks = [rng.normal(0, 100, int(sps)) for x in range(args.duration)]
+    start_time = obspy.UTCDateTime('2021-01-01')
+
+    cascade = mss_record.core.decimate.DecimationCascade(sps = sps,
+                                                         output_rates = rates)
+    start = time.process_time()
+    for k, cur_block in enumerate(blocks):
+        cascade.process(cur_block, start_time + k)
+    cascade_time = time.process_time() - start
+
+    start = time.process_time()
+    for cur_block in blocks:
+        for cur_rate in rates:
+            sp.signal.resample(cur_block, int(cur_rate))
+    resample_time = time.process_time() - start
+
+    start = time.process_time()
+    for cur_block in blocks:
+        for cur_rate in rates:
+            sp.signal.resample_poly(cur_block, 1, int(sps / cur_rate))
+    poly_time = time.process_time() - start
+
+    print("rates: %s sps, stages: %s, duration: %d s" % (args.rates,
+                                                         ' '.join([str(x.factor) for x in cascade.stages]),
+                                                         args.duration))
+    print("%-28s %12s %12s" % ('method', 'total [s]', 'per s [us]'))
+    for cur_name, cur_time in [('cascade', cascade_time),
+                               ('resample per rate', resample_time),
+                               ('resample_poly per rate', poly_time)]:
+        print("%-28s %12.3f %12.1f" % (cur_name, cur_time, cur_time / args.duration * 1e6))
+
+
+if __name__ == '__main__':
+    main()
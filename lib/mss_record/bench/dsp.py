@@ -0,0 +1,112 @@
+# -*- coding: utf-8 -*-
+# LICENSE
+#
+# This file is part of mss_record.
+#
+# If you use mss_record in any program or publication, please inform and
+# acknowledge its author Stefan Mertl (stefan@mertl-research.at).
+#
+# mss_record is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+''' Benchmark of the parallel processing of the channels.
+
+Measure the wall-clock time of the per-channel processing of one second
+(gridding, resampling and decimation) for an increasing number of
+synthetic channels, processed sequentially and by the DSP thread pool.
+The parallel processing gains from the numpy and scipy routines releasing
+the GIL, so the speedup is limited by the number of CPU cores.
+
+Usage: python3 -m mss_record.bench.dsp [options]
+'''
+
+import argparse
+import os
+import tempfile
+import time
+
+import numpy as np
+import obspy
+
+import mss_record.core.replay
+
+
+def measure(n_channels, dsp_workers, duration, output_rates, data_dir):
+    ''' Measure the processing time of the channels.
+
+    :return: The wall-clock times of the processed seconds [s].
+    '''
+    start_time = obspy.UTCDateTime('2021-01-01')
+    channels = []
+    for k in range(n_channels):
+        cur_source = mss_record.core.replay.synthetic_source(start_time = start_time,
+                                                             duration = duration + 2,
+                                                             seed = k)
+        channels.append(mss_record.core.replay.ReplayChannel(name = '%03d' % (k + 1),
+                                                             source = cur_source))
+    recorder = mss_record.core.replay.ReplayRecorder(network = 'XX',
+                                                     station = 'BENCH',
+                                                     location = '00',
+                                                     channels = channels,
+                                                     data_dir = data_dir,
+                                                     output_rates = output_rates,
+                                                     dsp_workers = dsp_workers)
+
+    times = []
+    for k in range(duration):
+        recorder.clock.sleep(1)
+        now = recorder.clock.now()
+        recorder.feed_channels(now)
+        start = time.perf_counter()
+        recorder.process_channels(request_start = now - 1,
+                                  request_end = now)
+        times.append(time.perf_counter() - start)
+    recorder.shutdown_dsp_executor()
+    return np.array(times)
+
+
+def main():
+    parser = argparse.ArgumentParser(description = 'Benchmark the parallel processing of the channels.')
+    parser.add_argument('--channels', type = str, default = '1,2,3,4,6,8',
+                        help = 'The comma separated numbers of channels.')
+    parser.add_argument('--dsp-workers', type = int, default = 0,
+                        help = 'The number of threads of the DSP pool. 0 uses one thread per CPU core.')
+    parser.add_argument('--duration', type = int, default = 60,
+                        help = 'The number of processed seconds.')
+    parser.add_argument('--output-rates', type = str, default = '20,1',
+                        help = 'The comma separated additional output rates [sps].')
+    args = parser.parse_args()
+
+    dsp_workers = args.dsp_workers
+    if dsp_workers == 0:
+        dsp_workers = os.cpu_count() or 1
+    output_rates = [float(x) for x in args.output_rates.split(',') if x.strip()]
+
+    print("cpu count: %s, dsp workers: %d, duration: %d s" % (os.cpu_count(),
+                                                             dsp_workers,
+                                                             args.duration))
+    print("%-10s %16s %16s %10s" % ('channels', 'sequential [ms]', 'parallel [ms]', 'speedup'))
+    with tempfile.TemporaryDirectory() as data_dir:
+        for cur_n in [int(x) for x in args.channels.split(',')]:
+            seq_times = measure(cur_n, None, args.duration, output_rates, data_dir)
+            par_times = measure(cur_n, dsp_workers, args.duration, output_rates, data_dir)
+            seq_median = np.median(seq_times)
+            par_median = np.median(par_times)
+            print("%-10d %16.2f %16.2f %10.2f" % (cur_n,
+                                                  seq_median * 1e3,
+                                                  par_median * 1e3,
+                                                  seq_median / par_median))
+
+
+if __name__ == '__main__':
+    main()
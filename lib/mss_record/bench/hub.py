@@ -0,0 +1,210 @@
+# -*- coding: utf-8 -*-
+# LICENSE
+#
+# This file is part of mss_record.
+#
+# If you use mss_record in any program or publication, please inform and
+# acknowledge its author Stefan Mertl (stefan@mertl-research.at).
+#
+# mss_record is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+''' Load test of the ingest hub.
+
+The hub runs in a separate process on localhost. Simulated stations push
+the records of a synthetic recording with RecordPusher instances as fast
+as possible. The pushers send at most a window of unacknowledged records
+and the hub acknowledges the records after each flush, so the wall time of
+a run is bound by the flush interval for few stations. The sustained
+ingest rate is measured by the hub from the first to the last received
+record, which has to span several flush intervals. The number of stations
+one hub can ingest is computed from the CPU time used by the hub process
+and the record rate of one station recording in real time.
+
+Usage: python3 -m mss_record.bench.hub [options]
+'''
+
+import argparse
+import asyncio
+import io
+import multiprocessing
+import os
+import tempfile
+import time
+
+import numpy as np
+import obspy
+
+import mss_record.core.hub
+import mss_record.core.pusher
+
+
+def station_records(duration, n_channels, reclen, seed = 0):
+    ''' Create the miniseed records of a synthetic station recording.
+
+    :return: A list of the records.
+    '''
+    rng = np.random.default_rng(seed)
+    sps = 100.
+    records = []
+    for k in range(n_channels):
+        cur_data = np.cumsum(rng.normal(0, 10, int(duration * sps))).astype(np.int32)
+        cur_trace = obspy.core.Trace(data = cur_data)
+        cur_trace.stats.network = 'XX'
+        cur_trace.stats.station = 'S0000'
+        cur_trace.stats.location = '00'
+        cur_trace.stats.channel = '%03d' % (k + 1)
+        cur_trace.stats.sampling_rate = sps
+        cur_trace.stats.starttime = obspy.UTCDateTime('2021-01-01')
+        buf = io.BytesIO()
+        cur_trace.write(buf, format = 'MSEED', reclen = reclen, encoding = 'STEIM2')
+        raw = buf.getvalue()
+        records.extend([raw[x:x + reclen] for x in range(0, len(raw), reclen)])
+    return records
+
+
+class BenchHub(mss_record.core.hub.IngestHub):
+    ''' An ingest hub recording the time of the first and the last received
+    record.
+
+    '''
+
+    def __init__(self, **kwargs):
+        ''' Initialization of the instance.
+
+        '''
+        super(BenchHub, self).__init__(**kwargs)
+
+        # The time of the first and the last received record [s].
+        self.first_received = None
+        self.last_received = None
+
+
+    def add_record(self, station, seq, record):
+        now = time.perf_counter()
+        if self.first_received is None:
+            self.first_received = now
+        self.last_received = now
+        super(BenchHub, self).add_record(station, seq, record)
+
+
+
+def run_hub(archive_dir, flush_interval, conn):
+    ''' Run the hub and send its port through the pipe.
+    '''
+    async def serve():
+        hub = BenchHub(archive_dir = archive_dir,
+                       host = '127.0.0.1',
+                       port = 0,
+                       flush_interval = flush_interval)
+        await hub.start()
+        cpu_start = time.process_time()
+        conn.send(hub.port)
+        loop = asyncio.get_running_loop()
+        # Stop the hub when the parent closes the pipe.
+        stop_event = asyncio.Event()
+        loop.add_reader(conn.fileno(), stop_event.set)
+        try:
+            while not stop_event.is_set():
+                try:
+                    await asyncio.wait_for(stop_event.wait(), timeout = hub.flush_interval)
+                except asyncio.TimeoutError:
+                    pass
+                await hub.flush()
+        finally:
+            loop.remove_reader(conn.fileno())
+            await hub.stop()
+        conn.send({'n_written': hub.n_written,
+                   'n_bytes': hub.n_written_bytes,
+                   'receive_time': hub.last_received - hub.first_received,
+                   'cpu_time': time.process_time() - cpu_start})
+
+    asyncio.run(serve())
+
+
+async def push_stations(port, n_stations, records):
+    ''' Push the records of the simulated stations to the hub.
+
+    :return: The time until all records were acknowledged [s].
+    '''
+    pushers = []
+    for k in range(n_stations):
+        cur_pusher = mss_record.core.pusher.RecordPusher(host = '127.0.0.1',
+                                                         port = port,
+                                                         station_id = 'XX.S%04d.00' % k,
+                                                         min_reconnect_interval = 0.1)
+        station = ('S%04d' % k).encode('ascii')
+        for cur_record in records:
+            cur_pusher.add_record(cur_record[:8] + station + cur_record[13:])
+        pushers.append(cur_pusher)
+
+    start = time.perf_counter()
+    tasks = [asyncio.create_task(x.run()) for x in pushers]
+    while any([x.pending for x in pushers]):
+        await asyncio.sleep(0.01)
+    elapsed = time.perf_counter() - start
+    for cur_task in tasks:
+        cur_task.cancel()
+    await asyncio.gather(*tasks, return_exceptions = True)
+    return elapsed
+
+
+def main():
+    parser = argparse.ArgumentParser(description = 'Load test of the ingest hub.')
+    parser.add_argument('--stations', type = str, default = '1,10,50,100,200',
+                        help = 'The comma separated numbers of simulated stations.')
+    parser.add_argument('--duration', type = int, default = 3600,
+                        help = 'The duration of the recording pushed by each station [s].')
+    parser.add_argument('--channels', type = int, default = 3,
+                        help = 'The number of channels of a station.')
+    parser.add_argument('--reclen', type = int, default = 512,
+                        help = 'The miniseed record length [bytes].')
+    parser.add_argument('--flush-interval', type = float, default = 0.1,
+                        help = 'The flush interval of the hub [s].')
+    args = parser.parse_args()
+
+    records = station_records(args.duration, args.channels, args.reclen)
+    station_rate = len(records) / args.duration
+    print("records per station: %d (%.3f records/s in real time)" % (len(records), station_rate))
+    print("%-10s %12s %12s %14s %12s %12s %16s" % ('stations', 'time [s]', 'ingest [s]', 'records/s',
+                                                   'MB/s', 'hub CPU [s]', 'station capacity'))
+
+    for cur_n in [int(x) for x in args.stations.split(',')]:
+        with tempfile.TemporaryDirectory() as archive_dir:
+            parent_conn, child_conn = multiprocessing.Pipe()
+            hub_process = multiprocessing.Process(target = run_hub,
+                                                  args = (archive_dir, args.flush_interval, child_conn))
+            hub_process.start()
+            port = parent_conn.recv()
+            elapsed = asyncio.run(push_stations(port, cur_n, records))
+            parent_conn.send('stop')
+            stats = parent_conn.recv()
+            hub_process.join()
+
+            expected = cur_n * len(records)
+            if stats['n_written'] != expected:
+                print("The hub wrote %d of %d records." % (stats['n_written'], expected))
+            if stats['receive_time'] < 5 * args.flush_interval:
+                print("The ingest spans less than 5 flush intervals. Increase the duration.")
+            rate = stats['n_written'] / stats['receive_time']
+            print("%-10d %12.2f %12.2f %14.0f %12.2f %12.2f %16.0f" % (cur_n,
+                                                                      elapsed,
+                                                                      stats['receive_time'],
+                                                                      rate,
+                                                                      stats['n_bytes'] / stats['receive_time'] / 1024**2,
+                                                                      stats['cpu_time'],
+                                                                      stats['n_written'] / stats['cpu_time'] / station_rate))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,100 @@
+# -*- coding: utf-8 -*-
+# LICENSE
+#
+# This file is part of mss_record.
+#
+# If you use mss_record in any program or publication, please inform and
+# acknowledge its author Stefan Mertl (stefan@mertl-research.at).
+#
+# mss_record is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+''' Benchmark of the streaming noise PSD.
+
+One hour of synthetic 100 sps data is fed in blocks of one second to the
+PSD estimator of a channel, as done by the recorder. The CPU time needed
+per hour and channel is measured for several window lengths. Run it on the
+recorder hardware to get the load on a Raspberry Pi.
+
+Usage: python3 -m mss_record.bench.psd [options]
+'''
+
+import argparse
+import tempfile
+import time
+
+import numpy as np
+import obspy
+
+import mss_record.core.psd
+
+
+def measure(nfft, overlap, n_average, duration, output_dir):
+    ''' Measure the CPU time of the PSD computation of one channel.
+
+    :return: A tuple of the CPU time per hour [s], the number of
+        computed windows and the memory size of the estimator [bytes].
+    '''
+    sps = 100
+    rng = np.random.default_rng(0)
+    data = np.cumsum(rng.normal(0, 10, int(duration * sps)))
+    start_time = obspy.UTCDateTime('2021-01-01')
+    monitor = mss_record.core.psd.PSDMonitor(output_dir = output_dir,
+                                             network = 'XX',
+                                             station = 'BENCH',
+                                             location = '00',
+                                             sps = sps,
+                                             nfft = nfft,
+                                             overlap = overlap,
+                                             n_average = n_average)
+    start = time.process_time()
+    for k in range(int(duration)):
+        monitor.add_data(channel = '001',
+                         start_time = start_time + k,
+                         data = data[k * sps:(k + 1) * sps])
+    monitor.flush()
+    cpu_time = time.process_time() - start
+    estimator = monitor.estimators['001']
+    n_windows = int((duration * sps - nfft) // estimator.step) + 1
+    return cpu_time * 3600. / duration, n_windows, estimator.memory_size
+
+
+def main():
+    parser = argparse.ArgumentParser(description = 'Benchmark the streaming noise PSD.')
+    parser.add_argument('--nfft', type = str, default = '1024,2048,4096,8192',
+                        help = 'The comma separated window lengths [samples].')
+    parser.add_argument('--overlap', type = float, default = 0.5,
+                        help = 'The overlap of the windows.')
+    parser.add_argument('--n-average', type = int, default = 4,
+                        help = 'The number of averaged windows.')
+    parser.add_argument('--duration', type = float, default = 3600,
+                        help = 'The duration of the processed data [s].')
+    args = parser.parse_args()
+
+    print("%-8s %10s %20s %14s %14s" % ('nfft', 'windows', 'cpu per hour [s]', 'cpu load [%]', 'memory [kB]'))
+    with tempfile.TemporaryDirectory() as output_dir:
+        for cur_nfft in [int(x) for x in args.nfft.split(',')]:
+            cpu_time, n_windows, memory_size = measure(cur_nfft,
+                                                       args.overlap,
+                                                       args.n_average,
+                                                       args.duration,
+                                                       output_dir)
+            print("%-8d %10d %20.3f %14.4f %14.1f" % (cur_nfft,
+                                                      n_windows,
+                                                      cpu_time,
+                                                      cpu_time / 36.,
+                                                      memory_size / 1024.))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,205 @@
+# -*- coding: utf-8 -*-
+# LICENSE
+#
+# This file is part of mss_record.
+#
+# If you use mss_record in any program or publication, please inform and
+# acknowledge its author Stefan Mertl (stefan@mertl-research.at).
+#
+# mss_record is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+''' Benchmark of the miniseed record length and encoding.
+
+Report the bytes per day, the CPU time per record and the record latency
+for each record length and encoding. The data is a synthetic,
+representative station signal: low-level ambient noise with occasional
+transient events. It is replayed through the ReplayRecorder, so the
+records are written by Recorder.write_data as in the live recorder. The
+latency is the time from the first sample of a record until the record is
+written. The records flushed at the end of the replay are not included.
+
+Usage: python3 -m mss_record.bench.record
+'''
+
+import argparse
+import collections
+import tempfile
+import time
+
+import numpy as np
+import obspy
+import obspy.io.mseed.util
+
+import mss_record.core.recorder
+import mss_record.core.replay
+
+
+# The miniseed encoding codes of the fixed header.
+ENCODING_NAMES = {1: 'INT16', 3: 'INT32', 10: 'STEIM1', 11: 'STEIM2'}
+
+
+def representative_data(sps, duration, noise = 20., seed = 0):
+    ''' Create ambient noise with occasional transient events.
+    '''
+    rng = np.random.default_rng(seed)
+    n_samples = int(sps * duration)
+    data = np.cumsum(rng.normal(0, noise, n_samples)) * 0.05 + rng.normal(0, noise, n_samples)
+    # Add an event of 30 s every 10 minutes.
+    event_len = int(30 * sps)
+    event_time = np.arange(event_len) / sps
+    event = 5000 * np.exp(-event_time / 5.) * np.sin(2 * np.pi * min(5., sps / 4) * event_time)
+    for k in range(0, n_samples - event_len, int(600 * sps)):
+        data[k:k + event_len] += event
+    data -= np.round(np.mean(data))
+    return np.clip(np.round(data), -32768, 32767)
+
+
+def representative_source(start_time, duration, sps = 128, seed = 0):
+    ''' A sample source of the representative data sampled by an ADC.
+
+    :return: A generator yielding blocks of (time [ns], count) arrays with
+        a length of one second.
+    '''
+    data = representative_data(sps = sps, duration = duration, seed = seed).astype(np.int16)
+    times = obspy.UTCDateTime(start_time).ns + np.round(np.arange(len(data)) * 1e9 / sps).astype(np.int64)
+    block_len = int(sps)
+    for k in range(0, len(data), block_len):
+        yield times[k:k + block_len], data[k:k + block_len]
+
+
+
+class BenchRecorder(mss_record.core.replay.ReplayRecorder):
+    ''' A replay recorder collecting the statistics of the written records.
+
+    '''
+
+    def __init__(self, **kwargs):
+        ''' Initialization of the instance.
+
+        '''
+        super(BenchRecorder, self).__init__(**kwargs)
+
+        # The written records: a tuple of the sampling rate, the size, the
+        # latency and the fill state for each record.
+        self.records = []
+
+        # The CPU time used to write the data and to analyze the records
+        # [s].
+        self.write_time = 0.
+        self.analyze_time = 0.
+
+        # True, while the data is flushed at the end of the replay.
+        self.flushing = False
+
+        self.record_handlers.append(self.analyze_file)
+
+
+    def write_data(self, now, flush = False):
+        self.flushing = flush
+        start = time.process_time()
+        super(BenchRecorder, self).write_data(now = now, flush = flush)
+        self.write_time += time.process_time() - start
+
+
+    def analyze_file(self, filepath):
+        ''' Collect the statistics of the records of a written file.
+        '''
+        if self.flushing:
+            return
+        start = time.process_time()
+        now = self.clock.now()
+        with open(filepath, 'rb') as msd_file:
+            raw = msd_file.read()
+        offset = 0
+        while offset < len(raw):
+            info = obspy.io.mseed.util.get_record_information(filepath, offset = offset)
+            record = raw[offset:offset + info['record_length']]
+            is_full = mss_record.core.recorder.record_is_full(record, ENCODING_NAMES[info['encoding']])
+            self.records.append((info['samp_rate'], len(record), now - info['starttime'], is_full))
+            offset += info['record_length']
+        self.analyze_time += time.process_time() - start
+
+
+
+def replay(duration, output_rates, reclen, encoding, max_latency, write_interval):
+    ''' Replay the representative data with a record configuration.
+
+    :return: A tuple of the BenchRecorder and the CPU time used to write
+        the data [s].
+    '''
+    record_config = {'reclen': reclen,
+                     'encoding': encoding,
+                     'max_latency': max_latency}
+    with tempfile.TemporaryDirectory() as data_dir:
+        channel = mss_record.core.replay.ReplayChannel(name = '001',
+                                                       source = representative_source(start_time = '2021-01-01',
+                                                                                      duration = duration))
+        recorder = BenchRecorder(network = 'XX',
+                                 station = 'BENCH',
+                                 location = '00',
+                                 channels = [channel],
+                                 channel_config = {'001': record_config},
+                                 data_dir = data_dir,
+                                 write_interval = write_interval,
+                                 output_rates = output_rates)
+        recorder.run()
+    return recorder, recorder.write_time - recorder.analyze_time
+
+
+def main():
+    parser = argparse.ArgumentParser(description = 'Benchmark the miniseed record length and encoding.')
+    parser.add_argument('--duration', type = float, default = 1800.,
+                        help = 'The duration of the replayed data [s].')
+    parser.add_argument('--rates', type = str, default = '20,1',
+                        help = 'The comma separated output rates recorded in addition to 100 sps [sps].')
+    parser.add_argument('--max-latency', type = float, default = None,
+                        help = 'The configured maximum record latency [s].')
+    parser.add_argument('--write-interval', type = int, default = 10,
+                        help = 'The interval to write the miniseed files [s].')
+    args = parser.parse_args()
+    output_rates = [float(x) for x in args.rates.split(',') if x.strip()]
+
+    print("duration: %.0f s, max. latency: %s, write interval: %d s" % (args.duration,
+                                                                       args.max_latency,
+                                                                       args.write_interval))
+    print("%6s %7s %7s | %12s %10s %10s %12s %12s %12s" % ('sps', 'reclen', 'enc.',
+                                                             'bytes/day', 'records', 'partial',
+                                                             'CPU/rec [us]', 'latency [s]', 'max lat. [s]'))
+    for cur_reclen in mss_record.core.recorder.RECORD_LENGTHS:
+        for cur_encoding in mss_record.core.recorder.RECORD_ENCODINGS:
+            recorder, cpu_time = replay(duration = args.duration,
+                                        output_rates = output_rates,
+                                        reclen = cur_reclen,
+                                        encoding = cur_encoding,
+                                        max_latency = args.max_latency,
+                                        write_interval = args.write_interval)
+            rate_records = collections.defaultdict(list)
+            for cur_record in recorder.records:
+                rate_records[cur_record[0]].append(cur_record[1:])
+            for cur_sps in sorted(rate_records.keys(), reverse = True):
+                cur_records = rate_records[cur_sps]
+                n_bytes = sum([x[0] for x in cur_records])
+                latency = [x[1] for x in cur_records]
+                n_partial = len([x for x in cur_records if not x[2]])
+                print("%6g %7d %7s | %12.0f %10d %10d %12.1f %12.1f %12.1f" % (cur_sps, cur_reclen, cur_encoding,
+                                                                               n_bytes * 86400. / args.duration,
+                                                                               len(cur_records),
+                                                                               n_partial,
+                                                                               cpu_time / len(recorder.records) * 1e6,
+                                                                               np.mean(latency),
+                                                                               max(latency)))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,237 @@
+# -*- coding: utf-8 -*-
+# LICENSE
+#
+# This file is part of mss_record.
+#
+# If you use mss_record in any program or publication, please inform and
+# acknowledge its author Stefan Mertl (stefan@mertl-research.at).
+#
+# mss_record is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+''' Benchmark of the multiplexed ADS1115 scan.
+
+Compare the effective sampling rate and the inter-channel skew of a
+multiplexed ADS1115 scan with the one-ADC-per-channel setup. The DRDY
+timing of both setups is simulated. The latency of the DRDY handler is
+measured using the ScanEngine with a simulated ADC. The simulated scan
+timestamps are passed to the phase tracking of the ScanEngine, which gives
+the tracked skew of the scan cycle.
+
+Usage: python3 -m mss_record.bench.scan
+'''
+
+import argparse
+import multiprocessing
+import time
+
+import numpy as np
+
+import mss_record.adc.ads111x as mss_ads111x
+import mss_record.adc.simulation as mss_simulation
+import mss_record.core.scan
+
+
+class DiscardQueue(object):
+    ''' A queue dropping all samples.
+    '''
+    def put(self, item):
+        pass
+
+
+def create_engine(data_rate, n_inputs, i2c_clock = 400000):
+    ''' Create a ScanEngine using a simulated ADC.
+    '''
+    device = mss_simulation.SimulatedI2CDevice(i2c_clock = i2c_clock,
+                                               simulate_timing = True)
+    adc = mss_ads111x.ADS1115(i2c_bus = None, device = device)
+    engine = mss_record.core.scan.ScanEngine(name = 'bench',
+                                             adc_address = device.address,
+                                             rdy_gpio = None,
+                                             i2c_mutex = multiprocessing.Lock(),
+                                             data_rate = data_rate,
+                                             adc = adc)
+    for k in range(n_inputs):
+        engine.add_input(name = '%03d' % k,
+                         mux = 4 + k,
+                         data_queue = DiscardQueue())
+    engine.start_adc()
+    return engine
+
+
+def measure_callback_time(data_rate, n_inputs, n_calls = 2000, i2c_clock = 400000):
+    ''' Measure the duration of the DRDY handlers using a simulated ADC.
+
+    :return: A tuple with the median duration of the ScanEngine DRDY
+        handler and the median duration of reading a sample from a single
+        ADC [s].
+    '''
+    engine = create_engine(data_rate = data_rate,
+                           n_inputs = n_inputs,
+                           i2c_clock = i2c_clock)
+    adc = engine.adc
+
+    scan_time = []
+    for k in range(n_calls):
+        # Measure the handler of the DRDY edges switching the multiplexer.
+        engine.settling = False
+        start = time.perf_counter()
+        engine.drdy_callback(None)
+        scan_time.append(time.perf_counter() - start)
+
+    single_time = []
+    i2c_mutex = multiprocessing.Lock()
+    for k in range(n_calls):
+        start = time.perf_counter()
+        i2c_mutex.acquire()
+        adc.get_last_result()
+        i2c_mutex.release()
+        single_time.append(time.perf_counter() - start)
+
+    return np.median(scan_time), np.median(single_time)
+
+
+def simulate_single(data_rate, n_channels, duration, spread, latency, rng):
+    ''' Simulate the sample timestamps of one free running ADC per channel.
+    '''
+    times = []
+    for k in range(n_channels):
+        cur_rate = data_rate * rng.uniform(1 - spread, 1 + spread)
+        cur_phase = rng.uniform(0, 1 / cur_rate)
+        cur_n = int(duration * cur_rate)
+        cur_times = cur_phase + np.arange(cur_n) / cur_rate
+        cur_times += rng.exponential(latency, cur_n)
+        times.append(cur_times[cur_times < duration])
+    return times
+
+
+def simulate_scan(data_rate, n_inputs, duration, spread, latency, i2c_clock, rng):
+    ''' Simulate the sample timestamps of a multiplexed ADS1115 scan.
+
+    Writing the config register is assumed to restart the conversion. The
+    first conversion after a switch is discarded.
+    '''
+    cur_rate = data_rate * rng.uniform(1 - spread, 1 + spread)
+    switch_time = (mss_ads111x.ADS111x_MUX_SWITCH_BYTES * 9 + 2) / i2c_clock
+    n_slots = int(duration * cur_rate) + 1
+    irq_latency = rng.exponential(latency, n_slots)
+    slot_time = irq_latency + switch_time + mss_ads111x.ADS111x_SCAN_CONVERSIONS / cur_rate
+    drdy_times = np.cumsum(slot_time)
+    # The timestamp is taken when the DRDY handler is entered.
+    stamp_times = drdy_times + np.roll(irq_latency, -1)
+    times = []
+    for k in range(n_inputs):
+        cur_times = stamp_times[k::n_inputs]
+        times.append(cur_times[cur_times < duration])
+    return times
+
+
+def track_skew(engine, times):
+    ''' Track the sampling phase of the scan timestamps with the ScanEngine.
+
+    :return: The tracked skew of the scan cycle [s].
+    '''
+    n_cycles = min([len(x) for x in times])
+    for k in range(n_cycles):
+        for cur_index, cur_times in enumerate(times):
+            engine.update_phase(cur_index, cur_times[k])
+    return engine.skew
+
+
+def compute_metrics(times, duration, output_sps = 100.):
+    ''' Compute the effective sampling rate and the inter-channel skew.
+
+    The skew is the spread of the timestamps of the samples selected by the
+    nearest neighbour gridding to the output sampling rate.
+    '''
+    rate = np.mean([len(x) / duration for x in times])
+    grid = np.arange(1, duration - 1, 1 / output_sps)
+    selected = []
+    for cur_times in times:
+        ind = np.clip(np.searchsorted(cur_times, grid), 1, len(cur_times) - 1)
+        left = cur_times[ind - 1]
+        right = cur_times[ind]
+        selected.append(np.where(grid - left < right - grid, left, right))
+    selected = np.array(selected)
+    skew = selected.max(axis = 0) - selected.min(axis = 0)
+    return rate, np.mean(skew), np.max(skew)
+
+
+def main():
+    parser = argparse.ArgumentParser(description = 'Benchmark the multiplexed ADS1115 scan.')
+    parser.add_argument('--channels', type = int, default = 3,
+                        help = 'The number of channels.')
+    parser.add_argument('--duration', type = float, default = 60.,
+                        help = 'The simulated duration [s].')
+    parser.add_argument('--spread', type = float, default = 0.02,
+                        help = 'The relative spread of the ADC oscillator frequencies.')
+    parser.add_argument('--irq-latency', type = float, default = 0.0001,
+                        help = 'The mean latency of the GPIO interrupt [s].')
+    parser.add_argument('--i2c-clock', type = int, default = 400000,
+                        help = 'The I2C clock frequency [Hz].')
+    args = parser.parse_args()
+
+    rng = np.random.default_rng(0)
+
+    print("channels: %d, duration: %.0f s, oscillator spread: %.1f %%, I2C clock: %d Hz" % (args.channels,
+                                                                                         args.duration,
+                                                                                         args.spread * 100,
+                                                                                         args.i2c_clock))
+    print("%6s | %10s %10s %10s | %10s %10s %10s %10s %12s %10s" % ('DR',
+                                                                     'single sps', 'skew mean', 'skew max',
+                                                                     'scan sps', 'model sps', 'skew mean', 'skew max',
+                                                                     'tracked skew', 'drdy dt'))
+    print("%6s | %10s %10s %10s | %10s %10s %10s %10s %12s %10s" % ('', '', '[ms]', '[ms]',
+                                                                     '', '', '[ms]', '[ms]', '[ms]', '[us]'))
+    for cur_dr in sorted(mss_ads111x.ADS111x_CONFIG_DR):
+        scan_dt, single_dt = measure_callback_time(data_rate = cur_dr,
+                                                   n_inputs = args.channels,
+                                                   i2c_clock = args.i2c_clock)
+        single_times = simulate_single(data_rate = cur_dr,
+                                       n_channels = args.channels,
+                                       duration = args.duration,
+                                       spread = args.spread,
+                                       latency = args.irq_latency + single_dt,
+                                       rng = rng)
+        scan_times = simulate_scan(data_rate = cur_dr,
+                                   n_inputs = args.channels,
+                                   duration = args.duration,
+                                   spread = args.spread,
+                                   latency = args.irq_latency + scan_dt,
+                                   i2c_clock = args.i2c_clock,
+                                   rng = rng)
+        tracked_skew = track_skew(engine = create_engine(data_rate = cur_dr,
+                                                         n_inputs = args.channels,
+                                                         i2c_clock = args.i2c_clock),
+                                  times = scan_times)
+        single_rate, single_skew, single_max_skew = compute_metrics(single_times, args.duration)
+        scan_rate, scan_skew, scan_max_skew = compute_metrics(scan_times, args.duration)
+        model_rate = mss_ads111x.scan_rate(data_rate = cur_dr,
+                                           n_inputs = args.channels,
+                                           i2c_clock = args.i2c_clock,
+                                           latency = args.irq_latency + scan_dt,
+                                           oscillator_tolerance = 0.)
+        print("%6d | %10.1f %10.2f %10.2f | %10.1f %10.1f %10.2f %10.2f %12.2f %10.1f" % (cur_dr,
+                                                                                         single_rate,
+                                                                                         single_skew * 1000,
+                                                                                         single_max_skew * 1000,
+                                                                                         scan_rate,
+                                                                                         model_rate,
+                                                                                         scan_skew * 1000,
+                                                                                         scan_max_skew * 1000,
+                                                                                         tracked_skew * 1000,
+                                                                                         scan_dt * 1e6))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,361 @@
+# -*- coding: utf-8 -*-
+# LICENSE
+#
+# This file is part of mss_record.
+#
+# If you use mss_record in any program or publication, please inform and
+# acknowledge its author Stefan Mertl (stefan@mertl-research.at).
+#
+# mss_record is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+''' Accelerated time soak test of the recorder.
+
+The recorder processes synthetic ADC sample streams using a virtual clock,
+so that days of operation are processed in minutes. After a warm-up time,
+the resident memory, the traced python memory, the number of python
+objects and the buffered data are sampled periodically. The processing
+time of each second is measured for the stages of the processing.
+
+The test fails with a nonzero exit code, if the growth of a value or the
+processing time exceeds its budget.
+
+Tracing the memory allocations slows down the processing by an order of
+magnitude. Use --no-tracemalloc for long runs and to check the processing
+time budgets with realistic values.
+
+Usage: python3 -m mss_record.bench.soak [options]
+'''
+
+import argparse
+import gc
+import os
+import resource
+import sys
+import tempfile
+import time
+import tracemalloc
+
+import numpy as np
+import obspy
+
+import mss_record.core.replay
+
+
+def rss():
+    ''' The resident set size of the process [bytes].
+    '''
+    try:
+        with open('/proc/self/statm') as statm_file:
+            return int(statm_file.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (IOError, OSError):
+        # The peak value is the best approximation without procfs.
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+
+class TimedReplayChannel(mss_record.core.replay.ReplayChannel):
+    ''' A replay channel measuring the time of the data requests.
+
+    '''
+
+    def __init__(self, timing, **kwargs):
+        ''' Initialization of the instance.
+
+        :param timing: The dictionary collecting the stage times.
+        '''
+        super(TimedReplayChannel, self).__init__(**kwargs)
+        self.timing = timing
+
+
+    def get_data(self, start_time, end_time):
+        start = time.perf_counter()
+        ret_data = super(TimedReplayChannel, self).get_data(start_time = start_time,
+                                                            end_time = end_time)
+        self.timing['get_data'] += time.perf_counter() - start
+        return ret_data
+
+
+
+class SoakRecorder(mss_record.core.replay.ReplayRecorder):
+    ''' A replay recorder sampling the resource usage.
+
+    '''
+
+    def __init__(self, timing, duration, warmup, sample_interval, use_tracemalloc = True,
+                 snapshot_dir = None, **kwargs):
+        ''' Initialization of the instance.
+
+        :param timing: The dictionary collecting the stage times.
+        :param duration: The simulated duration [s].
+        :param warmup: The time before the baseline sample [s].
+        :param sample_interval: The interval of the resource samples [s].
+        :param snapshot_dir: The directory where to dump the tracemalloc
+            snapshots.
+        '''
+        super(SoakRecorder, self).__init__(**kwargs)
+
+        self.timing = timing
+
+        self.use_tracemalloc = use_tracemalloc
+
+        # The time of the next resource sample.
+        self.next_sample = self.clock.now() + warmup
+
+        self.sample_interval = sample_interval
+
+        # The resource samples.
+        self.samples = []
+
+        # The files of the tracemalloc snapshots of the first and the last
+        # sample. The snapshots are dumped to files, so they don't add to the
+        # object count of the following samples.
+        self.snapshot_dir = snapshot_dir
+        self.baseline_snapshot = None
+        self.last_snapshot = None
+
+        # The processing times of the seconds for each stage. The arrays are
+        # preallocated and filled to keep the memory usage of the harness
+        # constant.
+        self.second_times = {x: np.full(int(duration) + 2, np.nan) for x in ['feed', 'get_data', 'process',
+                                                                       'decimate', 'write', 'total']}
+        self.n_seconds = 0
+
+
+    def collect_data(self):
+        now = self.clock.now()
+        for cur_key in self.timing.keys():
+            self.timing[cur_key] = 0.
+        start = time.perf_counter()
+        super(SoakRecorder, self).collect_data()
+        total = time.perf_counter() - start
+
+        if self.n_seconds < len(self.second_times['total']):
+            k = self.n_seconds
+            self.second_times['total'][k] = total
+            for cur_key, cur_time in self.timing.items():
+                self.second_times[cur_key][k] = cur_time
+            self.second_times['process'][k] = total - sum(self.timing.values())
+            self.n_seconds += 1
+
+        if now >= self.next_sample:
+            self.sample(now)
+            self.next_sample += self.sample_interval
+
+
+    def sample(self, now):
+        ''' Sample the resource usage.
+        '''
+        gc.collect()
+        cur_sample = {'time': now,
+                      'rss': rss(),
+                      'objects': len(gc.get_objects()),
+                      'stream_traces': len(self.stream),
+                      'buffered_samples': sum([len(x.data) for x in self.channels.values()])}
+        if self.use_tracemalloc:
+            # Ignore the allocations of the soak harness.
+            snapshot = tracemalloc.take_snapshot().filter_traces([tracemalloc.Filter(False, __file__),
+                                                                  tracemalloc.Filter(False, tracemalloc.__file__)])
+            # The memory used by tracemalloc itself is not part of the
+            # recorder RSS.
+            cur_sample['rss'] -= tracemalloc.get_tracemalloc_memory()
+            cur_sample['traced'] = sum([x.size for x in snapshot.statistics('filename')])
+            if self.baseline_snapshot is None:
+                self.baseline_snapshot = os.path.join(self.snapshot_dir, 'baseline.snapshot')
+                snapshot.dump(self.baseline_snapshot)
+            self.last_snapshot = os.path.join(self.snapshot_dir, 'last.snapshot')
+            snapshot.dump(self.last_snapshot)
+            del snapshot
+        self.samples.append(cur_sample)
+
+
+    def feed_channels(self, now):
+        start = time.perf_counter()
+        for cur_channel in self.channels.values():
+            cur_channel.feed(now)
+        self.timing['feed'] += time.perf_counter() - start
+
+
+    def decimate(self, name, data, start_time):
+        start = time.perf_counter()
+        ret_val = super(SoakRecorder, self).decimate(name, data, start_time)
+        self.timing['decimate'] += time.perf_counter() - start
+        return ret_val
+
+
+    def write_data(self, now, flush = False):
+        start = time.perf_counter()
+        super(SoakRecorder, self).write_data(now = now, flush = flush)
+        self.timing['write'] += time.perf_counter() - start
+
+
+
+def check_budgets(recorder, args):
+    ''' Check the resource samples and the processing times against the
+    budgets.
+
+    :return: A list of the exceeded budgets.
+    '''
+    failures = []
+    if len(recorder.samples) < 2:
+        failures.append("Not enough resource samples. Increase the duration.")
+        return failures
+
+    first = recorder.samples[0]
+    last = recorder.samples[-1]
+
+    rss_growth = (last['rss'] - first['rss']) / 1024**2
+    if rss_growth > args.max_rss_growth:
+        failures.append("RSS growth %.1f MB > %.1f MB." % (rss_growth, args.max_rss_growth))
+
+    if 'traced' in last:
+        traced_growth = (last['traced'] - first['traced']) / 1024**2
+        if traced_growth > args.max_traced_growth:
+            failures.append("Traced memory growth %.2f MB > %.2f MB." % (traced_growth, args.max_traced_growth))
+
+    object_growth = last['objects'] - first['objects']
+    if object_growth > args.max_object_growth:
+        failures.append("Object count growth %d > %d." % (object_growth, args.max_object_growth))
+
+    max_traces = max([x['stream_traces'] for x in recorder.samples])
+    if max_traces > args.max_stream_traces:
+        failures.append("Stream traces %d > %d." % (max_traces, args.max_stream_traces))
+
+    max_buffered = max([x['buffered_samples'] for x in recorder.samples])
+    if max_buffered > args.max_buffered_samples:
+        failures.append("Buffered channel samples %d > %d." % (max_buffered, args.max_buffered_samples))
+
+    total = recorder.second_times['total'][:recorder.n_seconds]
+    p99 = np.percentile(total, 99)
+    if p99 > args.max_second_p99:
+        failures.append("99th percentile of the processing time per second %.1f ms > %.1f ms." % (p99 * 1e3, args.max_second_p99 * 1e3))
+    if np.max(total) > args.max_second_time:
+        failures.append("Maximum processing time per second %.1f ms > %.1f ms." % (np.max(total) * 1e3, args.max_second_time * 1e3))
+
+    return failures
+
+
+def report(recorder, wall_time):
+    ''' Print the resource samples and the stage times.
+    '''
+    print("%-22s %10s %10s %10s %8s %10s" % ('time', 'rss [MB]', 'traced [MB]', 'objects',
+                                             'traces', 'buffered'))
+    for cur_sample in recorder.samples:
+        print("%-22s %10.1f %10s %10d %8d %10d" % (cur_sample['time'].strftime('%Y-%m-%dT%H:%M:%S'),
+                                                   cur_sample['rss'] / 1024**2,
+                                                   '%.2f' % (cur_sample['traced'] / 1024**2) if 'traced' in cur_sample else '-',
+                                                   cur_sample['objects'],
+                                                   cur_sample['stream_traces'],
+                                                   cur_sample['buffered_samples']))
+    print()
+    n_seconds = recorder.n_seconds
+    print("processed %d s in %.1f s wall time (%.0fx real time)" % (n_seconds, wall_time,
+                                                                     n_seconds / wall_time))
+    print("%-10s %10s %10s %10s" % ('stage', 'mean [ms]', 'p99 [ms]', 'max [ms]'))
+    for cur_stage, cur_times in recorder.second_times.items():
+        cur_times = cur_times[:n_seconds]
+        print("%-10s %10.2f %10.2f %10.2f" % (cur_stage, np.mean(cur_times) * 1e3,
+                                              np.percentile(cur_times, 99) * 1e3,
+                                              np.max(cur_times) * 1e3))
+
+
+def main():
+    parser = argparse.ArgumentParser(description = 'Soak test of the recorder in accelerated time.')
+    parser.add_argument('--duration', type = float, default = 86400.,
+                        help = 'The simulated duration [s].')
+    parser.add_argument('--channels', type = str, default = '001,002,003',
+                        help = 'The comma separated names of the simulated channels.')
+    parser.add_argument('--output-rates', type = str, default = '20,1',
+                        help = 'The comma separated additional output sampling rates [sps].')
+    parser.add_argument('--write-interval', type = int, default = 10,
+                        help = 'The interval to write the miniseed files [s].')
+    parser.add_argument('--warmup', type = float, default = 600.,
+                        help = 'The simulated time before the baseline sample [s].')
+    parser.add_argument('--sample-interval', type = float, default = 3600.,
+                        help = 'The simulated interval of the resource samples [s].')
+    parser.add_argument('--no-tracemalloc', action = 'store_true',
+                        help = "Don't trace the python memory allocations.")
+    parser.add_argument('--data-dir', type = str, default = None,
+                        help = 'The directory of the miniseed files. A temporary directory is used by default.')
+    parser.add_argument('--max-rss-growth', type = float, default = 16.,
+                        help = 'The budget of the RSS growth [MB].')
+    parser.add_argument('--max-traced-growth', type = float, default = 2.,
+                        help = 'The budget of the traced memory growth [MB].')
+    parser.add_argument('--max-object-growth', type = int, default = 5000,
+                        help = 'The budget of the python object count growth.')
+    parser.add_argument('--max-stream-traces', type = int, default = 100,
+                        help = 'The budget of the traces buffered in the recorder stream.')
+    parser.add_argument('--max-buffered-samples', type = int, default = 1000,
+                        help = 'The budget of the samples buffered in the channels.')
+    parser.add_argument('--max-second-p99', type = float, default = 0.5,
+                        help = 'The budget of the 99th percentile of the processing time per second [s].')
+    parser.add_argument('--max-second-time', type = float, default = 1.,
+                        help = 'The budget of the maximum processing time per second [s]. The processing of a second has to finish within the second.')
+    args = parser.parse_args()
+
+    if not args.no_tracemalloc:
+        tracemalloc.start()
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        data_dir = args.data_dir or tmp_dir
+        start_time = obspy.UTCDateTime('2021-01-01')
+        timing = {'feed': 0., 'get_data': 0., 'decimate': 0., 'write': 0.}
+        channels = []
+        for k, cur_name in enumerate(args.channels.split(',')):
+            cur_source = mss_record.core.replay.synthetic_source(start_time = start_time,
+                                                                 duration = args.duration,
+                                                                 drift = 50e-6 * (k - 1),
+                                                                 seed = k)
+            channels.append(TimedReplayChannel(timing = timing,
+                                               name = cur_name.strip(),
+                                               source = cur_source))
+        recorder = SoakRecorder(timing = timing,
+                                duration = args.duration,
+                                snapshot_dir = tmp_dir,
+                                warmup = args.warmup,
+                                sample_interval = args.sample_interval,
+                                use_tracemalloc = not args.no_tracemalloc,
+                                network = 'XX',
+                                station = 'SOAK',
+                                location = '00',
+                                channels = channels,
+                                data_dir = data_dir,
+                                write_interval = args.write_interval,
+                                output_rates = [float(x) for x in args.output_rates.split(',') if x.strip()])
+        start = time.perf_counter()
+        recorder.run()
+        wall_time = time.perf_counter() - start
+        # Take the final sample at the end of the replay.
+        recorder.sample(recorder.clock.now())
+
+        report(recorder, wall_time)
+        failures = check_budgets(recorder, args)
+        if failures and recorder.baseline_snapshot is not None:
+            print()
+            print("Largest traced memory growth:")
+            baseline = tracemalloc.Snapshot.load(recorder.baseline_snapshot)
+            last = tracemalloc.Snapshot.load(recorder.last_snapshot)
+            for cur_stat in last.compare_to(baseline, 'lineno')[:10]:
+                print(cur_stat)
+
+    print()
+    if failures:
+        for cur_failure in failures:
+            print("FAILED: %s" % cur_failure)
+        return 1
+    print("PASSED")
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,414 @@
+# -*- coding: utf-8 -*-
+# LICENSE
+#
+# This file is part of mss_record.
+#
+# If you use mss_record in any program or publication, please inform and
+# acknowledge its author Stefan Mertl (stefan@mertl-research.at).
+#
+# mss_record is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+''' The asyncio core of the recorder.
+
+The AsyncRecorder runs the data collection, the supervision of the
+acquisition worker, the clock monitor and additional services as tasks of
+one asyncio event loop in the main thread. The acquisition worker process
+collects the samples of the DRDY handlers and sends them in blocks through
+a pipe, which is read by the event loop.
+'''
+
+import asyncio
+import collections
+import concurrent.futures
+import logging
+import multiprocessing
+import pickle
+import signal
+import sys
+
+import numpy as np
+
+import mss_record.core.recorder
+import mss_record.core.supervisor
+
+
+class SampleBlockBuffer(object):
+    ''' Collect the samples of a channel in the acquisition worker.
+
+    The buffer replaces the data queue of the channel in the worker process.
+    '''
+
+    def __init__(self):
+        ''' Initialization of the instance.
+
+        '''
+        self.samples = collections.deque()
+
+
+    def put(self, sample):
+        ''' Add a sample (timestamp, count) to the buffer.
+        '''
+        self.samples.append(sample)
+
+
+    def take(self):
+        ''' Remove all buffered samples.
+
+        :return: A tuple of the timestamps [ns] and the counts.
+        '''
+        n_samples = len(self.samples)
+        samples = [self.samples.popleft() for x in range(n_samples)]
+        times = np.array([x[0].ns for x in samples], dtype = np.int64)
+        counts = np.array([x[1] for x in samples], dtype = np.int32)
+        return times, counts
+
+
+
+def block_request(channels, stop_event, heartbeat, conn, block_interval = 0.1):
+    ''' Request data from the ADCs and send it in blocks through the pipe.
+
+    :param conn: The sending connection of the pipe.
+    :param block_interval: The interval to send the sample blocks [s].
+    '''
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    # The logger.
+    logger_name = __name__
+    logger = logging.getLogger(logger_name)
+
+    logger.info("Starting the ADC block request for channels: %s.", ','.join(channels.keys()))
+    for cur_name in sorted(channels.keys()):
+        cur_channel = channels[cur_name]
+        cur_channel.data_queue = SampleBlockBuffer()
+        logger.info("Starting channel %s.", cur_name)
+        cur_channel.run()
+
+    while not stop_event.wait(block_interval):
+        heartbeat.beat()
+        for cur_name in sorted(channels.keys()):
+            times, counts = channels[cur_name].data_queue.take()
+            if len(times) > 0:
+                conn.send((cur_name, times, counts))
+
+    for cur_name in sorted(channels.keys()):
+        cur_channel = channels[cur_name]
+        logger.info("Stopping channel %s.", cur_name)
+        cur_channel.stop()
+        times, counts = cur_channel.data_queue.take()
+        if len(times) > 0:
+            conn.send((cur_name, times, counts))
+    conn.close()
+    logger.info("Leaving the block_request process.")
+    sys.exit(0)
+
+
+
+class AsyncSupervisor(mss_record.core.supervisor.Supervisor):
+    ''' Supervise the acquisition worker from an asyncio event loop.
+
+    The checks and the restarts of the worker run in executor threads, so
+    the joins of the worker and the rearming of the ADCs don't block the
+    event loop. The reader of the pipe is changed in the event loop thread.
+    '''
+
+    def __init__(self, loop, block_interval = 0.1, **kwargs):
+        ''' Initialization of the instance.
+
+        :param loop: The asyncio event loop.
+        :param block_interval: The interval of the sample blocks sent by
+            the worker [s].
+        '''
+        super(AsyncSupervisor, self).__init__(**kwargs)
+
+        self.loop = loop
+
+        self.block_interval = block_interval
+
+        # The receiving connection of the pipe of the current worker.
+        self.conn = None
+
+
+    def start(self):
+        ''' Start the worker.
+
+        The supervision is done by the monitor coroutine.
+        '''
+        for cur_name, cur_channel in self.channels.items():
+            cur_channel.sample_counter = self.heartbeat.sample_counts[cur_name]
+        self.start_worker()
+
+
+    def stop(self):
+        ''' Stop the worker.
+
+        No restarts are done after the stop.
+        '''
+        with self.restart_mutex:
+            self.stop_event.set()
+            self.stop_worker()
+
+
+    def restart(self, reason):
+        ''' Restart the worker, if the supervisor is not stopped.
+        '''
+        with self.restart_mutex:
+            if self.stop_event.is_set():
+                return
+            self.restart_worker(reason)
+
+
+    def call_in_loop(self, func, *args):
+        ''' Call a function in the event loop thread and wait for the result.
+
+        The function is called directly, if the caller runs in the event
+        loop thread or if the event loop is not running.
+        '''
+        try:
+            in_loop = asyncio.get_running_loop() is self.loop
+        except RuntimeError:
+            in_loop = False
+        if in_loop or not self.loop.is_running():
+            return func(*args)
+
+        result = concurrent.futures.Future()
+        def call():
+            try:
+                result.set_result(func(*args))
+            except Exception as e:
+                result.set_exception(e)
+        self.loop.call_soon_threadsafe(call)
+        return result.result()
+
+
+    def start_worker(self):
+        ''' Start a new worker with a new pipe.
+        '''
+        self.conn, send_conn = multiprocessing.Pipe(duplex = False)
+        self.worker_args = (send_conn, self.block_interval)
+        super(AsyncSupervisor, self).start_worker()
+        # The sending connection is used by the worker only.
+        send_conn.close()
+        self.worker_args = ()
+        self.call_in_loop(self.loop.add_reader, self.conn.fileno(), self.receive_blocks)
+
+
+    def stop_worker(self, timeout = 0.2, failed = False):
+        ''' Stop the worker and close the pipe.
+        '''
+        clean = super(AsyncSupervisor, self).stop_worker(timeout = timeout,
+                                                         failed = failed)
+        if self.conn is not None:
+            self.call_in_loop(self.loop.remove_reader, self.conn.fileno())
+            # Receive the complete blocks still in the pipe. A killed
+            # worker may have left an incomplete block at the end.
+            self.receive_blocks()
+            self.conn.close()
+            self.conn = None
+        return clean
+
+
+    def receive_blocks(self):
+        ''' Move the sample blocks available in the pipe to the channels.
+
+        The samples are added to the channel buffers holding the data
+        mutex of the channel, so this is serialized with the data
+        collection running in the collect thread.
+        '''
+        try:
+            while self.conn.poll():
+                cur_name, times, counts = self.conn.recv()
+                self.channels[cur_name].add_samples(times, counts)
+        except (EOFError, OSError, pickle.UnpicklingError):
+            # The worker has exited or left an incomplete block. The
+            # reader is removed until the worker is restarted.
+            self.call_in_loop(self.loop.remove_reader, self.conn.fileno())
+
+
+    async def monitor(self):
+        ''' The supervision task.
+        '''
+        while True:
+            await asyncio.sleep(self.check_interval)
+            try:
+                await self.loop.run_in_executor(None, self.supervise)
+            except Exception:
+                self.logger.exception("Error in the supervisor.")
+
+
+
+class AsyncRecorder(mss_record.core.recorder.Recorder):
+    ''' The recorder running its tasks in an asyncio event loop.
+
+    '''
+
+    def __init__(self, block_interval = 0.1, **kwargs):
+        ''' Initialization of the instance.
+
+        :param block_interval: The interval of the sample blocks sent by
+            the acquisition worker [s].
+        '''
+        super(AsyncRecorder, self).__init__(**kwargs)
+
+        self.block_interval = block_interval
+
+        # The coroutine functions of additional services. They are called
+        # with the recorder as argument when the recorder starts.
+        self.services = []
+
+        # The single thread running the data collection, so the event loop
+        # is not blocked by the processing and the writing of the data.
+        self.collect_executor = None
+
+        # The event loop and the event requesting the stop of the recorder.
+        self.loop = None
+        self.stop_requested = None
+
+        self.supervisor = None
+
+
+    def add_service(self, service):
+        ''' Add a service running in the event loop of the recorder.
+
+        :param service: A coroutine function called with the recorder as
+            argument.
+        '''
+        self.services.append(service)
+
+
+    def run(self):
+        ''' Run the recorder until it is stopped.
+        '''
+        asyncio.run(self.run_async())
+
+
+    async def run_async(self):
+        ''' Run the tasks of the recorder until the stop is requested.
+        '''
+        self.loop = asyncio.get_running_loop()
+        self.stop_requested = asyncio.Event()
+        for cur_signal in [signal.SIGINT, signal.SIGTERM]:
+            self.loop.add_signal_handler(cur_signal, self.request_stop, cur_signal)
+
+        # Wait for the next full second, than start the channels.
+        now = self.clock.now()
+        await asyncio.sleep((1e6 - now.microsecond) / 1e6)
+
+        self.supervisor = AsyncSupervisor(loop = self.loop,
+                                          channels = self.channels,
+                                          worker = block_request,
+                                          block_interval = self.block_interval)
+        self.supervisor.start()
+
+        self.collect_executor = concurrent.futures.ThreadPoolExecutor(max_workers = 1,
+                                                                      thread_name_prefix = 'collect')
+        tasks = [asyncio.create_task(self.pps_task(), name = 'pps'),
+                 asyncio.create_task(self.supervisor.monitor(), name = 'supervisor')]
+        if self.clock_monitor is not None:
+            tasks.append(asyncio.create_task(self.clock_task(), name = 'clock_monitor'))
+        for cur_service in self.services:
+            tasks.append(asyncio.create_task(cur_service(self)))
+
+        try:
+            await self.stop_requested.wait()
+        finally:
+            self.logger.info("Stopping.")
+            for cur_task in tasks:
+                cur_task.cancel()
+            results = await asyncio.gather(*tasks, return_exceptions = True)
+            for cur_task, cur_result in zip(tasks, results):
+                if isinstance(cur_result, Exception):
+                    self.logger.error("Task %s failed: %s.", cur_task.get_name(), cur_result)
+            # Wait for a running data collection.
+            self.collect_executor.shutdown(wait = True)
+            self.collect_executor = None
+            await self.loop.run_in_executor(None, self.flush_data)
+            await self.loop.run_in_executor(None, self.supervisor.stop)
+            self.shutdown_dsp_executor()
+            if self.psd_monitor is not None:
+                self.psd_monitor.flush()
+            for cur_signal in [signal.SIGINT, signal.SIGTERM]:
+                self.loop.remove_signal_handler(cur_signal)
+            self.logger.info("Stopped.")
+
+
+    def request_stop(self, signum = None):
+        ''' Request the stop of the recorder from within the event loop.
+        '''
+        if signum is not None:
+            self.logger.info("Stopping the recorder on signal %d.", signum)
+        self.stop_requested.set()
+
+
+    def stop(self):
+        ''' Stop the recorder from outside of the event loop.
+
+        The worker is stopped immediately, the tasks are cancelled by the
+        event loop.
+        '''
+        if self.loop is not None and self.stop_requested is not None:
+            self.loop.call_soon_threadsafe(self.stop_requested.set)
+        if self.supervisor is not None:
+            self.supervisor.stop_worker()
+
+
+    def change_data_rate(self, data_rate):
+        ''' Change the data rate of the running channels.
+
+        The method is called in the collect thread. The restart of the
+        worker is scheduled in the event loop.
+        '''
+        self.set_data_rate(data_rate)
+        if self.supervisor is not None:
+            asyncio.run_coroutine_threadsafe(self.restart_worker("data rate changed to %d sps" % data_rate),
+                                             self.loop)
+
+
+    async def restart_worker(self, reason):
+        ''' Restart the acquisition worker in an executor thread.
+        '''
+        try:
+            await self.loop.run_in_executor(None, self.supervisor.restart, reason)
+        except Exception:
+            self.logger.exception("Error when restarting the acquisition worker.")
+
+
+    async def pps_task(self):
+        ''' Collect the data after each full second.
+
+        The data is collected two block intervals after the full second,
+        when the samples of the last block of the previous second have been
+        received. The collection runs in the collect thread, the event
+        loop keeps receiving the sample blocks in the meantime.
+        '''
+        self.write_interval = int(self.write_interval)
+        self.write_counter = 0
+        collect_delay = 2 * self.block_interval
+
+        while True:
+            now = self.clock.now()
+            delay = (1e6 - now.microsecond) / 1e6 + collect_delay
+            if delay >= 1:
+                delay -= 1
+            await asyncio.sleep(delay)
+            try:
+                await self.loop.run_in_executor(self.collect_executor, self.collect_data)
+            except Exception as e:
+                self.logger.exception(e)
+
+
+    async def clock_task(self):
+        ''' Request the status of the system clock periodically.
+        '''
+        while True:
+            self.clock_monitor.update()
+            await asyncio.sleep(self.clock_monitor.interval)
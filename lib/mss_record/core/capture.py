@@ -0,0 +1,229 @@
+# -*- coding: utf-8 -*-
+# LICENSE
+#
+# This file is part of mss_record.
+#
+# If you use mss_record in any program or publication, please inform and
+# acknowledge its author Stefan Mertl (stefan@mertl-research.at).
+#
+# mss_record is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+''' Capture of the raw ADC samples.
+
+The raw (timestamp, count) samples of a channel are written to
+preallocated, memory-mapped files with fixed-width binary records. A file
+consists of a header of CAPTURE_HEADER_SIZE bytes followed by the records
+with the layout CAPTURE_DTYPE:
+
+- time: The timestamp of the sample [ns since 1970-01-01 UTC].
+- count: The ADC count.
+- flags: A combination of the CAPTURE_FLAG values.
+
+The header holds the number of valid records. It is updated every
+sync_records records and when the file is closed. Records behind the
+header count with a timestamp different from 0 are valid records of a file
+which hasn't been closed properly.
+'''
+
+import glob
+import logging
+import mmap
+import os
+import struct
+import time
+
+import numpy as np
+
+
+CAPTURE_MAGIC = b'MSSRAW01'
+CAPTURE_VERSION = 1
+# The file header: magic, version, record size, capacity, sampling rate,
+# number of valid records and the channel name.
+CAPTURE_HEADER_FORMAT = '<8sHHIdQ16s16x'
+CAPTURE_HEADER_SIZE = struct.calcsize(CAPTURE_HEADER_FORMAT)
+# The record layout.
+CAPTURE_RECORD_FORMAT = '<qhH'
+CAPTURE_RECORD_SIZE = struct.calcsize(CAPTURE_RECORD_FORMAT)
+CAPTURE_DTYPE = np.dtype([('time', '<i8'),
+                          ('count', '<i2'),
+                          ('flags', '<u2')])
+# The offset of the number of valid records in the header.
+CAPTURE_HEADER_NREC_OFFSET = struct.calcsize('<8sHHId')
+# The first sample after the start of the capture.
+CAPTURE_FLAG_START = 0x0001
+
+
+class RawCaptureWriter(object):
+    ''' Write the raw samples of a channel to memory-mapped files.
+
+    '''
+
+    def __init__(self, directory, name, sps, file_size = 16 * 1024**2, sync_records = 1024):
+        ''' Initialization of the instance.
+
+        :param directory: The directory where to store the capture files.
+        :param name: The name of the channel used for the filenames.
+        :param sps: The nominal sampling rate of the channel.
+        :param file_size: The size of a capture file [bytes]. A new file is
+            started when the file is full.
+        :param sync_records: The interval of the update of the number of
+            valid records in the header [records].
+        '''
+        # The logger.
+        logger_name = __name__ + "." + self.__class__.__name__
+        self.logger = logging.getLogger(logger_name)
+
+        self.directory = directory
+
+        self.name = name
+
+        self.sps = sps
+
+        # The number of records per file.
+        self.capacity = (file_size - CAPTURE_HEADER_SIZE) // CAPTURE_RECORD_SIZE
+
+        self.sync_records = sync_records
+
+        # The precompiled record struct.
+        self._pack_into = struct.Struct(CAPTURE_RECORD_FORMAT).pack_into
+        self._pack_nrec = struct.Struct('<Q').pack_into
+
+        # The currently open file.
+        self.filepath = None
+        self._fid = None
+        self._mmap = None
+        self._index = 0
+        self._offset = CAPTURE_HEADER_SIZE
+
+        # The flags added to the next record.
+        self._next_flags = CAPTURE_FLAG_START
+
+
+    def open(self):
+        ''' Prepare the capture.
+
+        The file is created when the first sample is written.
+        '''
+        if not os.path.exists(self.directory):
+            os.makedirs(self.directory)
+        self._next_flags = CAPTURE_FLAG_START
+
+
+    def _create_file(self, timestamp):
+        ''' Create and preallocate a new capture file.
+        '''
+        seconds, nanoseconds = divmod(timestamp, 1000000000)
+        cur_time = time.strftime('%Y%m%dT%H%M%S', time.gmtime(seconds))
+        filename = '%s_%s%09d.raw' % (self.name, cur_time, nanoseconds)
+        self.filepath = os.path.join(self.directory, filename)
+
+        size = CAPTURE_HEADER_SIZE + self.capacity * CAPTURE_RECORD_SIZE
+        self._fid = open(self.filepath, 'w+b')
+        try:
+            os.posix_fallocate(self._fid.fileno(), 0, size)
+        except (AttributeError, OSError):
+            self._fid.truncate(size)
+        self._mmap = mmap.mmap(self._fid.fileno(), size)
+        struct.pack_into(CAPTURE_HEADER_FORMAT, self._mmap, 0,
+                         CAPTURE_MAGIC, CAPTURE_VERSION, CAPTURE_RECORD_SIZE,
+                         self.capacity, self.sps, 0,
+                         self.name.encode('ascii')[:16])
+        self._index = 0
+        self._offset = CAPTURE_HEADER_SIZE
+        self.logger.debug("Created the capture file %s.", self.filepath)
+
+
+    def write(self, timestamp, count, flags = 0):
+        ''' Write a sample.
+
+        :param timestamp: The timestamp of the sample [ns].
+        :param count: The ADC count.
+        :param flags: The CAPTURE_FLAG values of the sample.
+        '''
+        if self._index >= self.capacity or self._mmap is None:
+            self.close()
+            self._create_file(timestamp)
+
+        self._pack_into(self._mmap, self._offset, timestamp, count, flags | self._next_flags)
+        self._next_flags = 0
+        self._offset += CAPTURE_RECORD_SIZE
+        self._index += 1
+        if self._index % self.sync_records == 0:
+            self._pack_nrec(self._mmap, CAPTURE_HEADER_NREC_OFFSET, self._index)
+
+
+    def close(self):
+        ''' Close the current capture file.
+        '''
+        if self._mmap is None:
+            return
+        self._pack_nrec(self._mmap, CAPTURE_HEADER_NREC_OFFSET, self._index)
+        self._mmap.flush()
+        self._mmap.close()
+        self._fid.close()
+        self._mmap = None
+        self._fid = None
+        self.logger.debug("Closed the capture file %s with %d records.", self.filepath, self._index)
+
+
+
+def read_capture_header(filepath):
+    ''' Read the header of a capture file.
+
+    :return: A dictionary with the header values.
+    '''
+    with open(filepath, 'rb') as fid:
+        header = fid.read(CAPTURE_HEADER_SIZE)
+    if len(header) < CAPTURE_HEADER_SIZE:
+        raise ValueError("The file %s is too short for a capture file." % filepath)
+    (magic, version, record_size,
+     capacity, sps, n_records, name) = struct.unpack(CAPTURE_HEADER_FORMAT, header)
+    if magic != CAPTURE_MAGIC:
+        raise ValueError("The file %s is not a capture file." % filepath)
+    if record_size != CAPTURE_RECORD_SIZE:
+        raise ValueError("Unsupported record size %d in file %s." % (record_size, filepath))
+    return {'version': version,
+            'capacity': capacity,
+            'sps': sps,
+            'n_records': n_records,
+            'name': name.rstrip(b'\x00').decode('ascii')}
+
+
+def read_capture(filepath):
+    ''' Memory-map the records of a capture file.
+
+    :return: A tuple of the header dictionary and the valid records as a
+        memory-mapped structured array with the dtype CAPTURE_DTYPE.
+    '''
+    header = read_capture_header(filepath)
+    records = np.memmap(filepath, dtype = CAPTURE_DTYPE, mode = 'r',
+                        offset = CAPTURE_HEADER_SIZE,
+                        shape = (header['capacity'],))
+
+    # Recover the records written after the last header update.
+    n_records = header['n_records']
+    unused = np.flatnonzero(records['time'][n_records:] == 0)
+    if len(unused):
+        n_records += unused[0]
+    else:
+        n_records = header['capacity']
+    header['n_records'] = n_records
+
+    return header, records[:n_records]
+
+
+def list_capture_files(directory, name = '*'):
+    ''' Get the capture files of a directory sorted by time.
+    '''
+    return sorted(glob.glob(os.path.join(directory, name + '_*.raw')))
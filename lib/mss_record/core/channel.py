@@ -22,13 +22,22 @@
 
 import logging
 import multiprocessing
+import queue
 import time
 
-import board
-import busio
 import numpy as np
 import obspy
-import RPi.GPIO as gpio
+
+try:
+    import board
+    import busio
+    import RPi.GPIO as gpio
+except ImportError:
+    # The hardware modules are not available on hosts used for offline
+    # processing (e.g. the replay of raw sample captures).
+    board = None
+    busio = None
+    gpio = None
 
 
 import mss_record.adc.ads111x as mss_ads111x
@@ -39,7 +48,8 @@ class Channel:
 
     '''
 
-    def __init__(self, name, adc_address, rdy_gpio, i2c_mutex, data_queue, sps = 128, gain = '1'):
+    def __init__(self, name, adc_address, rdy_gpio, i2c_mutex, data_queue, sps = 128, gain = '1',
+                 capture = None):
         ''' Initialization of the instance.
 
         '''
@@ -63,6 +73,9 @@ class Channel:
         # The gain of the channel.
         self.gain = gain
 
+        # The ADC configuration (ADS111xConfig).
+        self.adc_config = None
+
         # The ADC device.
         self.i2c_bus = busio.I2C(board.SCL, board.SDA)
         try:
@@ -85,12 +98,20 @@ class Channel:
 
         self.drdy = False
 
+        # The optional capture of the raw samples (RawCaptureWriter).
+        self.capture = capture
+
+        # The shared memory counter of the acquired samples. It is set by
+        # the supervisor of the acquisition worker.
+        self.sample_counter = None
+
 
     def check_adc(self):
         ''' Check, if the ADC is available.
         '''
         default_config = 0x8583
         ret_val = False
+        adc_config = None
         if self.adc is not None:
             try:
                 # Write the default configuration to the ADC.
@@ -103,7 +124,7 @@ class Channel:
             if adc_config == default_config:
                 self.logger.info("Got valid response from ADC at address %s.", hex(self.adc_address))
                 ret_val = True
-            else:
+            elif adc_config is not None:
                 self.logger.warning("Got an invalid response from ADC at address %s: %s", hex(self.adc_address), hex(adc_config))
         else:
             self.logger.warning("No ADC found at address %s.", hex(self.adc_address))
@@ -111,38 +132,37 @@ class Channel:
         return ret_val
 
 
-    def start_adc(self):
-        ''' Start the ADC in continuous mode.
-        '''
-        self.adc.configure(gain = self.gain,
-                           data_rate = self.sps,
-                           mode = 'continuous')
-        # Check if the configuration has been written successfully.
-        adc_config = self.adc.read_config()
-        self.logger.debug("adc_config %s.", hex(adc_config))
-
-        # Extract the data_rate information.
-        adc_dr = adc_config & 0xE0
-        self.logger.debug("adc_dr: %s.", hex(adc_dr))
-        if (adc_dr != mss_ads111x.ADS111x_CONFIG_DR[self.sps]):
-            self.logger.error("The samplingrate has not been set.")
-            return False
+    def get_adc_config(self):
+        ''' Get the ADC configuration of the channel.
 
-        # Extract the pga information.
-        adc_pga = adc_config & 0xE00
-        self.logger.debug("adc_pga: %s.", hex(adc_pga))
-        if (adc_pga != mss_ads111x.ADS111x_CONFIG_GAIN[self.gain]):
-            self.logger.error("The pga gain has not been set.")
-            return False
+        The configuration is created again only if the sampling rate or the
+        gain of the channel has changed.
+        '''
+        if (self.adc_config is None or self.adc_config.data_rate != self.sps
+                or self.adc_config.gain != self.gain):
+            self.adc_config = mss_ads111x.ADS111xConfig(gain = self.gain,
+                                                        data_rate = self.sps,
+                                                        mode = 'continuous',
+                                                        conversion_ready = True)
+        return self.adc_config
 
 
-        # Enable the conversion ready pin.
-        self.logger.debug("Enabling the conversion ready pin.")
-        success = self.adc.enable_conversion_ready_pin()
-        adc_config = self.adc.read_config()
-        self.logger.debug("adc_config %s.", hex(adc_config))
+    def start_adc(self):
+        ''' Start the ADC in continuous mode with the conversion ready pin
+        enabled.
+        '''
+        adc_config = self.get_adc_config()
+        success = self.adc.apply_config(adc_config)
+        self.logger.debug("adc registers %s.", {hex(x): hex(y) for x, y in self.adc.registers.items()})
         if not success:
-            self.logger.error("Couldn't enable the conversion ready pin.")
+            read_config = self.adc.registers.get(mss_ads111x.ADS111x_POINTER_CONFIG, 0)
+            if (read_config & 0xE0) != (adc_config.config_word & 0xE0):
+                self.logger.error("The samplingrate has not been set.")
+            elif (read_config & 0xE00) != (adc_config.config_word & 0xE00):
+                self.logger.error("The pga gain has not been set.")
+            else:
+                self.logger.error("Couldn't enable the conversion ready pin.")
+            return False
 
         return True
 
@@ -153,6 +173,8 @@ class Channel:
         # Configure the GPIO.
         gpio.setmode(gpio.BCM)
         gpio.setup(self.rdy_gpio, gpio.IN)
+        if self.capture is not None:
+            self.capture.open()
         gpio.add_event_detect(self.rdy_gpio, gpio.RISING, callback = self.drdy_callback)
         self.logger.info("Added the DRDY event handler for channel %s.", self.name)
 
@@ -162,6 +184,8 @@ class Channel:
         '''
         gpio.remove_event_detect(self.rdy_gpio)
         gpio.cleanup(self.rdy_gpio)
+        if self.capture is not None:
+            self.capture.close()
 
 
     def drdy_callback(self, channel):
@@ -178,29 +202,73 @@ class Channel:
 
         self.data_queue.put((cur_timestamp, cur_sample))
 
+        if self.capture is not None:
+            self.capture.write(cur_timestamp.ns, cur_sample)
+
+        if self.sample_counter is not None:
+            self.sample_counter.value += 1
+
         #end = time.time()
         #self.logger.info('drdy dt: %f', end - start)
         #self.logger.info("cur_timestamp: %s", cur_timestamp)
 
 
+    def drain_queue(self, timeout = 0.1, block = True):
+        ''' Move the samples of the data queue to the data buffer.
+
+        The data_mutex has to be acquired by the caller.
+
+        :param block: If False, only the samples available in the pipe of
+            the queue are read. Use it for the queue of a killed worker. The
+            samples are small enough to be written atomically to the pipe,
+            so a killed worker can't leave a partial sample.
+        :return: The number of moved samples.
+        '''
+        queue_len = self.data_queue.qsize()
+        cur_data = []
+        for k in range(queue_len):
+            try:
+                if block:
+                    cur_data.append(self.data_queue.get(timeout = timeout))
+                else:
+                    cur_data.append(self.data_queue.get_nowait())
+            except queue.Empty:
+                break
+        self.data.extend(cur_data)
+        return len(cur_data)
+
+
+    def add_samples(self, times, counts):
+        ''' Add a block of samples received from the acquisition worker.
+
+        :param times: The timestamps of the samples [ns].
+        :param counts: The ADC counts of the samples.
+        '''
+        samples = [(obspy.UTCDateTime(ns = x), y) for x, y in zip(times.tolist(), counts.tolist())]
+        with self.data_mutex:
+            self.data.extend(samples)
+
+
     def get_data(self, start_time, end_time):
         ''' Return the data and clear the data array.
         '''
         start = time.time()
-        queue_len = self.data_queue.qsize()
-        cur_data = [self.data_queue.get() for x in range(queue_len)]
+        with self.data_mutex:
+            n_queued = self.drain_queue()
+        ret_data = []
         end = time.time()
         dt_1 = end - start
         self.logger.debug('get_data dt_1: %f', dt_1)
 
-        if cur_data:
+        # The buffer may also hold samples moved from the queue by the
+        # supervisor of the acquisition worker.
+        if n_queued or len(self.data) > 1:
             # Include some samples prior to the requested start time. This
             # gives better results when using griddata in the recorder.
             start_time = start_time - 2 * 1/self.sps
             self.logger.debug("start: %s; end: %s", start_time, end_time)
             start = time.time()
             with self.data_mutex:
-                self.data.extend(cur_data)
                 ret_data = [x for x in self.data if x[0] >= start_time and x[0] < end_time]
                 # Keep the last sample for better nearest neighbour
                 # interpolation.
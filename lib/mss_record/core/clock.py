@@ -0,0 +1,332 @@
+# -*- coding: utf-8 -*-
+# LICENSE
+#
+# This file is part of mss_record.
+#
+# If you use mss_record in any program or publication, please inform and
+# acknowledge its author Stefan Mertl (stefan@mertl-research.at).
+#
+# mss_record is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+''' The clocks used by the recorder.
+
+The recorder gets the current time and waits using a clock instance. The
+SystemClock is used for the live recording. The VirtualClock is used to
+process recorded or simulated data faster than real time.
+
+The ClockMonitor watches the synchronization of the system clock using the
+kernel time status (adjtimex).
+'''
+
+import collections
+import ctypes
+import ctypes.util
+import logging
+import threading
+import time
+
+import obspy
+
+
+# The clock states returned by adjtimex.
+TIME_OK = 0
+TIME_ERROR = 5
+# The kernel time status bits.
+STA_UNSYNC = 0x0040
+STA_NANO = 0x2000
+
+
+class Timex(ctypes.Structure):
+    ''' The Linux struct timex used by adjtimex.
+    '''
+    _fields_ = [('modes', ctypes.c_uint),
+                ('offset', ctypes.c_long),
+                ('freq', ctypes.c_long),
+                ('maxerror', ctypes.c_long),
+                ('esterror', ctypes.c_long),
+                ('status', ctypes.c_int),
+                ('constant', ctypes.c_long),
+                ('precision', ctypes.c_long),
+                ('tolerance', ctypes.c_long),
+                ('time_sec', ctypes.c_long),
+                ('time_usec', ctypes.c_long),
+                ('tick', ctypes.c_long),
+                ('ppsfreq', ctypes.c_long),
+                ('jitter', ctypes.c_long),
+                ('shift', ctypes.c_int),
+                ('stabil', ctypes.c_long),
+                ('jitcnt', ctypes.c_long),
+                ('calcnt', ctypes.c_long),
+                ('errcnt', ctypes.c_long),
+                ('stbcnt', ctypes.c_long),
+                ('tai', ctypes.c_int),
+                ('padding', ctypes.c_int * 11)]
+
+
+# The status of the system clock.
+# time: The time of the status request.
+# synchronized: True, if the kernel reports a synchronized clock.
+# state: The clock state returned by adjtimex.
+# offset: The time offset [s].
+# max_error: The maximum error [s].
+# est_error: The estimated error [s].
+ClockStatus = collections.namedtuple('ClockStatus', ['time', 'synchronized', 'state',
+                                                     'offset', 'max_error', 'est_error'])
+
+
+_libc = None
+
+
+def kernel_time_status():
+    ''' Read the kernel time status using adjtimex without changing it.
+
+    :rtype: ClockStatus
+    '''
+    global _libc
+    if _libc is None:
+        _libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno = True)
+    timex = Timex()
+    timex.modes = 0
+    state = _libc.adjtimex(ctypes.byref(timex))
+    if state < 0:
+        raise OSError(ctypes.get_errno(), "adjtimex failed.")
+
+    if timex.status & STA_NANO:
+        offset = timex.offset / 1e9
+    else:
+        offset = timex.offset / 1e6
+    synchronized = (state != TIME_ERROR) and not (timex.status & STA_UNSYNC)
+    return ClockStatus(time = obspy.UTCDateTime(),
+                       synchronized = synchronized,
+                       state = state,
+                       offset = offset,
+                       max_error = timex.maxerror / 1e6,
+                       est_error = timex.esterror / 1e6)
+
+
+class SystemClock(object):
+    ''' The system clock.
+
+    '''
+
+    def now(self):
+        ''' The current time.
+
+        :rtype: obspy.UTCDateTime
+        '''
+        return obspy.UTCDateTime()
+
+
+    def sleep(self, seconds):
+        ''' Wait for the given number of seconds.
+        '''
+        time.sleep(seconds)
+
+
+
+class VirtualClock(object):
+    ''' A clock which advances only when sleeping.
+
+    '''
+
+    def __init__(self, start_time):
+        ''' Initialization of the instance.
+
+        :param start_time: The initial time of the clock.
+        :type start_time: obspy.UTCDateTime
+        '''
+        self.time = obspy.UTCDateTime(start_time)
+
+
+    def now(self):
+        ''' The current time.
+
+        :rtype: obspy.UTCDateTime
+        '''
+        return obspy.UTCDateTime(self.time)
+
+
+    def sleep(self, seconds):
+        ''' Advance the clock by the given number of seconds without waiting.
+        '''
+        self.time += seconds
+
+
+    def set(self, cur_time):
+        ''' Set the clock to the given time.
+        '''
+        self.time = obspy.UTCDateTime(cur_time)
+
+
+
+class ClockMonitor(object):
+    ''' Monitor the synchronization of the system clock.
+
+    The kernel time status is read periodically in a background thread.
+    The clock is considered locked if it is synchronized and the estimated
+    error is below the limit. The periods with an unlocked clock are kept
+    to set the quality flags of the miniseed records.
+    '''
+
+    def __init__(self, read_status = kernel_time_status, interval = 10.,
+                 max_est_error = 0.01, history_length = 86400.):
+        ''' Initialization of the instance.
+
+        :param read_status: The callable returning the ClockStatus.
+        :param interval: The interval of the status requests [s].
+        :param max_est_error: The maximum estimated error of a locked
+            clock [s].
+        :param history_length: The time to keep the unlocked periods [s].
+        '''
+        # The logger.
+        logger_name = __name__ + "." + self.__class__.__name__
+        self.logger = logging.getLogger(logger_name)
+
+        self.read_status = read_status
+
+        self.interval = interval
+
+        self.max_est_error = max_est_error
+
+        self.history_length = history_length
+
+        # The last clock status.
+        self.status = None
+
+        # The periods with an unlocked clock. A list of [start, end]. The end
+        # of a running period is None.
+        self.unlocked_periods = []
+
+        self.stop_event = threading.Event()
+
+        self.thread = None
+
+
+    @property
+    def locked(self):
+        ''' True, if the clock was locked at the last status request.
+        '''
+        return self.is_locked(self.status)
+
+
+    def is_locked(self, status):
+        ''' Check if the clock status is locked.
+        '''
+        if status is None:
+            return False
+        return status.synchronized and status.est_error <= self.max_est_error
+
+
+    def update(self):
+        ''' Request the clock status and update the unlocked periods.
+        '''
+        try:
+            status = self.read_status()
+        except Exception:
+            self.logger.exception("Error when reading the clock status.")
+            status = None
+
+        if status is None:
+            now = obspy.UTCDateTime()
+            locked = False
+        else:
+            now = status.time
+            locked = self.is_locked(status)
+        was_locked = self.status is not None and self.is_locked(self.status)
+        periods = list(self.unlocked_periods)
+        if not locked and (not periods or periods[-1][1] is not None):
+            if self.status is None:
+                periods.append([None, None])
+            else:
+                periods.append([self.status.time, None])
+            self.logger.warning("The system clock is not locked: %s.", status)
+        elif locked and periods and periods[-1][1] is None:
+            periods[-1] = [periods[-1][0], now]
+            self.logger.info("The system clock is locked again: %s.", status)
+        elif locked and not was_locked:
+            self.logger.info("The system clock is locked: %s.", status)
+
+        # Remove the old periods.
+        periods = [x for x in periods if x[1] is None or now - x[1] < self.history_length]
+
+        # Replace the attributes without modifying the instances used by
+        # other threads.
+        self.unlocked_periods = periods
+        self.status = status
+
+
+    def run(self):
+        ''' The loop of the monitor thread.
+        '''
+        while not self.stop_event.wait(self.interval):
+            self.update()
+
+
+    def start(self):
+        ''' Start the monitor thread.
+        '''
+        self.update()
+        self.stop_event.clear()
+        self.thread = threading.Thread(name = 'clock_monitor',
+                                       target = self.run,
+                                       daemon = True)
+        self.thread.start()
+
+
+    def stop(self):
+        ''' Stop the monitor thread.
+        '''
+        self.stop_event.set()
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
+
+
+    def quality_flags(self, start_time, end_time):
+        ''' Get the miniseed quality flags of a time span.
+
+        :return: The flags in the format of
+            obspy.io.mseed.util.set_flags_in_fixed_headers.
+        '''
+        unlocked = []
+        for cur_start, cur_end in self.unlocked_periods:
+            if cur_start is None:
+                cur_start = start_time
+            if cur_end is None:
+                cur_end = end_time
+            cur_start = max(cur_start, start_time)
+            cur_end = min(cur_end, end_time)
+            if cur_start <= cur_end:
+                unlocked.append((cur_start, cur_end))
+
+        if not unlocked:
+            return {'io_clock_flags': {'clock_locked': True},
+                    'data_qual_flags': {'time_tag_questionable': False}}
+
+        # The locked periods between the unlocked periods.
+        locked = []
+        cur_start = start_time
+        for cur_unlocked_start, cur_unlocked_end in unlocked:
+            if cur_unlocked_start > cur_start:
+                locked.append((cur_start, cur_unlocked_start))
+            cur_start = max(cur_start, cur_unlocked_end)
+        if cur_start < end_time:
+            locked.append((cur_start, end_time))
+
+        flags = {'data_qual_flags': {'time_tag_questionable': {'DURATION': unlocked}}}
+        if locked:
+            flags['io_clock_flags'] = {'clock_locked': {'DURATION': locked}}
+        else:
+            flags['io_clock_flags'] = {'clock_locked': False}
+        return flags
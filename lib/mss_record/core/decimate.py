@@ -0,0 +1,308 @@
+# -*- coding: utf-8 -*-
+# LICENSE
+#
+# This file is part of mss_record.
+#
+# If you use mss_record in any program or publication, please inform and
+# acknowledge its author Stefan Mertl (stefan@mertl-research.at).
+#
+# mss_record is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+''' Streaming multi-rate decimation.
+
+The lower rate output products are computed in one pass by a cascade of
+FIR decimation stages. The stages keep their filter state between the
+processed blocks. The linear phase filters have a delay of an integer
+number of output samples, which is compensated, so the output samples are
+aligned to the output sampling interval.
+
+The compensation doesn't remove the latency of the products. Each stage
+delays its output by 10 of its output sampling intervals, the delays of
+the cascaded stages add up. From 100 sps, the 20 sps product is delayed by
+0.5 s and the 1 sps product by 18 s (stages 100 -> 20 -> 4 -> 2 -> 1 sps).
+The samples still pending in the filters are emitted by flush when the
+processing ends.
+'''
+
+import numpy as np
+import obspy
+import scipy as sp
+import scipy.signal
+
+
+# The SEED band codes: minimum sampling rate, band code of short period
+# (corner period < 10 s) and broadband instruments.
+SEED_BAND_CODES = [(1000., 'G', 'F'),
+                   (250., 'D', 'C'),
+                   (80., 'E', 'H'),
+                   (10., 'S', 'B'),
+                   (1.000001, 'M', 'M'),
+                   (0.316, 'L', 'L'),
+                   (0.0316, 'V', 'V'),
+                   (0., 'U', 'U')]
+
+
+def band_code(sps, short_period = True):
+    ''' Get the SEED band code of a sampling rate.
+    '''
+    for min_sps, sp_code, bb_code in SEED_BAND_CODES:
+        if sps >= min_sps:
+            if short_period:
+                return sp_code
+            else:
+                return bb_code
+
+
+def product_channel_code(channel, sps):
+    ''' Get the channel code of a decimated product.
+
+    The first character of the channel code is replaced by the band code.
+    '''
+    return band_code(sps) + channel[1:]
+
+
+def prime_factors(n):
+    ''' Get the prime factors of n in descending order.
+    '''
+    factors = []
+    k = 2
+    while k * k <= n:
+        while n % k == 0:
+            factors.append(k)
+            n //= k
+        k += 1
+    if n > 1:
+        factors.append(n)
+    return sorted(factors, reverse = True)
+
+
+
+class DecimationStage(object):
+    ''' A streaming FIR decimation stage.
+
+    '''
+
+    def __init__(self, sps, factor, taps_per_factor = 20):
+        ''' Initialization of the instance.
+
+        :param sps: The input sampling rate.
+        :param factor: The integer decimation factor.
+        :param taps_per_factor: The filter length per decimation factor.
+        '''
+        self.sps = sps
+
+        self.factor = factor
+
+        # The lowpass filter with the cutoff at 80 % of the output nyquist
+        # frequency. The odd length results in a delay of an integer
+        # number of output samples.
+        n_taps = taps_per_factor * factor + 1
+        self.taps = sp.signal.firwin(n_taps, 0.8 / factor, window = ('kaiser', 8.))
+        self.reversed_taps = self.taps[::-1].copy()
+
+        # The delay of the filter [input samples].
+        self.delay = (n_taps - 1) // 2
+
+        self.reset()
+
+
+    def reset(self):
+        ''' Reset the filter state.
+        '''
+        # The number of processed input samples.
+        self.count = 0
+
+        # The last input samples needed for the next block.
+        self.history = None
+
+
+    def process(self, data):
+        ''' Decimate a block of data.
+
+        The delay of the filter is compensated. The output sample with the
+        index j has the time of the input sample with the index j * factor.
+
+        :param data: The input samples following the previously processed
+            samples.
+        :return: A tuple of the index of the first output sample and the
+            output samples.
+        '''
+        n_taps = len(self.taps)
+        if self.history is None:
+            # Pad the start of the data with the first sample.
+            self.history = np.full(n_taps - 1, data[0], dtype = np.float64)
+
+        buffered = np.concatenate([self.history, data])
+        self.history = buffered[len(data):]
+
+        # The output samples are computed at the input indices which are a
+        # multiple of the decimation factor. Drop the output samples prior
+        # to the start of the data.
+        first_ind = max(-self.count % self.factor, self.delay - self.count)
+        first_ind += -(self.count + first_ind) % self.factor
+        n_out = max(0, (len(data) - first_ind + self.factor - 1) // self.factor)
+        # A strided view of the filter windows of the output samples.
+        windows = np.ndarray(shape = (n_out, n_taps),
+                             dtype = buffered.dtype,
+                             buffer = buffered,
+                             offset = first_ind * buffered.itemsize,
+                             strides = (self.factor * buffered.itemsize, buffered.itemsize))
+        out_data = windows @ self.reversed_taps
+        out_index = (self.count + first_ind - self.delay) // self.factor
+        self.count += len(data)
+
+        return out_index, out_data
+
+
+    def flush(self):
+        ''' Emit the output samples pending in the filter.
+
+        The end of the data is padded with the last sample, like the start
+        of the data. The filter state is reset.
+
+        :return: A tuple of the index of the first output sample and the
+            output samples.
+        '''
+        if self.history is None:
+            return 0, np.array([], dtype = np.float64)
+        count = self.count
+        out_index, out_data = self.process(np.full(self.delay, self.history[-1]))
+        # Keep the output samples up to the last input sample.
+        n_out = max(0, (count - 1) // self.factor - out_index + 1)
+        self.reset()
+        return out_index, out_data[:n_out]
+
+
+
+class DecimationCascade(object):
+    ''' Compute multiple output rates using cascaded decimation stages.
+
+    '''
+
+    def __init__(self, sps, output_rates):
+        ''' Initialization of the instance.
+
+        :param sps: The input sampling rate.
+        :param output_rates: The output sampling rates. Each rate has to be
+            an integer fraction of the next higher rate.
+        '''
+        self.sps = sps
+
+        self.output_rates = sorted(output_rates, reverse = True)
+
+        # The stages and the output rate produced after each stage.
+        self.stages = []
+        self.stage_products = []
+        cur_sps = sps
+        for cur_rate in self.output_rates:
+            factor = cur_sps / cur_rate
+            if factor <= 1 or abs(factor - round(factor)) > 1e-9:
+                raise ValueError("The output rate %g is no integer fraction of %g." % (cur_rate, cur_sps))
+            for cur_factor in prime_factors(int(round(factor))):
+                self.stages.append(DecimationStage(sps = cur_sps, factor = cur_factor))
+                self.stage_products.append(None)
+                cur_sps = cur_sps / cur_factor
+            self.stage_products[-1] = cur_rate
+
+        self.reset()
+
+
+    @property
+    def delays(self):
+        ''' The delays of the output products caused by the filters.
+
+        :return: A dictionary with the output rate as key and the delay [s]
+            as value.
+        '''
+        delays = {}
+        cur_delay = 0.
+        for cur_stage, cur_product in zip(self.stages, self.stage_products):
+            cur_delay += cur_stage.delay / cur_stage.sps
+            if cur_product is not None:
+                delays[cur_product] = cur_delay
+        return delays
+
+
+    def reset(self):
+        ''' Reset the state of all stages.
+        '''
+        # The time of the first input sample.
+        self.start_time = None
+
+        # The number of processed input samples.
+        self.count = 0
+
+        for cur_stage in self.stages:
+            cur_stage.reset()
+
+
+    def process(self, data, start_time):
+        ''' Decimate a block of data to all output rates.
+
+        The filter state is reset if the block doesn't follow the previous
+        block without a gap.
+
+        :param data: The input samples.
+        :param start_time: The time of the first input sample.
+        :type start_time: obspy.UTCDateTime
+        :return: A dictionary with the output rate as key and a tuple of the
+            time of the first sample and the output samples as value.
+        '''
+        if self.start_time is not None:
+            expected_time = self.start_time + self.count / self.sps
+            if abs(start_time - expected_time) > 0.5 / self.sps:
+                self.reset()
+        if self.start_time is None:
+            self.start_time = obspy.UTCDateTime(start_time)
+        self.count += len(data)
+
+        products = {}
+        cur_data = np.asarray(data, dtype = np.float64)
+        for cur_stage, cur_product in zip(self.stages, self.stage_products):
+            if len(cur_data) == 0:
+                # Not enough samples for the next output sample.
+                break
+            first_index, cur_data = cur_stage.process(cur_data)
+            if cur_product is not None:
+                products[cur_product] = (self.start_time + first_index / cur_product,
+                                         cur_data)
+        return products
+
+
+    def flush(self):
+        ''' Emit the output samples pending in the filters of all stages.
+
+        The pending samples of a stage are processed by the following
+        stages before these are flushed. The state of all stages is reset.
+
+        :return: A dictionary with the output rate as key and a tuple of the
+            time of the first sample and the output samples as value.
+        '''
+        products = {}
+        if self.start_time is not None:
+            cur_data = np.array([], dtype = np.float64)
+            for cur_stage, cur_product in zip(self.stages, self.stage_products):
+                parts = []
+                if len(cur_data) > 0:
+                    parts.append(cur_stage.process(cur_data))
+                parts.append(cur_stage.flush())
+                parts = [x for x in parts if len(x[1]) > 0]
+                if not parts:
+                    break
+                cur_data = np.concatenate([x[1] for x in parts])
+                if cur_product is not None:
+                    products[cur_product] = (self.start_time + parts[0][0] / cur_product,
+                                             cur_data)
+        self.reset()
+        return products
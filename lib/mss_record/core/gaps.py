@@ -0,0 +1,197 @@
+# -*- coding: utf-8 -*-
+# LICENSE
+#
+# This file is part of mss_record.
+#
+# If you use mss_record in any program or publication, please inform and
+# acknowledge its author Stefan Mertl (stefan@mertl-research.at).
+#
+# mss_record is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+''' Gap and overlap detection of the buffered traces.
+
+The traces of a channel are placed on the sample index grid of the
+channel. Gaps and overlaps are found with vectorized differences of the
+start and end indices and the traces are joined to contiguous segments.
+Overlapping samples are taken from the earlier trace. Traces which are not
+aligned to the sample grid start a new segment, which is trimmed to start
+after the end of the previous segment. The samples before the end of the
+data already written to the miniseed files are removed.
+
+The number of samples lost in gaps and removed in overlaps are counted for
+each channel.
+'''
+
+import logging
+
+import numpy as np
+import obspy
+
+
+class GapEngine(object):
+    ''' Join the traces of the channels to contiguous segments.
+
+    '''
+
+    def __init__(self, tolerance = 0.1):
+        ''' Initialization of the instance.
+
+        :param tolerance: The maximum misalignment of a trace to the sample
+            grid of the segment [samples]. A trace with a larger
+            misalignment starts a new segment.
+        '''
+        # The logger.
+        logger_name = __name__ + "." + self.__class__.__name__
+        self.logger = logging.getLogger(logger_name)
+
+        self.tolerance = tolerance
+
+        # The number of samples lost in gaps of each trace id.
+        self.lost_samples = {}
+
+        # The number of overlapping samples removed of each trace id.
+        self.overlap_samples = {}
+
+        # The number of gaps of each trace id.
+        self.n_gaps = {}
+
+        # The time [ns] of the sample following the last written sample of
+        # each trace id.
+        self.written_end = {}
+
+        # The time [ns] up to which the gaps of each trace id have been
+        # counted.
+        self.counted_end = {}
+
+
+    @property
+    def total_lost_samples(self):
+        ''' The number of samples lost in gaps of all trace ids.
+        '''
+        return sum(self.lost_samples.values())
+
+
+    def set_written(self, trace_id, end_time):
+        ''' Set the end of the written data of a trace id.
+
+        :param end_time: The time of the sample following the last written
+            sample.
+        '''
+        end_ns = obspy.UTCDateTime(end_time).ns
+        self.written_end[trace_id] = max(self.written_end.get(trace_id, end_ns), end_ns)
+
+
+    def count_gap(self, trace_id, gap_start, gap_end, delta_ns):
+        ''' Count a gap if it has not been counted before.
+
+        :param gap_start: The time of the first missing sample [ns].
+        :param gap_end: The time of the first sample after the gap [ns].
+        '''
+        if gap_end <= self.counted_end.get(trace_id, gap_start):
+            return
+        n_lost = int(round((gap_end - gap_start) / delta_ns))
+        self.counted_end[trace_id] = gap_end
+        if n_lost <= 0:
+            return
+        self.lost_samples[trace_id] = self.lost_samples.get(trace_id, 0) + n_lost
+        self.n_gaps[trace_id] = self.n_gaps.get(trace_id, 0) + 1
+        self.logger.warning("Gap of %d samples in %s at %s (%d samples lost in total).",
+                            n_lost, trace_id, obspy.UTCDateTime(ns = int(gap_start)),
+                            self.lost_samples[trace_id])
+
+
+    def segments(self, trace_id, traces):
+        ''' Join the traces of a trace id to contiguous segments.
+
+        :param trace_id: The id of the traces.
+        :param traces: The traces with the same id and sampling rate.
+        :return: The list of the contiguous traces in temporal order.
+        '''
+        traces = [x for x in traces if x.stats.npts > 0]
+        if not traces:
+            return []
+
+        delta_ns = 1e9 / traces[0].stats.sampling_rate
+        starts_ns = np.array([x.stats.starttime.ns for x in traces], dtype = np.int64)
+        npts = np.array([x.stats.npts for x in traces], dtype = np.int64)
+
+        # The positions on the sample grid of the first trace.
+        ref_ns = starts_ns.min()
+        pos = (starts_ns - ref_ns) / delta_ns
+        order = np.argsort(pos, kind = 'stable')
+        pos = pos[order]
+        npts = npts[order]
+        traces = [traces[x] for x in order]
+        start_ind = np.round(pos).astype(np.int64)
+        misalignment = pos - start_ind
+
+        end_ind = start_ind + npts
+        prev_end = np.maximum.accumulate(end_ind)[:-1]
+        diff = start_ind[1:] - prev_end
+        aligned = np.abs(misalignment[1:] - misalignment[:-1]) <= self.tolerance
+        breaks = np.flatnonzero((diff > 0) | ~aligned) + 1
+
+        overlap = int(np.minimum(-diff[(diff < 0) & aligned], npts[1:][(diff < 0) & aligned]).sum())
+
+        # The samples before the end of the written data and before the end
+        # of the previous segment are removed. Segments which are not
+        # aligned to the previous segment may overlap it.
+        limit_ns = self.written_end.get(trace_id)
+        written_end = limit_ns
+
+        segments = []
+        seg_bounds = np.concatenate([[0], breaks, [len(traces)]])
+        for cur_first, cur_last in zip(seg_bounds[:-1], seg_bounds[1:]):
+            seg_start = start_ind[cur_first]
+            seg_end = end_ind[cur_first:cur_last].max()
+            first_trace = traces[cur_first]
+            data = np.empty(seg_end - seg_start,
+                            dtype = np.result_type(*[x.data.dtype for x in traces[cur_first:cur_last]]))
+            # Fill the later traces first. The samples of the earlier
+            # traces are kept in overlaps.
+            for k in range(cur_last - 1, cur_first - 1, -1):
+                data[start_ind[k] - seg_start:end_ind[k] - seg_start] = traces[k].data
+            seg_start_ns = ref_ns + (seg_start + misalignment[cur_first]) * delta_ns
+
+            if limit_ns is not None and seg_start_ns < limit_ns - self.tolerance * delta_ns:
+                n_drop = int(np.ceil((limit_ns - seg_start_ns) / delta_ns - self.tolerance))
+                n_drop = min(n_drop, len(data))
+                overlap += n_drop
+                data = data[n_drop:]
+                seg_start_ns += n_drop * delta_ns
+                if len(data) == 0:
+                    continue
+
+            header = first_trace.stats.copy()
+            header.npts = len(data)
+            cur_trace = obspy.core.Trace(data = data, header = header)
+            cur_trace.stats.starttime = obspy.UTCDateTime(ns = int(round(seg_start_ns)))
+            cur_trace.stats.pop('processing', None)
+            segments.append(cur_trace)
+            seg_end_ns = seg_start_ns + len(data) * delta_ns
+            limit_ns = seg_end_ns if limit_ns is None else max(limit_ns, seg_end_ns)
+
+        if overlap:
+            self.overlap_samples[trace_id] = self.overlap_samples.get(trace_id, 0) + overlap
+            self.logger.warning("Removed %d overlapping samples of %s.", overlap, trace_id)
+
+        # Count the gaps to the written data and between the segments.
+        prev_end_ns = written_end
+        for cur_trace in segments:
+            cur_start_ns = cur_trace.stats.starttime.ns
+            if prev_end_ns is not None and cur_start_ns - prev_end_ns > delta_ns / 2:
+                self.count_gap(trace_id, prev_end_ns, cur_start_ns, delta_ns)
+            prev_end_ns = cur_start_ns + int(round(cur_trace.stats.npts * delta_ns))
+
+        return segments
@@ -0,0 +1,478 @@
+# -*- coding: utf-8 -*-
+# LICENSE
+#
+# This file is part of mss_record.
+#
+# If you use mss_record in any program or publication, please inform and
+# acknowledge its author Stefan Mertl (stefan@mertl-research.at).
+#
+# mss_record is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+''' The ingest hub collecting the miniseed records of many recorders.
+
+The recorders push their miniseed records over persistent TCP connections
+(see mss_record.core.pusher). Each message is a frame with a fixed header
+(magic, frame type, sequence number, payload length) followed by the
+payload.
+
+A connection starts with a HELLO frame of the recorder containing the
+station id and the session id of the recorder process. The hub answers
+with an ACK frame holding the last sequence number received from this
+session. The recorder continues with the next record, so no record is sent
+twice after a reconnect. Records with a sequence number already received
+are dropped.
+
+The received records are collected in batches for each channel and
+appended to the files of a SDS archive every flush interval. After a
+flush, the hub sends an ACK frame with the last written sequence number to
+each station. The last written sequence numbers are kept in a state file.
+'''
+
+import argparse
+import asyncio
+import concurrent.futures
+import json
+import logging
+import os
+import signal
+import struct
+import time
+
+
+# The frame header: magic, frame type, sequence number, payload length.
+FRAME_HEADER = struct.Struct('!2sBxQI')
+FRAME_MAGIC = b'MR'
+
+# The frame types.
+FRAME_HELLO = 1
+FRAME_RECORD = 2
+FRAME_ACK = 3
+
+# The maximum payload length of a frame [bytes].
+MAX_PAYLOAD = 65536
+
+
+def pack_frame(frame_type, seq, payload = b''):
+    ''' Create a frame.
+
+    :return: The bytes of the frame.
+    '''
+    return FRAME_HEADER.pack(FRAME_MAGIC, frame_type, seq, len(payload)) + payload
+
+
+async def read_frame(reader):
+    ''' Read a frame from a stream.
+
+    :return: A tuple of the frame type, the sequence number and the
+        payload.
+    '''
+    header = await reader.readexactly(FRAME_HEADER.size)
+    magic, frame_type, seq, length = FRAME_HEADER.unpack(header)
+    if magic != FRAME_MAGIC:
+        raise ValueError("Invalid frame magic %r." % magic)
+    if length > MAX_PAYLOAD:
+        raise ValueError("The frame payload of %d bytes is too large." % length)
+    payload = await reader.readexactly(length)
+    return frame_type, seq, payload
+
+
+def record_info(record):
+    ''' Get the channel id and the start time of a miniseed record.
+
+    Only the fixed header is parsed.
+
+    :return: A tuple of the SEED id (network, station, location, channel)
+        and the year and day of year of the record start.
+    '''
+    station = record[8:13].decode('ascii').strip()
+    location = record[13:15].decode('ascii').strip()
+    channel = record[15:18].decode('ascii').strip()
+    network = record[18:20].decode('ascii').strip()
+    year, doy = struct.unpack('>HH', record[20:24])
+    if not 1900 <= year <= 2500:
+        # A little endian record.
+        year, doy = struct.unpack('<HH', record[20:24])
+    return (network, station, location, channel), (year, doy)
+
+
+def sds_path(seed_id, year, doy):
+    ''' The relative path of a day file in a SDS archive.
+    '''
+    network, station, location, channel = seed_id
+    filename = '%s.%s.%s.%s.D.%04d.%03d' % (network, station, location,
+                                            channel, year, doy)
+    return os.path.join('%04d' % year, network, station, channel + '.D', filename)
+
+
+
+class StationState(object):
+    ''' The ingest state of a station.
+
+    '''
+
+    def __init__(self, station_id, session = None, received_seq = 0, written_seq = 0):
+        ''' Initialization of the instance.
+
+        :param station_id: The id of the station (NET.STA.LOC).
+        :param session: The session id of the recorder process.
+        :param received_seq: The last received sequence number.
+        :param written_seq: The last sequence number written to the archive.
+        '''
+        self.station_id = station_id
+
+        self.session = session
+
+        self.received_seq = received_seq
+
+        self.written_seq = written_seq
+
+        # The writer of the current connection.
+        self.writer = None
+
+        # The number of received, duplicate and missing records.
+        self.n_records = 0
+        self.n_duplicates = 0
+        self.n_missing = 0
+
+
+
+class IngestHub(object):
+    ''' The TCP server ingesting the miniseed records of many recorders.
+
+    '''
+
+    def __init__(self, archive_dir, host = '0.0.0.0', port = 16000,
+                 flush_interval = 1., max_batch_size = 4 * 1024**2,
+                 state_file = None):
+        ''' Initialization of the instance.
+
+        :param archive_dir: The root directory of the SDS archive.
+        :param host: The address to listen on.
+        :param port: The port to listen on.
+        :param flush_interval: The interval to write the batches [s].
+        :param max_batch_size: The size of the pending records which
+            triggers a write before the flush interval [bytes].
+        :param state_file: The file keeping the sequence numbers. Defaults
+            to hub_state.json in the archive directory.
+        '''
+        # The logger.
+        logger_name = __name__ + "." + self.__class__.__name__
+        self.logger = logging.getLogger(logger_name)
+
+        self.archive_dir = archive_dir
+
+        self.host = host
+
+        self.port = port
+
+        self.flush_interval = flush_interval
+
+        self.max_batch_size = max_batch_size
+
+        if state_file is None:
+            state_file = os.path.join(archive_dir, 'hub_state.json')
+        self.state_file = state_file
+
+        # The ingest states of the stations.
+        self.stations = {}
+
+        # The pending records for each archive file.
+        self.batches = {}
+
+        # The size of the pending records [bytes].
+        self.batch_size = 0
+
+        # The last sequence numbers of the pending records of each station.
+        self.batch_seq = {}
+
+        # The number of written records and bytes.
+        self.n_written = 0
+        self.n_written_bytes = 0
+
+        # A single thread writing the archive files.
+        self.write_executor = concurrent.futures.ThreadPoolExecutor(max_workers = 1,
+                                                                    thread_name_prefix = 'hub_write')
+
+        self.server = None
+        self.flush_event = None
+        self.flush_lock = None
+
+
+    def load_state(self):
+        ''' Load the sequence numbers of the stations from the state file.
+        '''
+        if not os.path.exists(self.state_file):
+            return
+        with open(self.state_file, 'r') as state_file:
+            state = json.load(state_file)
+        for cur_id, cur_state in state.items():
+            self.stations[cur_id] = StationState(station_id = cur_id,
+                                                 session = cur_state['session'],
+                                                 received_seq = cur_state['seq'],
+                                                 written_seq = cur_state['seq'])
+
+
+    def save_state(self):
+        ''' Write the sequence numbers of the stations to the state file.
+        '''
+        state = {x.station_id: {'session': x.session, 'seq': x.written_seq} for x in self.stations.values()}
+        tmp_file = self.state_file + '.tmp'
+        with open(tmp_file, 'w') as state_file:
+            json.dump(state, state_file)
+        os.replace(tmp_file, self.state_file)
+
+
+    async def start(self):
+        ''' Start the server.
+        '''
+        if not os.path.exists(self.archive_dir):
+            os.makedirs(self.archive_dir)
+        self.load_state()
+        self.flush_event = asyncio.Event()
+        self.flush_lock = asyncio.Lock()
+        self.server = await asyncio.start_server(self.handle_connection,
+                                                 host = self.host,
+                                                 port = self.port)
+        if self.port == 0:
+            self.port = self.server.sockets[0].getsockname()[1]
+        self.logger.info("Listening on %s:%d.", self.host, self.port)
+
+
+    async def stop(self):
+        ''' Stop the server and write the pending records.
+        '''
+        if self.server is not None:
+            self.server.close()
+            for cur_station in self.stations.values():
+                if cur_station.writer is not None:
+                    cur_station.writer.close()
+            await self.server.wait_closed()
+            self.server = None
+        await self.flush()
+        self.write_executor.shutdown(wait = True)
+
+
+    async def serve(self):
+        ''' Run the server and write the batches until cancelled.
+        '''
+        await self.start()
+        try:
+            while True:
+                try:
+                    await asyncio.wait_for(self.flush_event.wait(),
+                                           timeout = self.flush_interval)
+                except asyncio.TimeoutError:
+                    pass
+                self.flush_event.clear()
+                await self.flush()
+        finally:
+            await self.stop()
+
+
+    async def handle_connection(self, reader, writer):
+        ''' Handle the connection of a recorder.
+        '''
+        peer = writer.get_extra_info('peername')
+        station = None
+        try:
+            frame_type, seq, payload = await read_frame(reader)
+            if frame_type != FRAME_HELLO:
+                raise ValueError("Expected a HELLO frame.")
+            station = self.register(payload, writer)
+            self.logger.info("Station %s connected from %s, session %s, last written sequence number %d.",
+                             station.station_id, peer, station.session, station.written_seq)
+            # Only the written records are acknowledged. The records
+            # received but not yet written are pending in the batches and
+            # their retransmissions are dropped as duplicates.
+            writer.write(pack_frame(FRAME_ACK, station.written_seq))
+            await writer.drain()
+
+            while True:
+                frame_type, seq, payload = await read_frame(reader)
+                if frame_type != FRAME_RECORD:
+                    raise ValueError("Unexpected frame type %d." % frame_type)
+                self.add_record(station, seq, payload)
+        except asyncio.IncompleteReadError:
+            pass
+        except (ConnectionError, ValueError) as e:
+            self.logger.error("Error on the connection of %s: %s.", peer, e)
+        finally:
+            if station is not None:
+                if station.writer is writer:
+                    station.writer = None
+                self.logger.info("Station %s disconnected.", station.station_id)
+            writer.close()
+
+
+    def register(self, payload, writer):
+        ''' Register the connection of a station.
+
+        :param payload: The HELLO payload with the station id and session.
+        :return: The state of the station.
+        '''
+        hello = json.loads(payload.decode('utf-8'))
+        station_id = hello['station']
+        session = hello['session']
+        station = self.stations.get(station_id)
+        if station is None:
+            station = StationState(station_id = station_id, session = session)
+            self.stations[station_id] = station
+        elif station.session != session:
+            # A new recorder process starts the numbering again.
+            self.logger.info("New session of station %s.", station_id)
+            station.session = session
+            station.received_seq = 0
+            station.written_seq = 0
+            self.batch_seq.pop(station_id, None)
+
+        if station.writer is not None:
+            # Only the latest connection of a station is used.
+            station.writer.close()
+        station.writer = writer
+        return station
+
+
+    def add_record(self, station, seq, record):
+        ''' Add a received record to the batches.
+        '''
+        if seq <= station.received_seq:
+            station.n_duplicates += 1
+            return
+        if seq > station.received_seq + 1:
+            station.n_missing += seq - station.received_seq - 1
+            self.logger.warning("Missing %d records of station %s.",
+                                seq - station.received_seq - 1,
+                                station.station_id)
+        station.received_seq = seq
+        station.n_records += 1
+
+        try:
+            seed_id, (year, doy) = record_info(record)
+        except (UnicodeDecodeError, struct.error):
+            self.logger.error("Invalid record %d of station %s.", seq, station.station_id)
+            return
+        self.batches.setdefault(sds_path(seed_id, year, doy), []).append(record)
+        self.batch_size += len(record)
+        self.batch_seq[station.station_id] = seq
+        if self.batch_size >= self.max_batch_size:
+            self.flush_event.set()
+
+
+    async def flush(self):
+        ''' Write the pending records and acknowledge them.
+        '''
+        async with self.flush_lock:
+            if not self.batches:
+                return
+            batches = self.batches
+            batch_seq = self.batch_seq
+            self.batches = {}
+            self.batch_seq = {}
+            self.batch_size = 0
+
+            loop = asyncio.get_running_loop()
+            try:
+                await loop.run_in_executor(self.write_executor, self.write_batches, batches)
+            except Exception:
+                self.logger.exception("Error when writing the archive files.")
+                # Keep the records not written for the next flush. They
+                # are not sent again by the stations.
+                for cur_path, cur_records in batches.items():
+                    self.batches[cur_path] = cur_records + self.batches.get(cur_path, [])
+                    self.batch_size += sum([len(x) for x in cur_records])
+                for cur_id, cur_seq in batch_seq.items():
+                    self.batch_seq[cur_id] = max(cur_seq, self.batch_seq.get(cur_id, 0))
+                return
+
+            for cur_id, cur_seq in batch_seq.items():
+                cur_station = self.stations[cur_id]
+                cur_station.written_seq = max(cur_station.written_seq, cur_seq)
+            await loop.run_in_executor(self.write_executor, self.save_state)
+
+            for cur_id in batch_seq:
+                cur_station = self.stations[cur_id]
+                if cur_station.writer is not None and not cur_station.writer.is_closing():
+                    cur_station.writer.write(pack_frame(FRAME_ACK, cur_station.written_seq))
+
+
+    def write_batches(self, batches):
+        ''' Append the batched records to the archive files.
+
+        :param batches: A dictionary of the records of each archive file.
+            The written files are removed from the dictionary.
+        '''
+        start = time.monotonic()
+        n_bytes = 0
+        n_records = 0
+        n_files = 0
+        for cur_path, cur_records in list(batches.items()):
+            cur_filepath = os.path.join(self.archive_dir, cur_path)
+            cur_dir = os.path.dirname(cur_filepath)
+            if not os.path.exists(cur_dir):
+                os.makedirs(cur_dir)
+            data = b''.join(cur_records)
+            with open(cur_filepath, 'ab') as archive_file:
+                archive_file.write(data)
+            del batches[cur_path]
+            n_files += 1
+            n_bytes += len(data)
+            n_records += len(cur_records)
+            self.n_written += len(cur_records)
+            self.n_written_bytes += len(data)
+        self.logger.debug("Wrote %d records to %d files in %.3f s.",
+                          n_records, n_files, time.monotonic() - start)
+
+
+
+async def run_hub(hub):
+    ''' Run the hub until SIGINT or SIGTERM.
+    '''
+    loop = asyncio.get_running_loop()
+    task = asyncio.current_task()
+    for cur_signal in [signal.SIGINT, signal.SIGTERM]:
+        loop.add_signal_handler(cur_signal, task.cancel)
+    try:
+        await hub.serve()
+    except asyncio.CancelledError:
+        pass
+
+
+def main(argv = None):
+    ''' The hub entry point.
+    '''
+    parser = argparse.ArgumentParser(prog = 'mss_record_hub',
+                                     description = 'Ingest the miniseed records pushed by mss_record recorders.')
+    parser.add_argument('archive_dir', type = str,
+                        help = 'The root directory of the SDS archive.')
+    parser.add_argument('--host', type = str, default = '0.0.0.0',
+                        help = 'The address to listen on.')
+    parser.add_argument('--port', type = int, default = 16000,
+                        help = 'The port to listen on.')
+    parser.add_argument('--flush-interval', type = float, default = 1.,
+                        help = 'The interval to write the batched records [s].')
+    parser.add_argument('--max-batch-size', type = int, default = 4,
+                        help = 'The size of the batched records triggering a write [MB].')
+    parser.add_argument('--log-level', type = str, default = 'INFO')
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(level = args.log_level,
+                        format = "#LOG# - %(asctime)s - %(levelname)s - %(name)s: %(message)s")
+
+    hub = IngestHub(archive_dir = args.archive_dir,
+                    host = args.host,
+                    port = args.port,
+                    flush_interval = args.flush_interval,
+                    max_batch_size = args.max_batch_size * 1024**2)
+    asyncio.run(run_hub(hub))
+    return 0
@@ -0,0 +1,492 @@
+# -*- coding: utf-8 -*-
+# LICENSE
+#
+# This file is part of mss_record.
+#
+# If you use mss_record in any program or publication, please inform and
+# acknowledge its author Stefan Mertl (stefan@mertl-research.at).
+#
+# mss_record is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+''' Streaming noise power spectral density of the channels.
+
+The resampled data of each second is fed to a Welch PSD estimator. The
+data is split into overlapping windows, which are detrended, tapered and
+transformed. The power of n_average consecutive windows is averaged and
+reduced to fractional octave frequency bands. The PSD values in dB of the
+bands are counted in a histogram with a fixed number of dB bins, so the
+memory needed does not depend on the recorded duration.
+
+Each hour, the percentiles and the mean of the PSD values of each band are
+computed from the histogram and appended to a binary summary file. The
+unit of the PSD is counts^2/Hz.
+
+Summary file record (network byte order):
+
+- header: SUMMARY_HEADER
+- band center frequencies: n_bands float32 [Hz]
+- percentiles: n_percentiles uint8 [%]
+- mean: n_bands int16 [0.1 dB]
+- percentile values: n_percentiles x n_bands int16 [0.1 dB]
+
+Bands without data have the value NO_DATA.
+'''
+
+import argparse
+import logging
+import os
+import struct
+import threading
+
+import numpy as np
+import obspy
+import scipy.fft
+
+
+# The header of a summary record: magic, version, trace id, start time of
+# the hour [ns], number of averaged segments, number of bands, number of
+# percentiles.
+SUMMARY_HEADER = struct.Struct('!2sBx16sqIHH')
+SUMMARY_MAGIC = b'MP'
+SUMMARY_VERSION = 1
+
+# The value of bands without data.
+NO_DATA = -32768
+
+# The duration of a summary [ns].
+SUMMARY_INTERVAL = 3600 * 10**9
+
+
+def pack_summary(trace_id, summary):
+    ''' Pack an hourly summary to a summary file record.
+
+    :param trace_id: The SEED id of the channel.
+    :param summary: The summary returned by WelchPSD.
+    :return: The bytes of the record.
+    '''
+    n_bands = len(summary['frequencies'])
+    n_percentiles = len(summary['percentiles'])
+    header = SUMMARY_HEADER.pack(SUMMARY_MAGIC,
+                                 SUMMARY_VERSION,
+                                 trace_id.encode('ascii'),
+                                 summary['start_time'],
+                                 summary['n_segments'],
+                                 n_bands,
+                                 n_percentiles)
+    values = np.vstack([summary['mean'], summary['values']])
+    values = np.where(np.isfinite(values), np.round(values * 10), NO_DATA)
+    values = np.clip(values, NO_DATA, 32767)
+    return b''.join([header,
+                     np.asarray(summary['frequencies'], dtype = '>f4').tobytes(),
+                     np.asarray(summary['percentiles'], dtype = np.uint8).tobytes(),
+                     values.astype('>i2').tobytes()])
+
+
+def read_summaries(filename):
+    ''' Read the records of a summary file.
+
+    :return: A list of dictionaries with the keys trace_id, start_time,
+        n_segments, frequencies, percentiles, mean and values. The PSD
+        values are in dB, bands without data are NaN.
+    '''
+    with open(filename, 'rb') as fid:
+        raw = fid.read()
+
+    summaries = []
+    offset = 0
+    while offset + SUMMARY_HEADER.size <= len(raw):
+        (magic, version, trace_id, start_time,
+         n_segments, n_bands, n_percentiles) = SUMMARY_HEADER.unpack_from(raw, offset)
+        if magic != SUMMARY_MAGIC or version != SUMMARY_VERSION:
+            raise ValueError("Invalid summary record at offset %d of %s." % (offset, filename))
+        offset += SUMMARY_HEADER.size
+        frequencies = np.frombuffer(raw, dtype = '>f4', count = n_bands, offset = offset)
+        offset += 4 * n_bands
+        percentiles = np.frombuffer(raw, dtype = np.uint8, count = n_percentiles, offset = offset)
+        offset += n_percentiles
+        values = np.frombuffer(raw, dtype = '>i2', count = (n_percentiles + 1) * n_bands, offset = offset)
+        offset += 2 * (n_percentiles + 1) * n_bands
+        values = values.reshape(n_percentiles + 1, n_bands).astype(float)
+        values[values == NO_DATA] = np.nan
+        values /= 10
+        summaries.append({'trace_id': trace_id.rstrip(b'\x00').decode('ascii'),
+                          'start_time': obspy.UTCDateTime(ns = int(start_time)),
+                          'n_segments': n_segments,
+                          'frequencies': frequencies.astype(float),
+                          'percentiles': percentiles.astype(int),
+                          'mean': values[0],
+                          'values': values[1:]})
+    return summaries
+
+
+
+class WelchPSD(object):
+    ''' The streaming Welch PSD estimator of one channel.
+
+    '''
+
+    def __init__(self, sps = 100., nfft = 4096, overlap = 0.5, n_average = 4,
+                 bands_per_octave = 4, db_min = -50., db_max = 150., db_step = 1.,
+                 percentiles = (5, 10, 50, 90, 95)):
+        ''' Initialization of the instance.
+
+        :param sps: The sampling rate of the data [sps].
+        :param nfft: The number of samples of a window.
+        :param overlap: The overlap of consecutive windows (0 to 1).
+        :param n_average: The number of windows averaged to one PSD
+            segment counted in the histogram.
+        :param bands_per_octave: The number of frequency bands per octave.
+        :param db_min: The lower limit of the histogram [dB].
+        :param db_max: The upper limit of the histogram [dB].
+        :param db_step: The width of the histogram bins [dB].
+        :param percentiles: The percentiles of the summaries [%].
+        '''
+        self.sps = sps
+
+        self.nfft = nfft
+
+        # The number of samples between the starts of two windows.
+        self.step = max(1, int(round(nfft * (1 - overlap))))
+
+        self.n_average = n_average
+
+        self.db_min = db_min
+
+        self.db_step = db_step
+
+        self.percentiles = list(percentiles)
+
+        # The sampling interval [ns].
+        self.delta_ns = 1e9 / sps
+
+        # The Hann taper and the scaling of the one-sided PSD.
+        self.taper = 0.5 - 0.5 * np.cos(2 * np.pi * np.arange(nfft) / nfft)
+        self.scale = 2. / (sps * np.sum(self.taper**2))
+
+        # The centered and normalized time used for the linear detrend.
+        self.detrend_time = np.arange(nfft) - (nfft - 1) / 2.
+        self.detrend_time /= np.sqrt(np.sum(self.detrend_time**2))
+
+        # The frequency bands. The lowest band starts at the fourth
+        # frequency bin, bands containing no frequency bin are removed.
+        freqs = np.fft.rfftfreq(nfft, d = 1. / sps)
+        fmin = 4 * sps / nfft
+        n_bands = int(np.floor(np.log2((sps / 2) / fmin) * bands_per_octave))
+        edges = fmin * 2**(np.arange(n_bands + 1) / bands_per_octave)
+        band_ind = np.searchsorted(edges, freqs, side = 'right') - 1
+        valid = (band_ind >= 0) & (band_ind < n_bands)
+        used_bands, band_start, band_size = np.unique(band_ind[valid],
+                                                      return_index = True,
+                                                      return_counts = True)
+        # The first and last frequency bin of the banded spectrum.
+        self.first_bin = np.flatnonzero(valid)[0]
+        self.last_bin = np.flatnonzero(valid)[-1] + 1
+        self.band_start = band_start
+        self.band_size = band_size
+        self.frequencies = np.sqrt(edges[used_bands] * edges[used_bands + 1])
+
+        # The preallocated work buffers.
+        self.buffer = np.zeros(nfft)
+        self.work = np.zeros(nfft)
+        self.band_power = np.zeros(len(self.frequencies))
+
+        # The histogram of the PSD values of the bands of the current hour.
+        n_db_bins = int(np.ceil((db_max - db_min) / db_step))
+        self.histogram = np.zeros((len(self.frequencies), n_db_bins), dtype = np.uint32)
+
+        # The sum of the PSD values of the bands of the current hour [dB].
+        self.db_sum = np.zeros(len(self.frequencies))
+
+        # The number of segments counted in the current hour.
+        self.n_segments = 0
+
+        # The start of the current hour [ns].
+        self.hour_start = None
+
+        # The number of samples in the buffer.
+        self.n_buffered = 0
+
+        # The number of windows averaged in the current segment.
+        self.n_windows = 0
+
+        # The start time of the first buffered sample and of the current
+        # segment [ns].
+        self.buffer_start = None
+        self.segment_start = None
+
+        # The time of the next expected sample [ns].
+        self.next_time = None
+
+
+    @property
+    def memory_size(self):
+        ''' The memory used by the buffers and the histogram [bytes].
+        '''
+        arrays = [self.taper, self.detrend_time, self.buffer, self.work,
+                  self.band_power, self.histogram, self.db_sum]
+        return sum([x.nbytes for x in arrays])
+
+
+    def reset(self):
+        ''' Discard the buffered samples and the current segment.
+        '''
+        self.n_buffered = 0
+        self.n_windows = 0
+        self.band_power[:] = 0
+        self.buffer_start = None
+        self.segment_start = None
+
+
+    def feed(self, start_time, data):
+        ''' Add the data of a contiguous block of samples.
+
+        A gap to the previously fed data discards the incomplete window and
+        segment.
+
+        :param start_time: The time of the first sample.
+        :param data: The samples.
+        :return: The list of the summaries of the completed hours.
+        '''
+        start_ns = obspy.UTCDateTime(start_time).ns
+        if self.next_time is not None and abs(start_ns - self.next_time) > self.delta_ns / 2:
+            self.reset()
+        self.next_time = start_ns + int(round(len(data) * self.delta_ns))
+
+        summaries = []
+        data = np.asarray(data, dtype = float)
+        pos = 0
+        while pos < len(data):
+            if self.n_buffered == 0:
+                self.buffer_start = start_ns + int(round(pos * self.delta_ns))
+            n_copy = min(len(data) - pos, self.nfft - self.n_buffered)
+            self.buffer[self.n_buffered:self.n_buffered + n_copy] = data[pos:pos + n_copy]
+            self.n_buffered += n_copy
+            pos += n_copy
+            if self.n_buffered == self.nfft:
+                summaries.extend(self.process_window())
+                # Keep the overlapping samples.
+                n_keep = self.nfft - self.step
+                self.buffer[:n_keep] = self.buffer[self.step:]
+                self.n_buffered = n_keep
+                self.buffer_start += int(round(self.step * self.delta_ns))
+        return summaries
+
+
+    def process_window(self):
+        ''' Compute the band power of the buffered window.
+
+        :return: The list of the summaries of the completed hours.
+        '''
+        if self.n_windows == 0:
+            self.segment_start = self.buffer_start
+
+        # Remove the linear trend and apply the taper.
+        np.subtract(self.buffer, self.buffer.mean(), out = self.work)
+        self.work -= np.dot(self.work, self.detrend_time) * self.detrend_time
+        self.work *= self.taper
+
+        spec = scipy.fft.rfft(self.work, overwrite_x = True)
+        power = spec.real[self.first_bin:self.last_bin]**2 + spec.imag[self.first_bin:self.last_bin]**2
+        self.band_power += np.add.reduceat(power, self.band_start) / self.band_size
+        self.n_windows += 1
+
+        if self.n_windows < self.n_average:
+            return []
+        return self.add_segment()
+
+
+    def add_segment(self):
+        ''' Count the averaged PSD of the segment in the histogram.
+
+        :return: The list of the summaries of the completed hours.
+        '''
+        summaries = []
+        hour_start = (self.segment_start // SUMMARY_INTERVAL) * SUMMARY_INTERVAL
+        if self.hour_start is not None and hour_start != self.hour_start and self.n_segments:
+            summaries.append(self.summary())
+            self.clear_histogram()
+        self.hour_start = hour_start
+
+        psd = self.band_power * self.scale / self.n_windows
+        with np.errstate(divide = 'ignore'):
+            psd_db = 10 * np.log10(psd)
+        psd_db = np.maximum(psd_db, self.db_min)
+        bins = ((psd_db - self.db_min) / self.db_step).astype(int)
+        bins = np.clip(bins, 0, self.histogram.shape[1] - 1)
+        self.histogram[np.arange(len(bins)), bins] += 1
+        self.db_sum += psd_db
+        self.n_segments += 1
+
+        self.n_windows = 0
+        self.band_power[:] = 0
+        return summaries
+
+
+    def clear_histogram(self):
+        ''' Start a new hour.
+        '''
+        self.histogram[:] = 0
+        self.db_sum[:] = 0
+        self.n_segments = 0
+
+
+    def summary(self):
+        ''' Compute the summary of the current hour from the histogram.
+
+        :return: A dictionary with the keys start_time [ns], n_segments,
+            frequencies, percentiles, mean and values [dB]. The values have
+            one row per percentile.
+        '''
+        cdf = np.cumsum(self.histogram, axis = 1) / max(self.n_segments, 1)
+        values = np.zeros((len(self.percentiles), len(self.frequencies)))
+        for k, cur_percentile in enumerate(self.percentiles):
+            cur_bin = np.sum(cdf < cur_percentile / 100., axis = 1)
+            values[k] = self.db_min + (cur_bin + 0.5) * self.db_step
+        if self.n_segments == 0:
+            values[:] = np.nan
+        return {'start_time': int(self.hour_start),
+                'n_segments': self.n_segments,
+                'frequencies': self.frequencies,
+                'percentiles': self.percentiles,
+                'mean': self.db_sum / self.n_segments if self.n_segments else self.db_sum * np.nan,
+                'values': values}
+
+
+    def finish(self):
+        ''' Get the summary of the incomplete current hour.
+
+        :return: The list of the summaries.
+        '''
+        if not self.n_segments:
+            return []
+        summaries = [self.summary()]
+        self.clear_histogram()
+        return summaries
+
+
+
+class PSDMonitor(object):
+    ''' Compute the noise PSD of the recorder channels.
+
+    '''
+
+    def __init__(self, output_dir, network, station, location, sps = 100., **kwargs):
+        ''' Initialization of the instance.
+
+        :param output_dir: The directory of the summary files.
+        :param kwargs: The parameters of the WelchPSD estimators.
+        '''
+        # The logger.
+        logger_name = __name__ + "." + self.__class__.__name__
+        self.logger = logging.getLogger(logger_name)
+
+        self.output_dir = output_dir
+
+        self.network = network
+
+        self.station = station
+
+        self.location = location
+
+        self.sps = sps
+
+        self.psd_kwargs = kwargs
+
+        # The PSD estimators of the channels.
+        self.estimators = {}
+
+        # The mutex of the summary file writes.
+        self.write_mutex = threading.Lock()
+
+
+    def get_estimator(self, channel):
+        ''' Get the PSD estimator of a channel.
+        '''
+        if channel not in self.estimators:
+            self.estimators[channel] = WelchPSD(sps = self.sps, **self.psd_kwargs)
+        return self.estimators[channel]
+
+
+    def add_data(self, channel, start_time, data):
+        ''' Add the resampled data of a channel.
+
+        The channels may be fed in parallel from different threads, each
+        channel from one thread only.
+        '''
+        summaries = self.get_estimator(channel).feed(start_time = start_time,
+                                                     data = data)
+        for cur_summary in summaries:
+            self.write_summary(channel, cur_summary)
+
+
+    def flush(self):
+        ''' Write the summaries of the incomplete current hours.
+        '''
+        for cur_channel, cur_estimator in sorted(self.estimators.items()):
+            for cur_summary in cur_estimator.finish():
+                self.write_summary(cur_channel, cur_summary)
+
+
+    def get_filepath(self, trace_id, start_time):
+        ''' Get the path of the daily summary file.
+        '''
+        start_time = obspy.UTCDateTime(ns = int(start_time))
+        filename = '%s.%04d.%03d.psd' % (trace_id, start_time.year, start_time.julday)
+        return os.path.join(self.output_dir, '%04d' % start_time.year, filename)
+
+
+    def write_summary(self, channel, summary):
+        ''' Append an hourly summary to the summary file of the channel.
+        '''
+        trace_id = '.'.join([self.network, self.station, self.location, channel])
+        filepath = self.get_filepath(trace_id, summary['start_time'])
+        record = pack_summary(trace_id, summary)
+        try:
+            with self.write_mutex:
+                os.makedirs(os.path.dirname(filepath), exist_ok = True)
+                with open(filepath, 'ab') as fid:
+                    fid.write(record)
+        except Exception:
+            self.logger.exception("Error when writing the PSD summary to %s.", filepath)
+            return
+        self.logger.info("Wrote the PSD summary of %s for %s (%d segments).",
+                         trace_id, obspy.UTCDateTime(ns = summary['start_time']),
+                         summary['n_segments'])
+
+
+def main(argv = None):
+    ''' Print the records of summary files.
+    '''
+    parser = argparse.ArgumentParser(description = 'Print the hourly noise PSD summaries.')
+    parser.add_argument('files', nargs = '+',
+                        help = 'The summary files.')
+    parser.add_argument('--percentile', type = int, default = 50,
+                        help = 'The printed percentile [%%].')
+    args = parser.parse_args(argv)
+
+    for cur_file in args.files:
+        for cur_summary in read_summaries(cur_file):
+            print("%s %s segments: %d" % (cur_summary['trace_id'],
+                                          cur_summary['start_time'],
+                                          cur_summary['n_segments']))
+            percentiles = list(cur_summary['percentiles'])
+            if args.percentile not in percentiles:
+                print("  The percentile %d is not available (%s)." % (args.percentile, percentiles))
+                continue
+            values = cur_summary['values'][percentiles.index(args.percentile)]
+            for cur_freq, cur_value, cur_mean in zip(cur_summary['frequencies'],
+                                                     values,
+                                                     cur_summary['mean']):
+                print("  %9.3f Hz %8.1f dB (mean %8.1f dB)" % (cur_freq, cur_value, cur_mean))
+    return 0
@@ -0,0 +1,286 @@
+# -*- coding: utf-8 -*-
+# LICENSE
+#
+# This file is part of mss_record.
+#
+# If you use mss_record in any program or publication, please inform and
+# acknowledge its author Stefan Mertl (stefan@mertl-research.at).
+#
+# mss_record is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+''' Push the miniseed records of the recorder to an ingest hub.
+
+The pusher numbers the records written by the recorder and sends them over
+a persistent TCP connection to the hub (see mss_record.core.hub). The
+records are kept until the hub acknowledges that they have been written.
+After a reconnect, the sending continues after the last record received by
+the hub.
+'''
+
+import asyncio
+import collections
+import json
+import logging
+import threading
+import time
+
+import obspy.io.mseed.util
+
+import mss_record.core.hub
+
+
+class RecordPusher(object):
+    ''' Send the miniseed records of the recorder to an ingest hub.
+
+    '''
+
+    def __init__(self, host, port, station_id, window = 1000,
+                 max_buffered = 100000, min_reconnect_interval = 1.,
+                 max_reconnect_interval = 60.):
+        ''' Initialization of the instance.
+
+        :param host: The address of the hub.
+        :param port: The port of the hub.
+        :param station_id: The id of the station (NET.STA.LOC).
+        :param window: The maximum number of records sent but not yet
+            acknowledged.
+        :param max_buffered: The maximum number of buffered records. The
+            oldest records are dropped if the hub can't be reached for a
+            long time.
+        :param min_reconnect_interval: The initial time between two
+            connection attempts [s].
+        :param max_reconnect_interval: The maximum time between two
+            connection attempts [s].
+        '''
+        # The logger.
+        logger_name = __name__ + "." + self.__class__.__name__
+        self.logger = logging.getLogger(logger_name)
+
+        self.host = host
+
+        self.port = port
+
+        self.station_id = station_id
+
+        self.window = window
+
+        self.max_buffered = max_buffered
+
+        self.min_reconnect_interval = min_reconnect_interval
+
+        self.max_reconnect_interval = max_reconnect_interval
+
+        # The session id identifying the sequence numbers of this process.
+        self.session = time.time_ns()
+
+        # The last assigned sequence number.
+        self.seq = 0
+
+        # The records (seq, record) not yet acknowledged by the hub.
+        self.pending = collections.deque()
+
+        # The lock of the record buffer, which is filled by the recorder
+        # thread.
+        self.pending_mutex = threading.Lock()
+
+        # The last sequence number sent and acknowledged on the current
+        # connection.
+        self.sent_seq = 0
+        self.acked_seq = 0
+
+        # The number of dropped records.
+        self.n_dropped = 0
+
+        # The event loop of the pusher and the event signaling new records
+        # or acknowledgements.
+        self.loop = None
+        self.data_event = None
+
+        self.thread = None
+        self.task = None
+
+        # The recorder to which the pusher has been added as record handler
+        # by start.
+        self.recorder = None
+
+
+    def add_file(self, filepath):
+        ''' Add the records of a miniseed file.
+
+        This is the record handler called by the recorder for each written
+        miniseed file.
+        '''
+        reclen = obspy.io.mseed.util.get_record_information(filepath)['record_length']
+        with open(filepath, 'rb') as msd_file:
+            data = msd_file.read()
+        for k in range(0, len(data) - reclen + 1, reclen):
+            self.add_record(data[k:k + reclen])
+
+
+    def add_record(self, record):
+        ''' Add a record to the send buffer.
+
+        The method may be called from any thread.
+        '''
+        with self.pending_mutex:
+            self.seq += 1
+            self.pending.append((self.seq, record))
+            while len(self.pending) > self.max_buffered:
+                self.pending.popleft()
+                self.n_dropped += 1
+                if self.n_dropped % 1000 == 1:
+                    self.logger.warning("The send buffer is full. Dropped %d records.", self.n_dropped)
+        self.notify()
+
+
+    def notify(self):
+        ''' Wake up the sender.
+        '''
+        if self.loop is not None and self.data_event is not None:
+            self.loop.call_soon_threadsafe(self.data_event.set)
+
+
+    def acknowledge(self, seq):
+        ''' Remove the records acknowledged by the hub.
+        '''
+        self.acked_seq = max(self.acked_seq, seq)
+        with self.pending_mutex:
+            while self.pending and self.pending[0][0] <= seq:
+                self.pending.popleft()
+
+
+    async def run(self, recorder = None):
+        ''' Connect to the hub and send the records until cancelled.
+
+        The method can be used as a service of the AsyncRecorder.
+
+        :param recorder: The recorder providing the records. If given, the
+            pusher is added to its record handlers.
+        '''
+        self.loop = asyncio.get_running_loop()
+        self.data_event = asyncio.Event()
+        if recorder is not None:
+            recorder.record_handlers.append(self.add_file)
+
+        reconnect_interval = self.min_reconnect_interval
+        try:
+            while True:
+                try:
+                    await self.push()
+                    reconnect_interval = self.min_reconnect_interval
+                except (OSError, asyncio.IncompleteReadError, ValueError) as e:
+                    self.logger.error("Connection to the hub %s:%d failed: %s.",
+                                      self.host, self.port, e)
+                    await asyncio.sleep(reconnect_interval)
+                    reconnect_interval = min(2 * reconnect_interval, self.max_reconnect_interval)
+        finally:
+            if recorder is not None:
+                recorder.record_handlers.remove(self.add_file)
+
+
+    async def push(self):
+        ''' Send the records over one connection.
+        '''
+        reader, writer = await asyncio.open_connection(self.host, self.port)
+        try:
+            hello = json.dumps({'station': self.station_id,
+                                'session': self.session}).encode('utf-8')
+            writer.write(mss_record.core.hub.pack_frame(mss_record.core.hub.FRAME_HELLO, 0, hello))
+            await writer.drain()
+            frame_type, seq, payload = await mss_record.core.hub.read_frame(reader)
+            if frame_type != mss_record.core.hub.FRAME_ACK:
+                raise ValueError("Expected an ACK frame.")
+            # The records received by the hub are not sent again.
+            self.acknowledge(seq)
+            self.sent_seq = seq
+            self.logger.info("Connected to the hub %s:%d, continuing after record %d.",
+                             self.host, self.port, seq)
+
+            ack_task = asyncio.create_task(self.receive_acks(reader))
+            try:
+                while not ack_task.done():
+                    self.data_event.clear()
+                    with self.pending_mutex:
+                        records = [x for x in self.pending if x[0] > self.sent_seq]
+                    records = records[:max(self.window - (self.sent_seq - self.acked_seq), 0)]
+                    for cur_seq, cur_record in records:
+                        writer.write(mss_record.core.hub.pack_frame(mss_record.core.hub.FRAME_RECORD,
+                                                                    cur_seq,
+                                                                    cur_record))
+                        self.sent_seq = cur_seq
+                    await writer.drain()
+                    if not records:
+                        wait_task = asyncio.create_task(self.data_event.wait())
+                        await asyncio.wait([ack_task, wait_task],
+                                           return_when = asyncio.FIRST_COMPLETED)
+                        wait_task.cancel()
+                # Raise the error of the acknowledgement reader.
+                ack_task.result()
+                raise ConnectionError("The hub closed the connection.")
+            finally:
+                ack_task.cancel()
+        finally:
+            writer.close()
+
+
+    async def receive_acks(self, reader):
+        ''' Read the acknowledgements of the hub.
+        '''
+        while True:
+            frame_type, seq, payload = await mss_record.core.hub.read_frame(reader)
+            if frame_type == mss_record.core.hub.FRAME_ACK:
+                self.acknowledge(seq)
+                self.data_event.set()
+
+
+    def start(self, recorder = None):
+        ''' Run the pusher in a thread with its own event loop.
+
+        This is used with the threaded Recorder. The pusher is added to the
+        record handlers of the recorder before the thread is started, so
+        the files written before the event loop is running are buffered
+        too.
+        '''
+        if recorder is not None:
+            recorder.record_handlers.append(self.add_file)
+            self.recorder = recorder
+        self.thread = threading.Thread(name = 'pusher',
+                                       target = asyncio.run,
+                                       args = (self.run_thread(),),
+                                       daemon = True)
+        self.thread.start()
+
+
+    async def run_thread(self):
+        ''' Run the pusher until stopped.
+        '''
+        self.task = asyncio.current_task()
+        try:
+            await self.run()
+        except asyncio.CancelledError:
+            pass
+
+
+    def stop(self):
+        ''' Stop the pusher thread.
+        '''
+        if self.thread is None:
+            return
+        if self.loop is not None and self.task is not None:
+            self.loop.call_soon_threadsafe(self.task.cancel)
+        self.thread.join()
+        self.thread = None
+        if self.recorder is not None:
+            self.recorder.record_handlers.remove(self.add_file)
+            self.recorder = None
@@ -0,0 +1,199 @@
+# -*- coding: utf-8 -*-
+# LICENSE
+#
+# This file is part of mss_record.
+#
+# If you use mss_record in any program or publication, please inform and
+# acknowledge its author Stefan Mertl (stefan@mertl-research.at).
+#
+# mss_record is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+''' Adaptive selection of the ADC data rate.
+
+At startup, the time needed to acquire one sample (timestamp, I2C read of
+the conversion result and queueing) is measured on the real or simulated
+bus. The highest ADS111x data rate keeping the load of all channels within
+the budget is selected. At runtime, the number of samples received each
+second and the processing time of the recorder are watched. After
+sustained missing samples (missed DRDYs) or overruns, the next lower data
+rate is selected.
+'''
+
+import logging
+import queue
+import time
+
+import numpy as np
+import obspy
+
+import mss_record.adc.ads111x as mss_ads111x
+
+
+def usable_data_rates(min_rate = 100.):
+    ''' Get the ADS111x data rates usable for a minimum sampling rate.
+
+    :param min_rate: The minimum sampling rate of the channels [sps].
+    :return: The data rates above min_rate in ascending order.
+    '''
+    return [x for x in sorted(mss_ads111x.ADS111x_CONFIG_DR) if x > min_rate]
+
+
+def measure_sample_time(adc, i2c_mutex, n_reads = 200, data_queue = None):
+    ''' Measure the time needed to acquire one sample.
+
+    The work of the DRDY handler is repeated n_reads times: taking the
+    timestamp, reading the conversion result while holding the I2C mutex
+    and putting the sample into the queue.
+
+    :param adc: The ADS111x instance.
+    :param i2c_mutex: The mutex of the I2C bus.
+    :param n_reads: The number of measured reads.
+    :param data_queue: The queue receiving the samples. If None, a local
+        queue is used.
+    :return: The 95th percentile of the acquisition time of a sample [s].
+    '''
+    if data_queue is None:
+        data_queue = queue.SimpleQueue()
+    durations = np.zeros(n_reads)
+    for k in range(n_reads):
+        start = time.perf_counter()
+        cur_timestamp = obspy.UTCDateTime()
+        with i2c_mutex:
+            cur_sample = adc.get_last_result()
+        data_queue.put((cur_timestamp, cur_sample))
+        durations[k] = time.perf_counter() - start
+    # Remove the measurement samples from the queue.
+    for k in range(n_reads):
+        try:
+            data_queue.get(timeout = 0.1)
+        except queue.Empty:
+            break
+    return np.percentile(durations, 95)
+
+
+
+class RateController(object):
+    ''' Select the ADC data rate and fall back to lower rates on overload.
+
+    '''
+
+    def __init__(self, min_rate = 100., max_load = 0.5, missing_limit = 0.15,
+                 overrun_limit = 0.8, sustain = 10):
+        ''' Initialization of the instance.
+
+        :param min_rate: The minimum sampling rate of the channels [sps].
+            The lowest data rate used is the lowest ADS111x data rate
+            above this value.
+        :param max_load: The maximum fraction of the time spent acquiring
+            the samples of all channels.
+        :param missing_limit: The fraction of missing samples of a channel
+            in one second counted as missed DRDYs, in addition to the
+            oscillator tolerance of the ADC.
+        :param overrun_limit: The processing time of one second counted as
+            an overrun [s].
+        :param sustain: The number of consecutive bad seconds triggering the
+            fallback to a lower data rate.
+        '''
+        # The logger.
+        logger_name = __name__ + "." + self.__class__.__name__
+        self.logger = logging.getLogger(logger_name)
+
+        self.min_rate = min_rate
+
+        self.max_load = max_load
+
+        self.missing_limit = missing_limit
+
+        self.overrun_limit = overrun_limit
+
+        self.sustain = sustain
+
+        # The usable data rates in ascending order.
+        self.data_rates = usable_data_rates(min_rate)
+
+        # The selected data rate.
+        self.data_rate = None
+
+        # The measured acquisition time of one sample [s].
+        self.sample_time = None
+
+        # The number of consecutive seconds with missing samples or
+        # overruns.
+        self.n_missing = 0
+        self.n_overruns = 0
+
+
+    def select(self, sample_time, n_channels, fixed_load = 0.):
+        ''' Select the highest data rate sustainable by the channels.
+
+        :param sample_time: The acquisition time of one sample [s].
+        :param n_channels: The number of channels using the data rate.
+        :param fixed_load: The load of other devices sharing the bus,
+            e.g. a scan with a fixed data rate.
+        :return: The selected data rate.
+        '''
+        self.sample_time = sample_time
+        selected = self.data_rates[0]
+        for cur_rate in self.data_rates:
+            cur_load = n_channels * cur_rate * sample_time + fixed_load
+            if cur_load <= self.max_load:
+                selected = cur_rate
+        load = n_channels * selected * sample_time + fixed_load
+        if load > self.max_load:
+            self.logger.warning("The load of %.2f at the lowest data rate %d exceeds the budget of %.2f.",
+                                load, selected, self.max_load)
+        self.logger.info("Selected the data rate %d sps for %d channels (sample time %.1f us, load %.2f).",
+                         selected, n_channels, sample_time * 1e6, load)
+        self.data_rate = selected
+        return selected
+
+
+    def update(self, counts, cycle_time):
+        ''' Evaluate the last second.
+
+        :param counts: The number of samples received from each channel
+            using the data rate and the expected number of samples.
+        :param cycle_time: The processing time of the second [s].
+        :return: The lower data rate to use or None, if the data rate is
+            kept.
+        '''
+        limit = 1 - mss_ads111x.ADS111x_OSCILLATOR_TOLERANCE - self.missing_limit
+        missing = sorted([x for x, (n, expected) in counts.items() if n < limit * expected])
+        if missing:
+            self.n_missing += 1
+        else:
+            self.n_missing = 0
+        if cycle_time > self.overrun_limit:
+            self.n_overruns += 1
+        else:
+            self.n_overruns = 0
+
+        if self.n_missing < self.sustain and self.n_overruns < self.sustain:
+            return None
+
+        if self.n_missing >= self.sustain:
+            reason = "missing samples of channel %s" % ','.join(missing)
+        else:
+            reason = "processing time of %.2f s" % cycle_time
+        self.n_missing = 0
+        self.n_overruns = 0
+
+        lower = [x for x in self.data_rates if x < self.data_rate]
+        if not lower:
+            self.logger.error("Overload at the lowest data rate %d sps: %s.", self.data_rate, reason)
+            return None
+        self.logger.warning("Lowering the data rate from %d sps to %d sps: %s.",
+                            self.data_rate, lower[-1], reason)
+        self.data_rate = lower[-1]
+        return self.data_rate
@@ -19,12 +19,13 @@
 # You should have received a copy of the GNU General Public License
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
+import concurrent.futures
+import io
 import logging
 import multiprocessing
 import os
-import re
 import signal
-import subprocess
+import struct
 import sys
 import threading
 import time
@@ -32,17 +33,79 @@ import time
 #import apscheduler.schedulers.background as background_scheduler
 import numpy as np
 import obspy
+import obspy.io.mseed.util
 import scipy as sp
 import scipy.signal
 
+import mss_record.adc.ads111x as mss_ads111x
+import mss_record.core.capture
 import mss_record.core.channel
+import mss_record.core.clock
+import mss_record.core.decimate
+import mss_record.core.gaps
+import mss_record.core.rate
+import mss_record.core.scan
+import mss_record.core.supervisor
+
+# The default miniseed record configuration of a channel. The maximum
+# latency is the maximum time [s] between the first sample of a record and
+# writing the record. If None, the complete records are written at the write
+# interval.
+DEFAULT_RECORD_CONFIG = {'reclen': 512,
+                         'encoding': 'STEIM2',
+                         'max_latency': None}
+
+# The supported miniseed record lengths and encodings.
+RECORD_LENGTHS = [256, 512, 1024, 2048, 4096]
+RECORD_ENCODINGS = ['STEIM1', 'STEIM2', 'INT32', 'INT16']
+
+
+def min_record_samples(reclen, encoding):
+    ''' The smallest number of samples which can fill a miniseed record.
+
+    The data of a record starts after the fixed header and the blockettes at
+    byte 64. The Steim frames of 64 bytes hold 15 data words, two words of
+    the first frame hold the integration constants. In the worst case, a
+    data word holds one difference.
+    '''
+    data_bytes = reclen - 64
+    if encoding == 'INT16':
+        return data_bytes // 2
+    elif encoding == 'INT32':
+        return data_bytes // 4
+    else:
+        return (data_bytes // 64) * 15 - 2
+
+
+def record_is_full(record, encoding):
+    ''' Check, if a packed miniseed record is completely filled.
+
+    The number of samples and the data offset are read from the fixed
+    header (big endian as packed by obspy). The Steim frames are packed
+    word by word, so a Steim record is full if the last word of its last
+    frame is used, which is marked in the control word of the frame.
+    '''
+    n_samples = struct.unpack('>H', record[30:32])[0]
+    data_offset = struct.unpack('>H', record[44:46])[0]
+    if encoding == 'INT16':
+        return n_samples == (len(record) - data_offset) // 2
+    elif encoding == 'INT32':
+        return n_samples == (len(record) - data_offset) // 4
+    else:
+        control_word = struct.unpack('>I', record[-64:-60])[0]
+        return (control_word & 0x3) != 0
+
 
 class Recorder:
     ''' The recorder class.
 
     '''
     def __init__(self, network, station, location, channel_config,
-                 write_interval = 10):
+                 write_interval = 10, scan_config = None, capture_dir = None,
+                 capture_file_size = 16 * 1024**2, data_dir = '/home/mss/mseed',
+                 clock = None, watchdog = True, output_rates = None,
+                 clock_monitor = None, dsp_workers = None, data_rate = 128,
+                 max_bus_load = 0.5, telemetry = None, psd_monitor = None):
         ''' Initialization of the instance.
 
         '''
@@ -64,12 +127,86 @@ class Recorder:
         # The general sampling rate of the recorder.
         self.sps = 100.
 
+        # The additional lower output sampling rates. Each rate has to be an
+        # integer fraction of the next higher rate.
+        if output_rates is None:
+            output_rates = []
+        self.output_rates = sorted(output_rates, reverse = True)
+
+        # The decimation cascades computing the lower output rates of the
+        # channels.
+        self.decimators = {}
+
+        # The channel names of the decimated product channel codes.
+        self.product_parents = {}
+
         # The interval in full seconds to write the miniseed file.
         self.write_interval = write_interval
 
+        # The directory where to store the miniseed files.
+        self.data_dir = data_dir
+
+        # The clock used to get the current time and to wait for the next
+        # second.
+        if clock is None:
+            clock = mss_record.core.clock.SystemClock()
+        self.clock = clock
+
+        # Rearm the SIGALRM watchdog after each successful write.
+        self.watchdog = watchdog
+
+        # The monitor of the system clock synchronization. If set, the
+        # clock quality flags of the written miniseed records are set.
+        self.clock_monitor = clock_monitor
+
+        # The number of threads processing the data of the channels in
+        # parallel. None or 1 processes the channels sequentially, 0 uses
+        # one thread per CPU core.
+        if dsp_workers == 0:
+            dsp_workers = os.cpu_count() or 1
+        self.dsp_workers = dsp_workers
+
+        # The thread pool of the channel processing.
+        self.dsp_executor = None
+
+        # The ADC data rate of the channels. If 'auto', the highest data
+        # rate sustainable by the measured sample acquisition time is
+        # selected and lowered at runtime on overload.
+        self.rate_controller = None
+        if data_rate == 'auto':
+            self.rate_controller = mss_record.core.rate.RateController(min_rate = self.sps,
+                                                                       max_load = max_bus_load)
+            data_rate = 128
+        self.data_rate = data_rate
+
+        # The names of the channels using the data rate. The channels of a
+        # scan use the data rate of the scan configuration.
+        self.rate_channels = []
+
+        # The detection of gaps and overlaps in the buffered traces.
+        self.gap_engine = mss_record.core.gaps.GapEngine()
+
+        # The number of samples received from each channel in the last
+        # second and the expected number of samples.
+        self.sample_counts = {}
+
+        # The optional sender of the per-second telemetry packets.
+        self.telemetry = telemetry
+
+        # The optional computation of the hourly noise PSD summaries of the
+        # channels.
+        self.psd_monitor = psd_monitor
+
+        # The callables called with the file path of each written miniseed
+        # file, e.g. to push the records to an ingest hub.
+        self.record_handlers = []
+
         # The obspy data stream.
         self.stream = obspy.core.Stream()
 
+        # The supervisor of the acquisition worker.
+        self.supervisor = None
+
         # Mutex used for I2C communication.
         self.i2c_mutex = multiprocessing.Lock()
 
@@ -85,44 +222,69 @@ class Recorder:
 
 
 
+        # The configuration of an optional ADS1115 scanning multiple inputs.
+        # A dictionary with the keys i2c_address, rdy_gpio, data_rate and
+        # inputs. The inputs are a dictionary with the channel name as key
+        # and a dictionary with the keys mux and gain as value.
+        self.scan_config = scan_config
+
+        # The directory where to store the raw sample capture files. If None,
+        # the raw samples are not captured.
+        self.capture_dir = capture_dir
+
+        # The size of the raw sample capture files [bytes].
+        self.capture_file_size = capture_file_size
+
         # Initialize the channels.
         self.channels = {}
         self.channel_stats = {}
         self.init_channels()
+        if self.scan_config:
+            self.init_scan_channels()
+        if self.rate_controller is not None and self.rate_channels:
+            self.select_data_rate()
 
 
     def check_ntp(self):
-        ''' Check for a valid NTP connection.
-        '''
-        self.logger.info('Checking the NTP.')
-        proc = subprocess.Popen(['ntpq', '-np'], stdout=subprocess.PIPE)
-        stdout_value = proc.communicate()[0].decode('utf-8')
+        ''' Check the synchronization of the system clock.
 
-        if stdout_value.lower().startswith("no association id's returned"):
-            self.logger.error("NTP is not running. ntpd response: %s.", stdout_value)
-            return []
+        The kernel time status is used instead of querying the NTP daemon.
 
-        # Search for the header line.
-        header_token = "===\n"
-        header_end = stdout_value.find(header_token) + len(header_token)
+        :return: True, if the system clock is synchronized.
+        '''
+        self.logger.info('Checking the clock synchronization.')
+        if self.clock_monitor is not None:
+            read_status = self.clock_monitor.read_status
+        else:
+            read_status = mss_record.core.clock.kernel_time_status
 
-        if not header_end:
-            self.logger.error("NTP seems to be running, but no expected result was returned by ntpq: %s", stdout_value)
-            return []
+        try:
+            status = read_status()
+        except Exception:
+            self.logger.exception("Error when reading the kernel time status.")
+            return False
 
-        self.logger.info("NTP is running.\n%s", stdout_value)
+        if not status.synchronized:
+            self.logger.error("The system clock is not synchronized: %s.", status)
+            return False
 
-        payload = stdout_value[header_end:]
-        working_server = []
-        for cur_line in payload.splitlines():
-            cur_data = re.split(' +', cur_line)
-            if cur_line.startswith("*") or cur_line.startswith("+"):
-                working_server.append(cur_data)
+        self.logger.info("The system clock is synchronized: %s.", status)
+        return True
 
-        if not working_server:
-            self.logger.warning("No working servers found.")
 
-        return working_server
+    def create_capture(self, name, sps):
+        ''' Create the raw sample capture of a channel.
+
+        :return: The RawCaptureWriter or None, if no capture directory is
+            configured.
+        '''
+        if self.capture_dir is None:
+            return None
+        capture_name = '_'.join([self.network, self.station, self.location, name])
+        return mss_record.core.capture.RawCaptureWriter(directory = self.capture_dir,
+                                                        name = capture_name,
+                                                        sps = sps,
+                                                        file_size = self.capture_file_size)
 
 
     def init_channels(self):
@@ -144,8 +306,9 @@ class Recorder:
                                                           rdy_gpio = cur_rdy_gpio,
                                                           i2c_mutex = self.i2c_mutex,
                                                           data_queue = data_queue,
-                                                          sps = 128,
-                                                          gain = cur_gain)
+                                                          sps = self.data_rate,
+                                                          gain = cur_gain,
+                                                          capture = self.create_capture(cur_name, self.data_rate))
 
             if(cur_channel.check_adc()):
                 self.logger.info("Found a working ADC.")
@@ -155,6 +318,7 @@ class Recorder:
                     self.logger.error("ADC couldn't be configured. Ignoring channel %s.", cur_name)
 
                 self.channels[cur_name] = cur_channel
+                self.rate_channels.append(cur_name)
 
                 # Create the obspy trace stats for the channel.
                 cur_stats = obspy.core.Stats()
@@ -170,6 +334,104 @@ class Recorder:
                 self.logger.warning("ADC not found. Ingnoring channel %s.", cur_name)
 
 
+    def select_data_rate(self):
+        ''' Select the data rate of the channels using the measured
+        acquisition time of a sample.
+        '''
+        first_channel = self.channels[self.rate_channels[0]]
+        sample_time = mss_record.core.rate.measure_sample_time(adc = first_channel.adc,
+                                                               i2c_mutex = self.i2c_mutex,
+                                                               data_queue = first_channel.data_queue)
+        # The channels of a scan share the bus.
+        fixed_load = sum([x.sps for x in self.channels.values() if x.name not in self.rate_channels]) * sample_time
+        data_rate = self.rate_controller.select(sample_time = sample_time,
+                                                n_channels = len(self.rate_channels),
+                                                fixed_load = fixed_load)
+        self.set_data_rate(data_rate)
+        for cur_name in self.rate_channels:
+            if not self.channels[cur_name].start_adc():
+                self.logger.error("The ADC of channel %s couldn't be configured.", cur_name)
+
+
+    def set_data_rate(self, data_rate):
+        ''' Set the data rate of the channels.
+
+        The ADCs are configured with the new data rate when they are
+        started.
+        '''
+        self.data_rate = data_rate
+        for cur_name in self.rate_channels:
+            cur_channel = self.channels[cur_name]
+            cur_channel.sps = data_rate
+            if cur_channel.capture is not None:
+                # The new rate is written to the next capture file.
+                cur_channel.capture.sps = data_rate
+
+
+    def change_data_rate(self, data_rate):
+        ''' Change the data rate of the running channels.
+
+        The acquisition worker is restarted, which reconfigures the ADCs.
+        '''
+        self.set_data_rate(data_rate)
+        if self.supervisor is not None:
+            self.supervisor.restart("data rate changed to %d sps" % data_rate)
+
+
+    def init_scan_channels(self):
+        ''' Initialize the channels recorded by a multiplexed ADS1115 scan.
+        '''
+        cur_addr = self.scan_config['i2c_address']
+        engine = mss_record.core.scan.ScanEngine(name = 'scan_' + hex(cur_addr),
+                                                 adc_address = cur_addr,
+                                                 rdy_gpio = self.scan_config['rdy_gpio'],
+                                                 i2c_mutex = self.i2c_mutex,
+                                                 data_rate = self.scan_config.get('data_rate', 860))
+        self.logger.info("Checking the scan ADC at address %s.", hex(cur_addr))
+        if not engine.check_adc():
+            self.logger.warning("Scan ADC not found. Ignoring the scan channels.")
+            return
+
+        scan_channels = []
+        for cur_name in sorted(self.scan_config['inputs'].keys()):
+            if cur_name in self.channels:
+                self.logger.error("The scan channel %s is already used by an ADC. Ignoring it.", cur_name)
+                continue
+            cur_config = self.scan_config['inputs'][cur_name]
+            cur_channel = engine.add_input(name = cur_name,
+                                           mux = cur_config['mux'],
+                                           data_queue = multiprocessing.Queue(),
+                                           gain = cur_config.get('gain', '1'))
+            scan_channels.append(cur_channel)
+
+        if not scan_channels:
+            return
+
+        for cur_channel in scan_channels:
+            cur_channel.capture = self.create_capture(cur_channel.name, engine.input_sps)
+
+        self.logger.info("Configuring the scan ADC for continuous mode.")
+        success = engine.start_adc()
+        if not success:
+            self.logger.error("Scan ADC couldn't be configured. Ignoring the scan channels.")
+            return
+
+        self.logger.info("Scanning %d inputs with %.1f sps per input.", len(scan_channels), engine.input_sps)
+        for cur_channel in scan_channels:
+            self.channels[cur_channel.name] = cur_channel
+
+            # Create the obspy trace stats for the channel.
+            cur_stats = obspy.core.Stats()
+            cur_stats.network = self.network
+            cur_stats.station = self.station
+            cur_stats.location = self.location
+            cur_stats.sampling_rate = self.sps
+            cur_stats.channel = cur_channel.name
+            self.channel_stats[cur_channel.name] = cur_stats
+
+            self.logger.info("Initialization of scan channel %s successfull.", cur_channel.name)
+
+
 
     def run(self):
         ''' Start the data collection.
@@ -190,15 +452,18 @@ class Recorder:
 
 
         # Wait for the next full second, than start the channels.
-        now = obspy.UTCDateTime()
+        now = self.clock.now()
         delay_to_next_second = (1e6 - now.microsecond) / 1e6
-        time.sleep(delay_to_next_second)
+        self.clock.sleep(delay_to_next_second)
+        if self.clock_monitor is not None:
+            self.clock_monitor.start()
         #orig_sigint_handler = signal.signal(signal.SIGINT, signal.SIG_IGN)
         self.logger.debug("self.channels. %s.", self.channels)
-        self.data_request_process = multiprocessing.Process(target = data_request,
-                                                       args = (self.channels, self.stop_event),
-                                                       name = "data_request")
-        self.data_request_process.start()
+        # The supervisor runs the data_request worker process and restarts
+        # it if it fails.
+        self.supervisor = mss_record.core.supervisor.Supervisor(channels = self.channels,
+                                                                worker = data_request)
+        self.supervisor.start()
         #signal.signal(signal.SIGINT, orig_sigint_handler)
 
         self.pps_thread = threading.Thread(name = 'pps',
@@ -213,15 +478,22 @@ class Recorder:
         '''
         self.logger.info("Stopping.")
         self.stop_event.set()
-        self.data_request_process.join()
+        self.supervisor.stop()
         self.pps_thread.join()
+        self.flush_data()
+        if self.clock_monitor is not None:
+            self.clock_monitor.stop()
+        self.shutdown_dsp_executor()
+        if self.psd_monitor is not None:
+            self.psd_monitor.flush()
         self.logger.info("Stopped... %s", self.stop_event.is_set())
 
 
     def collect_data(self):
         ''' Collect the data from the channels.
         '''
-        timestamp = obspy.UTCDateTime()
+        timestamp = self.clock.now()
+        cycle_start = time.monotonic()
         self.logger.debug('Collecting data. timestamp: %s', timestamp)
 
         request_start = timestamp - 1
@@ -236,116 +508,421 @@ class Recorder:
         #ms_start = ms_delay - (ms_delay % ((1/self.sps) * 1000))
         #timestamp.microsecond = int(ms_start * 1000)
 
-        for cur_name in sorted(self.channels.keys()):
-            cur_channel = self.channels[cur_name]
-            cur_data = cur_channel.get_data(start_time = request_start,
-                                            end_time = request_end)
-            #self.logger.debug("get_data finished.")
-
-            if cur_data:
-                self.logger.debug("Collected data from channel %s.", cur_channel.name)
-                self.logger.debug("Data length: %d.", len(cur_data))
-                if (len(cur_data) > (cur_channel.sps - 10)) and (len(cur_data) < (cur_channel.sps + 10)):
-                    # Grid the data to a regular sampling interval.
-                    try:
-                        cur_data = np.array(cur_data)
-                        #self.logger.debug("orig_data: %s", cur_data[:,1])
-                        cur_time = cur_data[:,0] - request_start
-                        #self.logger.debug("cur_time: %s", cur_time)
-                        cur_samp_time = np.arange(0, 1, 1/cur_channel.sps)
-                        #self.logger.debug("cur_samp_time: %s", cur_samp_time)
-                        cur_data = sp.interpolate.griddata(cur_time, cur_data[:,1], cur_samp_time,
-                                                           method = 'nearest')
-                        #self.logger.debug("cur_data: %s", cur_data)
-
-                        # Resample the data to the recorder sampling rate.
-                        cur_data = sp.signal.resample(cur_data, int(self.sps))
-
-                        # Create a obspy trace using the resampled data.
-                        cur_trace = obspy.core.Trace(data = cur_data)
-                        cur_trace.stats.network = self.network
-                        cur_trace.stats.station = self.station
-                        cur_trace.stats.location = self.location
-                        cur_trace.stats.channel = cur_channel.name
-                        cur_trace.stats.sampling_rate = self.sps
-                        cur_trace.stats.starttime = request_start
-                        self.logger.debug("cur_trace: %s", cur_trace)
-
-                        # Add the trace to the recorder stream.
-                        self.stream.append(cur_trace)
-                    except Exception as e:
-                        self.logger.exception(e)
-                else:
-                    self.logger.error("The retrieved number of samples doesn't match the expected value.")
+        self.sample_counts = {}
+        results = self.process_channels(request_start = request_start,
+                                        request_end = request_end)
+        for cur_traces in results:
+            self.stream.extend(cur_traces)
+
+        self.write_data(now = timestamp)
+
+        if self.telemetry is not None:
+            # The first trace of a channel has the recorder sampling rate.
+            traces = {x[0].stats.channel: x[0] for x in results if x}
+            try:
+                self.telemetry.send_second(start_time = request_start,
+                                           sample_counts = self.sample_counts,
+                                           traces = traces,
+                                           clock_monitor = self.clock_monitor,
+                                           n_restarts = self.supervisor.n_restarts if self.supervisor else 0)
+            except Exception:
+                self.logger.exception("Error when sending the telemetry.")
+
+        if self.rate_controller is not None:
+            # Only the channels using the adaptive data rate are judged.
+            # The scan channels have a fixed data rate.
+            rate_counts = {x: y for x, y in self.sample_counts.items() if x in self.rate_channels}
+            data_rate = self.rate_controller.update(counts = rate_counts,
+                                                    cycle_time = time.monotonic() - cycle_start)
+            if data_rate is not None:
+                self.change_data_rate(data_rate)
+
+
+        # TODO: Remove old data files from the data_dir.
+
+        self.logger.debug('Finished collecting data.')
+
+
+
+
+    def process_channels(self, request_start, request_end):
+        ''' Process the data of all channels.
+
+        If more than one DSP worker is configured, the channels are
+        processed in parallel by the threads of the DSP pool. Each channel
+        is processed by one thread, so the decimation of a channel stays in
+        order.
+
+        :return: A list of the traces returned by process_channel, in the
+            order of the channel names.
+        '''
+        channel_names = sorted(self.channels.keys())
+        executor = self.get_dsp_executor()
+        if executor is None:
+            return [self.process_channel(self.channels[x],
+                                         request_start = request_start,
+                                         request_end = request_end) for x in channel_names]
+
+        futures = [executor.submit(self.process_channel,
+                                   self.channels[x],
+                                   request_start = request_start,
+                                   request_end = request_end) for x in channel_names]
+        return [x.result() for x in futures]
+
+
+    def process_channel(self, channel, request_start, request_end):
+        ''' Get the data of a channel and compute its output traces.
+
+        The data is gridded to the sampling rate of the channel and
+        resampled to the recorder sampling rate. The channels are
+        independent from each other, so this method may be run for several
+        channels in parallel.
+
+        :param channel: The channel to process.
+        :param request_start: The start time of the requested second.
+        :param request_end: The end time of the requested second.
+        :return: A list of obspy traces with the recorder sampling rate
+            trace followed by the lower rate output products.
+        '''
+        traces = []
+        cur_channel = channel
+        cur_data = cur_channel.get_data(start_time = request_start,
+                                        end_time = request_end)
+        #self.logger.debug("get_data finished.")
+        self.sample_counts[cur_channel.name] = (len(cur_data), cur_channel.sps)
+
+        if cur_data:
+            self.logger.debug("Collected data from channel %s.", cur_channel.name)
+            self.logger.debug("Data length: %d.", len(cur_data))
+            # Allow for the tolerance of the ADC oscillator at high data
+            # rates.
+            tolerance = max(10, cur_channel.sps * mss_ads111x.ADS111x_OSCILLATOR_TOLERANCE)
+            if (len(cur_data) > (cur_channel.sps - tolerance)) and (len(cur_data) < (cur_channel.sps + tolerance)):
+                # Grid the data to a regular sampling interval.
+                try:
+                    cur_data = np.array(cur_data)
+                    #self.logger.debug("orig_data: %s", cur_data[:,1])
+                    cur_time = cur_data[:,0] - request_start
+                    #self.logger.debug("cur_time: %s", cur_time)
+                    cur_samp_time = np.arange(0, 1, 1/cur_channel.sps)
+                    #self.logger.debug("cur_samp_time: %s", cur_samp_time)
+                    cur_data = sp.interpolate.griddata(cur_time, cur_data[:,1], cur_samp_time,
+                                                       method = 'nearest')
+                    #self.logger.debug("cur_data: %s", cur_data)
+
+                    # Resample the data to the recorder sampling rate.
+                    cur_data = sp.signal.resample(cur_data, int(self.sps))
+
+                    # Create a obspy trace using the resampled data.
+                    cur_trace = obspy.core.Trace(data = cur_data)
+                    cur_trace.stats.network = self.network
+                    cur_trace.stats.station = self.station
+                    cur_trace.stats.location = self.location
+                    cur_trace.stats.channel = cur_channel.name
+                    cur_trace.stats.sampling_rate = self.sps
+                    cur_trace.stats.starttime = request_start
+                    self.logger.debug("cur_trace: %s", cur_trace)
+                    traces.append(cur_trace)
+
+                    # Add the lower rate output products.
+                    if self.output_rates:
+                        traces.extend(self.decimate(cur_channel.name, cur_data, request_start))
+
+                    if self.psd_monitor is not None:
+                        self.psd_monitor.add_data(channel = cur_channel.name,
+                                                  start_time = request_start,
+                                                  data = cur_data)
+                except Exception as e:
+                    self.logger.exception(e)
+            else:
+                self.logger.error("The retrieved number of samples doesn't match the expected value.")
+
+        return traces
+
+
+    def get_dsp_executor(self):
+        ''' Get the thread pool processing the channels in parallel.
+
+        :return: The executor or None, if the channels are processed
+            sequentially.
+        '''
+        if self.dsp_workers is None or self.dsp_workers <= 1 or len(self.channels) <= 1:
+            return None
+        if self.dsp_executor is None:
+            self.dsp_executor = concurrent.futures.ThreadPoolExecutor(max_workers = self.dsp_workers,
+                                                                      thread_name_prefix = 'dsp')
+        return self.dsp_executor
+
+
+    def shutdown_dsp_executor(self):
+        ''' Stop the threads of the DSP pool.
+        '''
+        if self.dsp_executor is not None:
+            self.dsp_executor.shutdown(wait = True)
+            self.dsp_executor = None
+
+
+    def get_record_config(self, channel):
+        ''' Get the miniseed record configuration of an output channel.
 
+        The configuration of a decimated product falls back to the
+        configuration of the channel it has been computed from.
+
+        :return: A dictionary with the keys reclen, encoding and max_latency.
+        '''
+        record_config = dict(DEFAULT_RECORD_CONFIG)
+        parent = self.product_parents.get(channel)
+        for cur_name in [parent, channel]:
+            if cur_name in self.channel_config:
+                record_config.update({x: self.channel_config[cur_name][x] for x in DEFAULT_RECORD_CONFIG if x in self.channel_config[cur_name]})
+        return record_config
+
+
+    def flush_data(self):
+        ''' Write all buffered data when the recording ends.
+
+        The output products pending in the decimation filters are added
+        and all data is written including the partially filled records.
+        '''
+        self.stream.extend(self.flush_decimators())
+        self.write_data(now = self.clock.now(), flush = True)
+
+
+    def write_data(self, now, flush = False):
+        ''' Write the buffered data to miniseed files.
+
+        The complete records of all traces are written every write
+        interval. If a maximum latency is configured for a channel, its
+        records are also written as soon as a record is full and partially
+        filled records are flushed when the oldest buffered sample reaches
+        the maximum latency.
+
+        :param now: The current time.
+        :param flush: If True, all buffered data is written including the
+            partially filled last records, e.g. at the end of a replay.
+        '''
         self.write_counter += 1
+        interval_due = self.write_counter >= self.write_interval
+        if interval_due:
+            self.write_counter = 0
+
+        # Get the start time and the number of buffered samples for each
+        # trace id.
+        buffered = {}
+        for cur_trace in self.stream:
+            if cur_trace.stats.npts == 0:
+                continue
+            cur_start, cur_npts = buffered.get(cur_trace.id, (cur_trace.stats.starttime, 0))
+            buffered[cur_trace.id] = (min(cur_start, cur_trace.stats.starttime),
+                                      cur_npts + cur_trace.stats.npts)
+
+        write_ids = set()
+        flush_ids = set()
+        for cur_id, (cur_start, cur_npts) in buffered.items():
+            if flush:
+                flush_ids.add(cur_id)
+                continue
+            cur_config = self.get_record_config(cur_id.split('.')[-1])
+            if cur_config['max_latency'] is not None:
+                if now - cur_start >= cur_config['max_latency']:
+                    flush_ids.add(cur_id)
+                    continue
+                if cur_npts >= min_record_samples(cur_config['reclen'], cur_config['encoding']):
+                    write_ids.add(cur_id)
+                    continue
+            if interval_due:
+                write_ids.add(cur_id)
 
-        if self.write_counter >= self.write_interval:
-            data_dir = '/home/mss/mseed'
-            self.stream.merge()
-            self.stream = self.stream.split()
-            self.logger.debug('stream: %s.', self.stream)
+        if not write_ids and not flush_ids:
+            return
+
+        data_dir = self.data_dir
+        # Join the traces of each trace id to contiguous segments.
+        id_traces = {}
+        for cur_trace in self.stream:
+            id_traces.setdefault(cur_trace.id, []).append(cur_trace)
+        self.stream = obspy.core.Stream()
+        for cur_id in sorted(id_traces.keys()):
+            self.stream.extend(self.gap_engine.segments(cur_id, id_traces[cur_id]))
+        self.logger.debug('stream: %s.', self.stream)
 
-            # If more traces than channels are available in the stream, there
-            # seems to be a gap in the traces. In this case, flush all the data
-            # to the miniseed file to clear the stream.
-            if len(self.stream) > len(self.channels.keys()):
+        # The segments prior to a gap are flushed to close the last record
+        # at the gap. The last segment of a trace id continues.
+        last_segment = {x.id: x for x in self.stream}
+
+        drop_traces = []
+        for cur_trace in self.stream:
+            if cur_trace.id in flush_ids:
                 flush_mode = True
-                self.logger.warning("More traces than channels in stream. Flush the miniseed files.")
+            elif cur_trace.id in write_ids:
+                flush_mode = cur_trace is not last_segment[cur_trace.id]
             else:
-                flush_mode = False
-            for cur_trace in self.stream:
-                cur_filename = cur_trace.id.replace('.','_') + '_' + cur_trace.stats.starttime.isoformat().replace(':','') + '.msd'
-                cur_filepath = os.path.join(data_dir, cur_filename)
-                try:
-                    export_trace = cur_trace.copy()
+                continue
+            cur_config = self.get_record_config(cur_trace.stats.channel)
+            if not flush_mode and cur_trace.stats.npts < min_record_samples(cur_config['reclen'], cur_config['encoding']):
+                # The data can't fill a complete record.
+                continue
+            cur_filename = cur_trace.id.replace('.','_') + '_' + cur_trace.stats.starttime.isoformat().replace(':','') + '.msd'
+            cur_filepath = os.path.join(data_dir, cur_filename)
+            try:
+                export_trace = cur_trace.copy()
+                if cur_config['encoding'] == 'INT16':
+                    export_trace.data = np.clip(export_trace.data, -32768, 32767).astype(np.int16)
+                else:
                     export_trace.data = export_trace.data.astype(np.int32)
-                    export_trace.write(cur_filepath,
-                                       format = "MSEED",
-                                       reclen = 512,
-                                       encoding = 'STEIM2',
-                                       flush = flush_mode)
-                    signal.alarm(4*self.write_interval)
-                except NotImplementedError as e:
-                    self.logger.exception("Error when writing the miniseed file with masked data. Clearing the stream and going on.")
-                    self.stream = obspy.core.Stream()
-                    break
-                except ValueError as e:
+                # Pack all samples and drop the last record if it is
+                # incomplete and the data is not flushed. Packing without
+                # flushing in libmseed leaks memory with every write.
+                buf = io.BytesIO()
+                export_trace.write(buf,
+                                   format = "MSEED",
+                                   reclen = cur_config['reclen'],
+                                   encoding = cur_config['encoding'],
+                                   flush = True)
+                raw = buf.getvalue()
+                if not flush_mode and not record_is_full(raw[-cur_config['reclen']:], cur_config['encoding']):
+                    raw = raw[:-cur_config['reclen']]
+                if not raw:
                     self.logger.debug("Not enough data to write a miniseed record.")
+                    continue
+                with open(cur_filepath, 'wb') as msd_file:
+                    msd_file.write(raw)
+                self.kick_watchdog()
+            except NotImplementedError as e:
+                # The segments don't contain masked data. Drop only the
+                # affected trace if it happens anyway.
+                self.logger.exception("Error when writing the miniseed file with masked data. Dropping %d samples of %s.",
+                                      cur_trace.stats.npts, cur_trace.id)
+                drop_traces.append(cur_trace)
+                continue
+            except ValueError as e:
+                self.logger.debug("Not enough data to write a miniseed record.")
+                if os.path.exists(cur_filepath):
                     os.remove(cur_filepath)
+                continue
+
+            # Reread the file to check the end time.
+            if os.path.exists(cur_filepath):
+                try:
+                    cur_exp_st = obspy.read(cur_filepath)
+                    self.logger.debug('Re-read stream: %s.', cur_exp_st)
+                except Exception as e:
+                    self.logger.exception("Error when reading the miniseed file. Remove it and drop %d samples of %s.",
+                                          cur_trace.stats.npts, cur_trace.id)
+                    os.remove(cur_filepath)
+                    drop_traces.append(cur_trace)
                     continue
 
-                # Reread the file to check the end time.
-                if os.path.exists(cur_filepath):
+                end_list = [x.stats.endtime for x in cur_exp_st]
+                cur_end = max(end_list)
+                self.set_quality_flags(cur_filepath,
+                                       start_time = min([x.stats.starttime for x in cur_exp_st]),
+                                       end_time = cur_end)
+                for cur_handler in list(self.record_handlers):
                     try:
-                        cur_exp_st = obspy.read(cur_filepath)
-                        self.logger.debug('Re-read stream: %s.', cur_exp_st)
-                    except Exception as e:
-                        self.logger.exception("Error when reading the miniseed file. Remove it.")
-                        os.remove(cur_filepath)
-                        self.stream = obspy.core.Stream()
-                        break
-
-                    end_list = [x.stats.endtime for x in cur_exp_st]
-                    cur_end = max(end_list)
-                    cur_trace.trim(starttime = cur_end + cur_exp_st[0].stats.delta,
-                                   nearest_sample = False)
-
-            self.logger.debug('stream after write: %s.', self.stream)
-            self.write_counter = 0
+                        cur_handler(cur_filepath)
+                    except Exception:
+                        self.logger.exception("Error in the record handler.")
+                cur_trace.trim(starttime = cur_end + cur_exp_st[0].stats.delta,
+                               nearest_sample = False)
+                # The trimmed trace is kept in the stream. Drop the processing
+                # history added by obspy, which would grow with every write.
+                cur_trace.stats.pop('processing', None)
+                self.gap_engine.set_written(cur_trace.id, cur_end + cur_exp_st[0].stats.delta)
+
+        for cur_trace in drop_traces:
+            # The dropped samples are counted as a gap and are not expected
+            # in the stream anymore.
+            drop_start = cur_trace.stats.starttime.ns
+            drop_end = drop_start + int(round(cur_trace.stats.npts * 1e9 / cur_trace.stats.sampling_rate))
+            self.gap_engine.count_gap(cur_trace.id, drop_start, drop_end,
+                                      1e9 / cur_trace.stats.sampling_rate)
+            self.gap_engine.set_written(cur_trace.id, obspy.UTCDateTime(ns = drop_end))
+        # Remove the dropped and the completely written traces.
+        self.stream.traces = [x for x in self.stream if x.stats.npts > 0 and not any([x is y for y in drop_traces])]
+
+        self.logger.debug('stream after write: %s.', self.stream)
+
+
+    def set_quality_flags(self, filepath, start_time, end_time):
+        ''' Set the clock quality flags of the records of a miniseed file.
+
+        The records are marked as clock locked or as time tag questionable
+        using the unlocked periods of the clock monitor.
+        '''
+        if self.clock_monitor is None:
+            return
 
+        flags = self.clock_monitor.quality_flags(start_time, end_time)
+        try:
+            obspy.io.mseed.util.set_flags_in_fixed_headers(filepath, {'...': flags})
+        except Exception:
+            self.logger.exception("Error when setting the quality flags of %s.", filepath)
 
-        # TODO: Remove old data files from the data_dir.
 
-        self.logger.debug('Finished collecting data.')
+    def decimate(self, name, data, start_time):
+        ''' Compute the lower rate output products of a channel.
+
+        :param name: The name of the channel.
+        :param data: The data with the recorder sampling rate.
+        :param start_time: The time of the first sample.
+        :return: A list of obspy traces, one for each output rate.
+        '''
+        if name not in self.decimators:
+            self.decimators[name] = mss_record.core.decimate.DecimationCascade(sps = self.sps,
+                                                                               output_rates = self.output_rates)
+            self.logger.info("The output products of channel %s are delayed by the decimation filters: %s.",
+                             name, ', '.join(['%g sps %.1f s' % (x, y) for x, y in sorted(self.decimators[name].delays.items(), reverse = True)]))
+        products = self.decimators[name].process(data, start_time)
+        return self.product_traces(name, products)
+
 
+    def flush_decimators(self):
+        ''' Get the output products pending in the decimation filters.
+
+        :return: A list of obspy traces.
+        '''
+        traces = []
+        for cur_name in sorted(self.decimators.keys()):
+            traces.extend(self.product_traces(cur_name, self.decimators[cur_name].flush()))
+        return traces
 
 
+    def product_traces(self, name, products):
+        ''' Create the traces of the output products of a channel.
+
+        :param name: The name of the channel.
+        :param products: The products returned by the DecimationCascade.
+        :return: A list of obspy traces, one for each output rate.
+        '''
+        traces = []
+        for cur_rate in sorted(products.keys(), reverse = True):
+            cur_start, cur_data = products[cur_rate]
+            if len(cur_data) == 0:
+                continue
+            cur_trace = obspy.core.Trace(data = cur_data)
+            cur_trace.stats.network = self.network
+            cur_trace.stats.station = self.station
+            cur_trace.stats.location = self.location
+            cur_trace.stats.channel = mss_record.core.decimate.product_channel_code(name, cur_rate)
+            self.product_parents[cur_trace.stats.channel] = name
+            cur_trace.stats.sampling_rate = cur_rate
+            cur_trace.stats.starttime = cur_start
+            traces.append(cur_trace)
+        return traces
+
+
+    def kick_watchdog(self):
+        ''' Rearm the SIGALRM watchdog.
+        '''
+        if self.watchdog:
+            signal.alarm(4*self.write_interval)
+
 
     def pps(self, callback):
-        now = obspy.UTCDateTime()
+        now = self.clock.now()
         delay_to_next_second = (1e6 - now.microsecond) / 1e6
-        time.sleep(delay_to_next_second)
+        self.clock.sleep(delay_to_next_second)
 
         self.write_interval = int(self.write_interval)
         self.write_counter = 0
@@ -354,22 +931,27 @@ class Recorder:
             try:
                 callback()
             except Exception as e:
+                # Keep the pps loop running. A failure of the data
+                # acquisition is handled by the supervisor, a hanging
+                # recorder by the SIGALRM watchdog.
                 self.logger.exception(e)
-                self.stop()
 
             # skip tasks if we are behind schedule:
             #next_time += (time.time() - next_time) // delay * delay + delay
-            now = obspy.UTCDateTime()
+            now = self.clock.now()
             delay_to_next_second = (1e6 - now.microsecond) / 1e6
-            time.sleep(delay_to_next_second)
+            self.clock.sleep(delay_to_next_second)
 
         self.logger.info("Leaving the pps method.")
 
 
 
 
-def data_request(channels, stop_event):
+def data_request(channels, stop_event, heartbeat = None):
     ''' Request data from the ADCs and put it into the queue.
+
+    :param heartbeat: The Heartbeat instance used to signal the liveness
+        to the supervisor.
     '''
     signal.signal(signal.SIGINT, signal.SIG_IGN)
     # The logger.
@@ -383,8 +965,9 @@ def data_request(channels, stop_event):
         cur_channel.run()
 
     while not stop_event.is_set():
-        logger.debug("data_request waiting.... %s", stop_event.is_set())
-        time.sleep(1)
+        if heartbeat is not None:
+            heartbeat.beat()
+        stop_event.wait(0.1)
 
     for cur_name in sorted(channels.keys()):
         cur_channel = channels[cur_name]
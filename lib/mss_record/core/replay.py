@@ -0,0 +1,377 @@
+# -*- coding: utf-8 -*-
+# LICENSE
+#
+# This file is part of mss_record.
+#
+# If you use mss_record in any program or publication, please inform and
+# acknowledge its author Stefan Mertl (stefan@mertl-research.at).
+#
+# mss_record is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+''' Offline replay of raw sample streams.
+
+The raw samples of recorded captures or synthetic sample streams are fed
+through the processing of the live recorder (Channel.get_data,
+Recorder.collect_data and the miniseed writing) as fast as possible. The
+time is provided by a VirtualClock which advances only when the recorder
+waits for the next second.
+
+Usage: mss_record replay [options]
+'''
+
+import argparse
+import logging
+import multiprocessing
+import os
+import queue
+import time
+
+import numpy as np
+import obspy
+
+import mss_record.core.capture
+import mss_record.core.channel
+import mss_record.core.clock
+import mss_record.core.psd
+import mss_record.core.recorder
+import mss_record.core.telemetry
+
+
+def capture_source(filepaths):
+    ''' A sample source reading the records of capture files.
+
+    :return: A generator yielding blocks of (time [ns], count) arrays.
+    '''
+    for cur_filepath in filepaths:
+        header, records = mss_record.core.capture.read_capture(cur_filepath)
+        yield np.array(records['time']), np.array(records['count'])
+
+
+def synthetic_source(start_time, duration, sps = 128, drift = 0., jitter = 20e-6,
+                     amplitude = 1000., frequency = 1., noise = 10., seed = 0):
+    ''' A sample source generating a synthetic signal.
+
+    The samples are generated with the timing of a free running ADC: the
+    sampling rate deviates by drift from the nominal rate and the timestamps
+    are delayed by the exponentially distributed latency of the DRDY
+    handler.
+
+    :return: A generator yielding blocks of (time [ns], count) arrays with
+        a length of one second.
+    '''
+    rng = np.random.default_rng(seed)
+    cur_sps = sps * (1 + drift)
+    start_ns = obspy.UTCDateTime(start_time).ns
+    n_samples = int(duration * cur_sps)
+    block_len = int(np.ceil(cur_sps))
+    for k in range(0, n_samples, block_len):
+        ind = np.arange(k, min(k + block_len, n_samples))
+        cur_time = ind / cur_sps
+        cur_data = amplitude * np.sin(2 * np.pi * frequency * cur_time)
+        cur_data += rng.normal(0, noise, len(ind))
+        cur_data = np.clip(np.round(cur_data), -32768, 32767).astype(np.int16)
+        cur_time = cur_time + rng.exponential(jitter, len(ind))
+        yield start_ns + np.round(cur_time * 1e9).astype(np.int64), cur_data
+
+
+
+class ReplayChannel(mss_record.core.channel.Channel):
+    ''' A channel fed by a sample source instead of an ADC.
+
+    '''
+
+    def __init__(self, name, source, sps = 128):
+        ''' Initialization of the instance.
+
+        :param source: An iterator yielding blocks of (time [ns], count)
+            arrays.
+        '''
+        # The logger.
+        logger_name = __name__ + "." + self.__class__.__name__
+        self.logger = logging.getLogger(logger_name)
+
+        # The name of the channel.
+        self.name = name
+
+        # The sampling rate of the channel.
+        self.sps = sps
+
+        # The sample source.
+        self.source = iter(source)
+
+        # The samples of the source not yet fed to the queue.
+        self.pending_time = np.array([], dtype = np.int64)
+        self.pending_data = np.array([], dtype = np.int16)
+
+        # True, if all samples of the source have been fed to the queue.
+        self.exhausted = False
+
+        # The queue holding the fed samples.
+        self.data_queue = queue.SimpleQueue()
+
+        # The samples collected from the ADC.
+        self.data = []
+
+        # The mutex lock for the data.
+        self.data_mutex = multiprocessing.Lock()
+
+        self.capture = None
+
+        self.sample_counter = None
+
+
+    def feed(self, end_time):
+        ''' Put the source samples prior to end_time into the data queue.
+        '''
+        end_ns = end_time.ns
+        while not self.exhausted and (len(self.pending_time) == 0 or self.pending_time[-1] < end_ns):
+            try:
+                cur_time, cur_data = next(self.source)
+            except StopIteration:
+                self.exhausted = True
+                break
+            self.pending_time = np.concatenate([self.pending_time, cur_time])
+            self.pending_data = np.concatenate([self.pending_data, cur_data])
+
+        n_feed = np.searchsorted(self.pending_time, end_ns)
+        for cur_time, cur_sample in zip(self.pending_time[:n_feed].tolist(),
+                                        self.pending_data[:n_feed].tolist()):
+            self.data_queue.put((obspy.UTCDateTime(ns = cur_time), cur_sample))
+        self.pending_time = self.pending_time[n_feed:]
+        self.pending_data = self.pending_data[n_feed:]
+
+
+    @property
+    def first_time(self):
+        ''' The time of the first pending sample.
+        '''
+        if len(self.pending_time) == 0 and not self.exhausted:
+            try:
+                self.pending_time, self.pending_data = next(self.source)
+            except StopIteration:
+                self.exhausted = True
+        if len(self.pending_time) == 0:
+            return None
+        return obspy.UTCDateTime(ns = int(self.pending_time[0]))
+
+
+    @property
+    def finished(self):
+        ''' True, if all samples have been fed to the queue.
+        '''
+        return self.exhausted and len(self.pending_time) == 0
+
+
+    def check_adc(self):
+        return True
+
+
+    def start_adc(self):
+        return True
+
+
+    def run(self):
+        pass
+
+
+    def stop(self):
+        pass
+
+
+
+class ReplayRecorder(mss_record.core.recorder.Recorder):
+    ''' A recorder processing the samples of replay channels.
+
+    '''
+
+    def __init__(self, network, station, location, channels, data_dir,
+                 write_interval = 10, channel_config = None, **kwargs):
+        ''' Initialization of the instance.
+
+        :param channels: A list of ReplayChannel instances.
+        :param channel_config: The miniseed record configuration of the
+            channels.
+        '''
+        if channel_config is None:
+            channel_config = {}
+        self.replay_channels = channels
+        start_time = min([x.first_time for x in channels if x.first_time is not None])
+        start_time = obspy.UTCDateTime(ns = start_time.ns - start_time.ns % 1000000000)
+        super(ReplayRecorder, self).__init__(network = network,
+                                             station = station,
+                                             location = location,
+                                             channel_config = channel_config,
+                                             write_interval = write_interval,
+                                             data_dir = data_dir,
+                                             clock = mss_record.core.clock.VirtualClock(start_time),
+                                             watchdog = False,
+                                             **kwargs)
+
+
+    def init_channels(self):
+        ''' Initialize the replay channels.
+        '''
+        for cur_channel in self.replay_channels:
+            self.channels[cur_channel.name] = cur_channel
+
+
+    def feed_channels(self, now):
+        ''' Feed the samples prior to now to the channels.
+        '''
+        for cur_channel in self.channels.values():
+            cur_channel.feed(now)
+
+
+    def collect_data(self):
+        ''' Feed the samples up to the current time and collect the data.
+        '''
+        self.feed_channels(self.clock.now())
+
+        super(ReplayRecorder, self).collect_data()
+
+        if all([x.finished for x in self.channels.values()]):
+            self.stop_event.set()
+
+
+    def run(self):
+        ''' Process all samples of the replay channels.
+        '''
+        if not os.path.exists(self.data_dir):
+            os.makedirs(self.data_dir)
+        self.pps(self.collect_data)
+        # Write the data still buffered at the end of the input.
+        self.flush_data()
+        self.shutdown_dsp_executor()
+        if self.psd_monitor is not None:
+            self.psd_monitor.flush()
+
+
+    def stop(self):
+        ''' Stop the replay.
+        '''
+        self.stop_event.set()
+
+
+
+def main(argv = None):
+    ''' The replay entry point.
+    '''
+    parser = argparse.ArgumentParser(prog = 'mss_record replay',
+                                     description = 'Reprocess raw sample streams as fast as possible.')
+    parser.add_argument('output_dir', help = 'The directory where to store the miniseed files.',
+                        type = str)
+    source_group = parser.add_mutually_exclusive_group(required = True)
+    source_group.add_argument('--capture-dir', type = str,
+                              help = 'Replay the raw sample capture files of this directory.')
+    source_group.add_argument('--synthetic', type = float, metavar = 'DURATION',
+                              help = 'Replay synthetic sample streams with the given duration [s].')
+    parser.add_argument('--start', type = str, default = '2021-01-01T00:00:00',
+                        help = 'The start time of the synthetic streams.')
+    parser.add_argument('--channels', type = str, default = '001,002,003',
+                        help = 'The comma separated names of the synthetic channels.')
+    parser.add_argument('--network', type = str, default = 'XX')
+    parser.add_argument('--station', type = str, default = 'SYNTH')
+    parser.add_argument('--location', type = str, default = '00')
+    parser.add_argument('--write-interval', type = int, default = 10,
+                        help = 'The interval to write the miniseed files [s].')
+    parser.add_argument('--output-rates', type = str, default = '',
+                        help = 'The comma separated additional output sampling rates [sps].')
+    parser.add_argument('--reclen', type = int, default = 512,
+                        help = 'The miniseed record length [bytes].')
+    parser.add_argument('--encoding', type = str, default = 'STEIM2',
+                        help = 'The miniseed encoding.')
+    parser.add_argument('--max-latency', type = float, default = None,
+                        help = 'The maximum latency of a miniseed record [s].')
+    parser.add_argument('--dsp-workers', type = int, default = None,
+                        help = 'The number of threads processing the channels in parallel. 0 uses one thread per CPU core.')
+    parser.add_argument('--telemetry', type = str, default = None, metavar = 'HOST:PORT',
+                        help = 'Send the telemetry packets to this address.')
+    parser.add_argument('--waveform-rate', type = int, default = 0,
+                        help = 'The waveform rate of the telemetry packets [sps].')
+    parser.add_argument('--psd-dir', type = str, default = None,
+                        help = 'Write the hourly noise PSD summaries to this directory.')
+    parser.add_argument('--log-level', type = str, default = 'WARNING')
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(level = args.log_level,
+                        format = "#LOG# - %(asctime)s - %(levelname)s - %(name)s: %(message)s")
+    logger = logging.getLogger('mss_record.replay')
+
+    network = args.network
+    station = args.station
+    location = args.location
+    channels = []
+    if args.capture_dir:
+        capture_files = {}
+        for cur_filepath in mss_record.core.capture.list_capture_files(args.capture_dir):
+            header = mss_record.core.capture.read_capture_header(cur_filepath)
+            capture_files.setdefault(header['name'], []).append((cur_filepath, header))
+        for cur_name in sorted(capture_files.keys()):
+            network, station, location, cur_channel_name = cur_name.split('_')
+            cur_files = capture_files[cur_name]
+            channels.append(ReplayChannel(name = cur_channel_name,
+                                          source = capture_source([x[0] for x in cur_files]),
+                                          sps = cur_files[0][1]['sps']))
+    else:
+        for k, cur_name in enumerate(args.channels.split(',')):
+            cur_source = synthetic_source(start_time = obspy.UTCDateTime(args.start),
+                                          duration = args.synthetic,
+                                          seed = k)
+            channels.append(ReplayChannel(name = cur_name.strip(),
+                                          source = cur_source))
+
+    if not channels:
+        logger.error("No sample streams found.")
+        return 1
+
+    telemetry = None
+    if args.telemetry:
+        telemetry_host, telemetry_port = args.telemetry.rsplit(':', 1)
+        telemetry = mss_record.core.telemetry.TelemetrySender(host = telemetry_host,
+                                                              port = int(telemetry_port),
+                                                              network = network,
+                                                              station = station,
+                                                              location = location,
+                                                              channels = [x.name for x in channels],
+                                                              waveform_rate = args.waveform_rate)
+
+    psd_monitor = None
+    if args.psd_dir:
+        psd_monitor = mss_record.core.psd.PSDMonitor(output_dir = args.psd_dir,
+                                                     network = network,
+                                                     station = station,
+                                                     location = location)
+
+    record_config = {'reclen': args.reclen,
+                     'encoding': args.encoding,
+                     'max_latency': args.max_latency}
+    recorder = ReplayRecorder(network = network,
+                              station = station,
+                              location = location,
+                              channels = channels,
+                              channel_config = {x.name: dict(record_config) for x in channels},
+                              data_dir = args.output_dir,
+                              write_interval = args.write_interval,
+                              output_rates = [float(x) for x in args.output_rates.split(',') if x.strip()],
+                              dsp_workers = args.dsp_workers,
+                              telemetry = telemetry,
+                              psd_monitor = psd_monitor)
+    start_time = recorder.clock.now()
+    start = time.time()
+    recorder.run()
+    logger.warning("Replayed %s to %s in %.1f s.",
+                   start_time,
+                   recorder.clock.now(),
+                   time.time() - start)
+    return 0
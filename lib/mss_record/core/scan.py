@@ -0,0 +1,375 @@
+# -*- coding: utf-8 -*-
+# LICENSE
+#
+# This file is part of mss_record.
+#
+# If you use mss_record in any program or publication, please inform and
+# acknowledge its author Stefan Mertl (stefan@mertl-research.at).
+#
+# mss_record is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+import logging
+import multiprocessing
+
+import obspy
+
+try:
+    import board
+    import busio
+    import RPi.GPIO as gpio
+except ImportError:
+    # The hardware modules are not available on hosts used for offline
+    # processing (e.g. the replay of raw sample captures).
+    board = None
+    busio = None
+    gpio = None
+
+
+import mss_record.adc.ads111x as mss_ads111x
+import mss_record.core.channel
+
+
+class ScanEngine:
+    ''' Multiplexed scan of the inputs of an ADS1115.
+
+    The engine cycles through the multiplexer settings of the inputs driven
+    by the DRDY interrupt of the ADC. The first conversion after a
+    multiplexer switch is discarded, because it may have been started with
+    the previous multiplexer setting. Each sample is timestamped at the DRDY
+    edge which ends the conversion of the related input. The sampling phase
+    of the inputs within the scan cycle is tracked.
+    '''
+
+    def __init__(self, name, adc_address, rdy_gpio, i2c_mutex, data_rate = 860, adc = None):
+        ''' Initialization of the instance.
+
+        '''
+        # The logger.
+        logger_name = __name__ + "." + self.__class__.__name__
+        self.logger = logging.getLogger(logger_name)
+
+        # The name of the scan engine.
+        self.name = name
+
+        # The I2C address of the ADC.
+        self.adc_address = adc_address
+
+        # The pin of the Raspberry to which the ADC RDY pin is connected to.
+        # The pin number is in BCM mode.
+        self.rdy_gpio = rdy_gpio
+
+        # The data rate of the ADC.
+        self.data_rate = data_rate
+
+        # The ADC device.
+        if adc is None:
+            self.i2c_bus = busio.I2C(board.SCL, board.SDA)
+            try:
+                adc = mss_ads111x.ADS1115(i2c_bus = self.i2c_bus,
+                                          address = self.adc_address)
+            except Exception:
+                adc = None
+        self.adc = adc
+
+        # Mutex used for I2C communication.
+        self.i2c_mutex = i2c_mutex
+
+        # The scanned inputs.
+        self.inputs = []
+
+        # The index of the input which is currently converted.
+        self.cur_index = 0
+
+        # Flag indicating if the next conversion has to be discarded. It is
+        # set after each multiplexer switch.
+        self.settling = True
+
+        # The start of the current scan cycle.
+        self.cycle_start = None
+
+        # The sampling phase of the inputs relative to the first input of the
+        # scan cycle [s].
+        self.phase = []
+
+        # The number of discarded conversions after the multiplexer
+        # switches.
+        self.stale_count = 0
+
+        # Flag indicating if the DRDY event handler is installed.
+        self.running = False
+
+
+    @property
+    def input_sps(self):
+        ''' The nominal sampling rate of each input.
+
+        The rate of a nominal ADC oscillator is used. The actual rate
+        deviates by the oscillator tolerance, which is accepted by the
+        sample count check of the recorder.
+        '''
+        if not self.inputs:
+            return None
+        return mss_ads111x.scan_rate(data_rate = self.data_rate,
+                                     n_inputs = len(self.inputs),
+                                     oscillator_tolerance = 0.)
+
+
+    @property
+    def skew(self):
+        ''' The sampling time difference between the first and the last
+        input of a scan cycle.
+        '''
+        if not self.phase:
+            return 0.
+        return max(self.phase)
+
+
+    def add_input(self, name, mux, data_queue, gain = '1', capture = None):
+        ''' Add an input to the scan.
+
+        :return: The ScanChannel of the input.
+        '''
+        cur_input = ScanChannel(name = name,
+                                engine = self,
+                                mux = mux,
+                                data_queue = data_queue,
+                                gain = gain,
+                                capture = capture)
+        self.inputs.append(cur_input)
+        self.phase.append(0.)
+
+        # The scan rate depends on the number of inputs.
+        for cur_channel in self.inputs:
+            cur_channel.sps = self.input_sps
+
+        return cur_input
+
+
+    def check_adc(self):
+        ''' Check, if the ADC is available.
+        '''
+        default_config = 0x8583
+        ret_val = False
+        adc_config = None
+        if self.adc is not None:
+            try:
+                # Write the default configuration to the ADC.
+                self.adc.stop_adc()
+                # Read the written configuration from the ADC.
+                adc_config = self.adc.read_config()
+            except IOError:
+                self.logger.warning("No response from ADC at address %s.", hex(self.adc_address))
+
+            if adc_config == default_config:
+                self.logger.info("Got valid response from ADC at address %s.", hex(self.adc_address))
+                ret_val = True
+            elif adc_config is not None:
+                self.logger.warning("Got an invalid response from ADC at address %s: %s", hex(self.adc_address), hex(adc_config))
+        else:
+            self.logger.warning("No ADC found at address %s.", hex(self.adc_address))
+
+        return ret_val
+
+
+    def start_adc(self):
+        ''' Start the scan of the ADC inputs in continuous mode.
+        '''
+        if not self.inputs:
+            self.logger.error("No inputs added to the scan engine %s.", self.name)
+            return False
+
+        scan_configs = self.adc.prepare_scan(mux_list = [x.mux for x in self.inputs],
+                                             gain_list = [x.gain for x in self.inputs],
+                                             data_rate = self.data_rate)
+        # Start the conversion of the first input with the conversion ready
+        # pin enabled.
+        success = self.adc.apply_config(scan_configs[0])
+        self.logger.debug("adc registers %s.", {hex(x): hex(y) for x, y in self.adc.registers.items()})
+        if not success:
+            read_config = self.adc.registers.get(mss_ads111x.ADS111x_POINTER_CONFIG, 0)
+            if (read_config & 0xE0) != (scan_configs[0].config_word & 0xE0):
+                self.logger.error("The samplingrate has not been set.")
+                return False
+            self.logger.error("Couldn't enable the conversion ready pin.")
+
+        # The running conversion may have been started with a previous
+        # configuration.
+        self.cur_index = 0
+        self.settling = True
+        self.cycle_start = None
+        return True
+
+
+    def run(self):
+        ''' Start the data collection of the scan.
+        '''
+        if self.running:
+            return
+        for cur_input in self.inputs:
+            if cur_input.capture is not None:
+                cur_input.capture.open()
+        gpio.setmode(gpio.BCM)
+        gpio.setup(self.rdy_gpio, gpio.IN)
+        gpio.add_event_detect(self.rdy_gpio, gpio.RISING, callback = self.drdy_callback)
+        self.running = True
+        self.logger.info("Added the DRDY event handler for scan engine %s.", self.name)
+
+
+    def stop(self):
+        ''' Stop the data collection of the scan.
+        '''
+        if not self.running:
+            return
+        gpio.remove_event_detect(self.rdy_gpio)
+        gpio.cleanup(self.rdy_gpio)
+        for cur_input in self.inputs:
+            if cur_input.capture is not None:
+                cur_input.capture.close()
+        self.running = False
+        self.logger.info("Stopped scan engine %s: %d discarded conversions, skew %.2f ms.",
+                         self.name, self.stale_count, self.skew * 1000)
+
+
+    def drdy_callback(self, channel):
+        ''' Handle the ADC drdy interrupt.
+
+        The first conversion after a multiplexer switch is discarded. After
+        the second one, the multiplexer is switched to the next input before
+        reading the result of the finished conversion. This starts the next
+        conversion as early as possible.
+        '''
+        cur_timestamp = obspy.UTCDateTime()
+
+        # The finished conversion may belong to the previous input.
+        if self.settling:
+            self.settling = False
+            self.stale_count += 1
+            return
+
+        cur_index = self.cur_index
+        next_index = (cur_index + 1) % len(self.inputs)
+
+        self.i2c_mutex.acquire()
+        self.adc.select_input(next_index)
+        cur_sample = self.adc.get_last_result()
+        self.i2c_mutex.release()
+
+        self.settling = True
+        self.cur_index = next_index
+        self.update_phase(cur_index, cur_timestamp)
+
+        cur_input = self.inputs[cur_index]
+        cur_input.data_queue.put((cur_timestamp, cur_sample))
+
+        if cur_input.capture is not None:
+            cur_input.capture.write(cur_timestamp.ns, cur_sample)
+
+        if cur_input.sample_counter is not None:
+            cur_input.sample_counter.value += 1
+
+
+    def update_phase(self, index, timestamp):
+        ''' Track the sampling phase of an input within the scan cycle.
+
+        :param index: The index of the sampled input.
+        :param timestamp: The timestamp of the sample.
+        '''
+        if index == 0:
+            self.cycle_start = timestamp
+        elif self.cycle_start is not None:
+            self.phase[index] += 0.1 * ((timestamp - self.cycle_start) - self.phase[index])
+
+
+
+class ScanChannel(mss_record.core.channel.Channel):
+    ''' A MSS channel recorded by an input of a ScanEngine.
+
+    '''
+
+    def __init__(self, name, engine, mux, data_queue, gain = '1', capture = None):
+        ''' Initialization of the instance.
+
+        '''
+        # The logger.
+        logger_name = __name__ + "." + self.__class__.__name__
+        self.logger = logging.getLogger(logger_name)
+
+        # The name of the channel.
+        self.name = name
+
+        # The scan engine handling the ADC.
+        self.engine = engine
+
+        # The multiplexer setting of the input.
+        self.mux = mux
+
+        # The sampling rate of the channel. It is set by the scan engine.
+        self.sps = None
+
+        # The gain of the channel.
+        self.gain = gain
+
+        # The multiprocessing queue used to get the ADC data from a subprocess.
+        self.data_queue = data_queue
+
+        # The samples collected from the ADC.
+        self.data = []
+
+        # The mutex lock for the data.
+        self.data_mutex = multiprocessing.Lock()
+
+        # The optional capture of the raw samples (RawCaptureWriter).
+        self.capture = capture
+
+        # The shared memory counter of the acquired samples. It is set by
+        # the supervisor of the acquisition worker.
+        self.sample_counter = None
+
+
+    @property
+    def adc(self):
+        ''' The ADC of the scan engine.
+        '''
+        return self.engine.adc
+
+
+    def check_adc(self):
+        ''' Check, if the ADC is available.
+        '''
+        return self.engine.check_adc()
+
+
+    def start_adc(self):
+        ''' Start the scan of the ADC.
+        '''
+        return self.engine.start_adc()
+
+
+    def run(self):
+        ''' Start the data collection of the scan.
+        '''
+        self.engine.run()
+
+
+    def stop(self):
+        ''' Stop the data collection of the scan.
+        '''
+        self.engine.stop()
+
+
+    def drdy_callback(self, channel):
+        ''' The DRDY interrupt is handled by the scan engine.
+        '''
+        self.engine.drdy_callback(channel)
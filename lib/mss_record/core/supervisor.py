@@ -0,0 +1,362 @@
+# -*- coding: utf-8 -*-
+# LICENSE
+#
+# This file is part of mss_record.
+#
+# If you use mss_record in any program or publication, please inform and
+# acknowledge its author Stefan Mertl (stefan@mertl-research.at).
+#
+# mss_record is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+''' Supervision of the acquisition worker.
+
+The ADC samples are acquired by the data_request worker process. The worker
+signals its liveness with a heartbeat counter and a sample counter for each
+channel in shared memory. The supervisor thread of the recorder process
+watches the counters and restarts a dead or stalled worker. The samples
+already put into the data queues are kept in the channel buffers.
+
+With the default settings, a dead worker is detected within the check
+interval of 0.05 s, a missing heartbeat or a stalled channel within 0.35 s.
+A failed worker which is still running is terminated and killed after
+0.2 s, if needed. The ADCs are rearmed and the new worker is started within
+a few ms, so the acquisition is recovered within about 0.6 s.
+'''
+
+import logging
+import multiprocessing
+import threading
+import time
+
+
+class Heartbeat(object):
+    ''' The shared memory counters of the acquisition worker.
+
+    The counters are written by the worker only, so no locks are used.
+    '''
+
+    def __init__(self, channel_names):
+        ''' Initialization of the instance.
+
+        :param channel_names: The names of the channels acquired by the
+            worker.
+        '''
+        # The counter incremented by the main loop of the worker.
+        self.beats = multiprocessing.Value('I', 0, lock = False)
+
+        # The counters of the acquired samples of each channel.
+        self.sample_counts = {x: multiprocessing.Value('I', 0, lock = False) for x in channel_names}
+
+
+    def beat(self):
+        ''' Signal the liveness of the worker.
+        '''
+        self.beats.value += 1
+
+
+    def snapshot(self):
+        ''' Get the current counter values.
+
+        :return: A tuple of the heartbeat counter and a dictionary of the
+            sample counters.
+        '''
+        return (self.beats.value,
+                {x: y.value for x, y in self.sample_counts.items()})
+
+
+
+class Supervisor(object):
+    ''' Run and supervise the acquisition worker process.
+
+    '''
+
+    def __init__(self, channels, worker, check_interval = 0.05,
+                 heartbeat_timeout = 0.3, stall_timeout = 0.3,
+                 min_restart_interval = 1., max_restart_interval = 60.):
+        ''' Initialization of the instance.
+
+        :param channels: The dictionary of the channels.
+        :param worker: The target of the worker process. It is called with
+            the channels, the stop event and the Heartbeat instance.
+        :param check_interval: The interval to check the counters [s].
+        :param heartbeat_timeout: The time without a heartbeat after which
+            the worker is restarted [s].
+        :param stall_timeout: The time without a sample of a channel after
+            which the worker is restarted [s]. It is extended to four sample
+            intervals for channels with low sampling rates.
+        :param min_restart_interval: The minimum time between two restarts
+            [s]. It is doubled up to max_restart_interval with each restart
+            following a failed restart.
+        :param max_restart_interval: The maximum time between two restarts
+            [s].
+        '''
+        # The logger.
+        logger_name = __name__ + "." + self.__class__.__name__
+        self.logger = logging.getLogger(logger_name)
+
+        self.channels = channels
+
+        self.worker = worker
+
+        self.check_interval = check_interval
+
+        self.heartbeat_timeout = heartbeat_timeout
+
+        self.stall_timeout = stall_timeout
+
+        self.min_restart_interval = min_restart_interval
+
+        self.max_restart_interval = max_restart_interval
+
+        # The current interval between two restarts.
+        self.restart_interval = min_restart_interval
+
+        # The shared memory counters of the worker.
+        self.heartbeat = Heartbeat(channel_names = channels.keys())
+
+        # The worker process and the event to stop it.
+        self.process = None
+        self.worker_stop_event = None
+
+        # Additional arguments passed to the worker.
+        self.worker_args = ()
+
+        # The number of restarts of the worker.
+        self.n_restarts = 0
+
+        # The time of the last (re)start of the worker.
+        self.start_time = None
+
+        # The last counter values and the time when they changed.
+        self.last_beats = None
+        self.last_counts = {}
+        self.last_beat_time = None
+        self.last_sample_time = {}
+
+        # The channels which have acquired samples since their ADC was
+        # started. Channels which never started are not checked for
+        # stalls.
+        self.started_channels = set()
+
+        # The lock serializing the restarts requested by the supervisor
+        # and by the recorder.
+        self.restart_mutex = threading.Lock()
+
+        self.stop_event = threading.Event()
+
+        self.thread = None
+
+
+    def start(self):
+        ''' Start the worker and the supervision.
+        '''
+        for cur_name, cur_channel in self.channels.items():
+            cur_channel.sample_counter = self.heartbeat.sample_counts[cur_name]
+        self.start_worker()
+        self.stop_event.clear()
+        self.thread = threading.Thread(name = 'supervisor',
+                                       target = self.run,
+                                       daemon = True)
+        self.thread.start()
+
+
+    def stop(self):
+        ''' Stop the supervision and the worker.
+        '''
+        self.stop_event.set()
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
+        self.stop_worker()
+
+
+    def start_worker(self):
+        ''' Start a new worker process.
+        '''
+        self.worker_stop_event = multiprocessing.Event()
+        self.process = multiprocessing.Process(target = self.worker,
+                                               args = (self.channels,
+                                                       self.worker_stop_event,
+                                                       self.heartbeat) + tuple(self.worker_args),
+                                               name = "data_request")
+        self.process.start()
+
+        now = time.monotonic()
+        self.start_time = now
+        self.last_beats, self.last_counts = self.heartbeat.snapshot()
+        self.last_beat_time = now
+        self.last_sample_time = {x: now for x in self.last_counts}
+
+
+    def stop_worker(self, timeout = 0.2, failed = False):
+        ''' Stop the worker process.
+
+        :param failed: If True, the worker is terminated without requesting
+            it to stop.
+        :return: True, if the worker stopped cleanly.
+        '''
+        if self.process is None:
+            return True
+
+        # A killed worker may have left the lock of the stop event
+        # acquired and a hung worker doesn't wake up from waiting for the
+        # event. Setting the event would block in both cases.
+        if self.process.is_alive() and not failed:
+            self.worker_stop_event.set()
+            self.process.join(timeout)
+        clean = not self.process.is_alive() and self.process.exitcode == 0
+        if self.process.is_alive():
+            self.logger.warning("The worker didn't stop. Terminating it.")
+            self.process.terminate()
+            self.process.join(timeout)
+        if self.process.is_alive():
+            self.process.kill()
+            self.process.join()
+        self.process = None
+        return clean
+
+
+    def check(self):
+        ''' Check the counters of the worker.
+
+        :return: The reason of a failure or None, if the worker is healthy
+            or a restart is in progress.
+        '''
+        if self.process is None:
+            return None
+        now = time.monotonic()
+        beats, counts = self.heartbeat.snapshot()
+
+        if beats != self.last_beats:
+            self.last_beats = beats
+            self.last_beat_time = now
+        for cur_name, cur_count in counts.items():
+            if cur_count != self.last_counts[cur_name]:
+                self.last_counts[cur_name] = cur_count
+                self.last_sample_time[cur_name] = now
+                self.started_channels.add(cur_name)
+
+        if not self.process.is_alive():
+            return "the worker exited with code %s" % self.process.exitcode
+        if now - self.last_beat_time > self.heartbeat_timeout:
+            return "no heartbeat for %.1f s" % (now - self.last_beat_time)
+        stalled = sorted([x for x, y in self.last_sample_time.items()
+                          if x in self.started_channels and now - y > self.channel_stall_timeout(x)])
+        if stalled:
+            return "no samples of channel %s for %.1f s" % (','.join(stalled),
+                                                            now - min([self.last_sample_time[x] for x in stalled]))
+        return None
+
+
+    def channel_stall_timeout(self, name):
+        ''' The time without a sample after which a channel is stalled [s].
+        '''
+        sps = getattr(self.channels[name], 'sps', None)
+        if not sps:
+            return self.stall_timeout
+        return max(self.stall_timeout, 4. / sps)
+
+
+    def restart(self, reason):
+        ''' Restart the worker keeping the buffered samples.
+        '''
+        with self.restart_mutex:
+            self.restart_worker(reason)
+
+
+    def restart_worker(self, reason, failed = False):
+        ''' Stop the worker, rearm the ADCs and start a new worker.
+
+        :param failed: If True, the worker is terminated without requesting
+            it to stop.
+        '''
+        start = time.monotonic()
+        self.logger.error("Restarting the acquisition worker: %s.", reason)
+        clean = self.stop_worker(failed = failed)
+
+        # A killed worker may have left the locks of the I2C mutex and of
+        # the data queues acquired. Replace them after moving the queued
+        # samples to the channel buffers. The queue of a killed worker is
+        # read without blocking.
+        i2c_mutex = None
+        if not clean:
+            i2c_mutex = multiprocessing.Lock()
+        for cur_channel in self.channels.values():
+            with cur_channel.data_mutex:
+                cur_channel.drain_queue(block = clean)
+                if not clean:
+                    cur_channel.data_queue = multiprocessing.Queue()
+            if i2c_mutex is not None:
+                cur_channel.i2c_mutex = i2c_mutex
+                engine = getattr(cur_channel, 'engine', None)
+                if engine is not None:
+                    engine.i2c_mutex = i2c_mutex
+
+        # Rearm the ADCs. The channels of a scan share the ADC. The
+        # channels of an ADC which couldn't be started are not checked for
+        # stalls until they acquire samples again.
+        rearmed = {}
+        for cur_name in sorted(self.channels.keys()):
+            cur_channel = self.channels[cur_name]
+            cur_adc = getattr(cur_channel, 'engine', cur_channel)
+            if id(cur_adc) not in rearmed:
+                success = False
+                try:
+                    success = cur_channel.start_adc()
+                    if not success:
+                        self.logger.error("The ADC of channel %s couldn't be configured.", cur_name)
+                except Exception:
+                    self.logger.exception("Error when rearming the ADC of channel %s.", cur_name)
+                rearmed[id(cur_adc)] = success
+            if not rearmed[id(cur_adc)]:
+                self.started_channels.discard(cur_name)
+
+        self.start_worker()
+        self.n_restarts += 1
+        self.logger.warning("Restarted the acquisition worker in %.3f s (restart %d).",
+                            time.monotonic() - start, self.n_restarts)
+
+
+    def supervise(self):
+        ''' Check the worker and restart it if needed.
+
+        The check holds the restart mutex, so it doesn't see the worker of
+        a restart requested by the recorder (e.g. a data rate change) while
+        it is replaced.
+        '''
+        with self.restart_mutex:
+            reason = self.check()
+            if reason is None:
+                # Reset the restart interval after a healthy period.
+                if self.process is not None and time.monotonic() - self.start_time > self.max_restart_interval:
+                    self.restart_interval = self.min_restart_interval
+                return
+
+            if time.monotonic() - self.start_time < self.restart_interval:
+                # Wait before restarting a failed restart again.
+                return
+
+            if self.n_restarts > 0 and time.monotonic() - self.start_time < 2 * self.restart_interval:
+                self.restart_interval = min(2 * self.restart_interval, self.max_restart_interval)
+            self.restart_worker(reason, failed = True)
+
+
+    def run(self):
+        ''' The loop of the supervisor thread.
+        '''
+        while not self.stop_event.wait(self.check_interval):
+            try:
+                self.supervise()
+            except Exception:
+                self.logger.exception("Error in the supervisor.")
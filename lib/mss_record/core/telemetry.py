@@ -0,0 +1,403 @@
+# -*- coding: utf-8 -*-
+# LICENSE
+#
+# This file is part of mss_record.
+#
+# If you use mss_record in any program or publication, please inform and
+# acknowledge its author Stefan Mertl (stefan@mertl-research.at).
+#
+# mss_record is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+''' Compact binary telemetry packets sent over UDP.
+
+Each second, the recorder sends one packet with the state of the station.
+The size of the packets of a station is fixed by its number of channels
+and the waveform rate.
+
+The packet starts with the header (big endian):
+
+- magic 'MT', version, flags
+- sequence number (uint32)
+- start time of the second (uint32, seconds since 1970)
+- network, station and location code
+- number of channels, waveform samples per channel and second
+- clock flags, estimated clock error [us] (uint16)
+- number of restarts of the acquisition worker (uint16)
+
+followed by a block for each channel:
+
+- channel code
+- received and expected number of samples (uint16)
+- minimum and maximum (int32) and RMS (float32) of the 100 sps data
+
+and, if the waveform flag is set, the decimated waveform of each channel:
+the first sample (int32) followed by the differences to the previous
+samples (int16). The decimated samples are the means of the 100 sps data
+over the waveform sampling interval.
+'''
+
+import argparse
+import logging
+import socket
+import struct
+
+import numpy as np
+
+
+TELEMETRY_MAGIC = b'MT'
+TELEMETRY_VERSION = 1
+
+# The packet flags.
+FLAG_WAVEFORM = 0x01
+FLAG_WAVEFORM_CLIPPED = 0x02
+
+# The clock flags.
+CLOCK_MONITORED = 0x01
+CLOCK_SYNCHRONIZED = 0x02
+CLOCK_LOCKED = 0x04
+
+# The packet header.
+HEADER = struct.Struct('!2sBBII2s5s2sBBBHH')
+
+# The statistics of a channel.
+CHANNEL = struct.Struct('!3sHHiif')
+
+
+def waveform_struct(n_samples):
+    ''' The struct of the delta encoded waveform of a channel.
+    '''
+    return struct.Struct('!i%dh' % (n_samples - 1))
+
+
+def packet_size(n_channels, waveform_samples = 0):
+    ''' The size of a packet [bytes].
+    '''
+    size = HEADER.size + n_channels * CHANNEL.size
+    if waveform_samples:
+        size += n_channels * waveform_struct(waveform_samples).size
+    return size
+
+
+def pack_packet(seq, time, network, station, location, channels,
+                clock_flags = 0, est_error = 0., n_restarts = 0,
+                waveform_samples = 0):
+    ''' Create a telemetry packet.
+
+    :param seq: The sequence number.
+    :param time: The start time of the second [s since 1970].
+    :param channels: A list of dictionaries with the keys name, count,
+        expected, min, max, rms and waveform.
+    :param est_error: The estimated error of the clock [s].
+    :param waveform_samples: The number of waveform samples of each channel.
+        If 0, no waveform is sent.
+    :return: The bytes of the packet.
+    '''
+    flags = 0
+    if waveform_samples:
+        flags |= FLAG_WAVEFORM
+    est_error_us = int(min(max(est_error * 1e6, 0), 0xFFFF))
+    parts = [HEADER.pack(TELEMETRY_MAGIC, TELEMETRY_VERSION, 0,
+                         seq & 0xFFFFFFFF, int(time),
+                         network.encode('ascii'), station.encode('ascii'), location.encode('ascii'),
+                         len(channels), waveform_samples, clock_flags, est_error_us,
+                         min(n_restarts, 0xFFFF))]
+    for cur_channel in channels:
+        parts.append(CHANNEL.pack(cur_channel['name'].encode('ascii'),
+                                  min(cur_channel['count'], 0xFFFF),
+                                  min(int(round(cur_channel['expected'])), 0xFFFF),
+                                  cur_channel['min'],
+                                  cur_channel['max'],
+                                  cur_channel['rms']))
+    if waveform_samples:
+        wf_struct = waveform_struct(waveform_samples)
+        for cur_channel in channels:
+            waveform = cur_channel.get('waveform')
+            if waveform is None:
+                waveform = np.zeros(waveform_samples, dtype = np.int64)
+            deltas = np.diff(waveform)
+            clipped = np.clip(deltas, -32768, 32767)
+            if np.any(clipped != deltas):
+                flags |= FLAG_WAVEFORM_CLIPPED
+            first = int(np.clip(waveform[0], -2**31, 2**31 - 1))
+            parts.append(wf_struct.pack(first, *clipped.tolist()))
+    packet = b''.join(parts)
+    return packet[:3] + bytes([flags]) + packet[4:]
+
+
+def unpack_packet(packet):
+    ''' Decode a telemetry packet.
+
+    :return: A dictionary with the header fields and the list of channels.
+    '''
+    (magic, version, flags, seq, time, network, station, location,
+     n_channels, waveform_samples, clock_flags, est_error_us, n_restarts) = HEADER.unpack_from(packet)
+    if magic != TELEMETRY_MAGIC:
+        raise ValueError("Invalid telemetry magic %r." % magic)
+    if version != TELEMETRY_VERSION:
+        raise ValueError("Unsupported telemetry version %d." % version)
+    if len(packet) != packet_size(n_channels, waveform_samples if flags & FLAG_WAVEFORM else 0):
+        raise ValueError("Invalid telemetry packet size %d." % len(packet))
+
+    offset = HEADER.size
+    channels = []
+    for k in range(n_channels):
+        name, count, expected, min_value, max_value, rms = CHANNEL.unpack_from(packet, offset)
+        offset += CHANNEL.size
+        channels.append({'name': name.decode('ascii'),
+                         'count': count,
+                         'expected': expected,
+                         'min': min_value,
+                         'max': max_value,
+                         'rms': rms})
+    if flags & FLAG_WAVEFORM:
+        wf_struct = waveform_struct(waveform_samples)
+        for cur_channel in channels:
+            values = wf_struct.unpack_from(packet, offset)
+            offset += wf_struct.size
+            cur_channel['waveform'] = np.cumsum(values, dtype = np.int64)
+
+    return {'seq': seq,
+            'time': time,
+            'network': network.decode('ascii').strip('\x00'),
+            'station': station.decode('ascii').strip('\x00'),
+            'location': location.decode('ascii').strip('\x00'),
+            'flags': flags,
+            'clock_flags': clock_flags,
+            'est_error': est_error_us / 1e6,
+            'n_restarts': n_restarts,
+            'channels': channels}
+
+
+
+class TelemetrySender(object):
+    ''' Send the per-second state of the recorder over UDP.
+
+    '''
+
+    def __init__(self, host, port, network, station, location, channels,
+                 waveform_rate = 0, sps = 100.):
+        ''' Initialization of the instance.
+
+        :param host: The address of the telemetry receiver.
+        :param port: The UDP port of the telemetry receiver.
+        :param channels: The names of the channels sent in the packets.
+        :param waveform_rate: The sampling rate of the sent waveform [sps].
+            It has to be an integer fraction of sps. If 0, no waveform is
+            sent.
+        :param sps: The sampling rate of the recorder [sps].
+        '''
+        # The logger.
+        logger_name = __name__ + "." + self.__class__.__name__
+        self.logger = logging.getLogger(logger_name)
+
+        self.address = (host, port)
+
+        self.network = network
+
+        self.station = station
+
+        self.location = location
+
+        self.channels = sorted(channels)
+
+        self.waveform_rate = waveform_rate
+
+        self.sps = sps
+
+        # The number of waveform samples of a channel in one packet.
+        self.waveform_samples = int(waveform_rate)
+
+        # The sequence number of the next packet.
+        self.seq = 0
+
+        # The number of failed sends.
+        self.n_errors = 0
+
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.sock.setblocking(False)
+
+
+    def close(self):
+        ''' Close the socket.
+        '''
+        self.sock.close()
+
+
+    def channel_state(self, name, sample_counts, traces):
+        ''' Compute the state of a channel in the last second.
+        '''
+        count, expected = sample_counts.get(name, (0, 0))
+        state = {'name': name,
+                 'count': count,
+                 'expected': expected,
+                 'min': 0,
+                 'max': 0,
+                 'rms': 0.,
+                 'waveform': None}
+        trace = traces.get(name)
+        if trace is None or trace.stats.npts == 0:
+            return state
+
+        data = np.asarray(trace.data, dtype = np.float64)
+        state['min'] = int(np.clip(np.floor(data.min()), -2**31, 2**31 - 1))
+        state['max'] = int(np.clip(np.ceil(data.max()), -2**31, 2**31 - 1))
+        state['rms'] = float(np.sqrt(np.mean(data**2)))
+        if self.waveform_samples and len(data) % self.waveform_samples == 0:
+            blocks = data.reshape(self.waveform_samples, -1)
+            state['waveform'] = np.round(blocks.mean(axis = 1)).astype(np.int64)
+        return state
+
+
+    def send_second(self, start_time, sample_counts, traces, clock_monitor = None,
+                    n_restarts = 0):
+        ''' Send the packet of one second.
+
+        :param start_time: The start time of the second.
+        :param sample_counts: The number of received and expected samples of
+            each channel.
+        :param traces: The traces with the recorder sampling rate of each
+            channel.
+        :param clock_monitor: The ClockMonitor of the recorder.
+        :param n_restarts: The number of restarts of the acquisition worker.
+        '''
+        clock_flags = 0
+        est_error = 0.
+        if clock_monitor is not None:
+            clock_flags |= CLOCK_MONITORED
+            status = clock_monitor.status
+            if status is not None:
+                est_error = status.est_error
+                if status.synchronized:
+                    clock_flags |= CLOCK_SYNCHRONIZED
+                if clock_monitor.is_locked(status):
+                    clock_flags |= CLOCK_LOCKED
+
+        channels = [self.channel_state(x, sample_counts, traces) for x in self.channels]
+        packet = pack_packet(seq = self.seq,
+                             time = start_time.timestamp,
+                             network = self.network,
+                             station = self.station,
+                             location = self.location,
+                             channels = channels,
+                             clock_flags = clock_flags,
+                             est_error = est_error,
+                             n_restarts = n_restarts,
+                             waveform_samples = self.waveform_samples)
+        self.seq += 1
+        try:
+            self.sock.sendto(packet, self.address)
+        except OSError as e:
+            # UDP telemetry is lossy by design. Don't block or fail the
+            # recorder.
+            self.n_errors += 1
+            if self.n_errors % 100 == 1:
+                self.logger.warning("Error when sending the telemetry packet (%d errors): %s.",
+                                    self.n_errors, e)
+
+
+
+class TelemetryReceiver(object):
+    ''' Receive and decode the telemetry packets of the stations.
+
+    '''
+
+    def __init__(self, host = '0.0.0.0', port = 16001):
+        ''' Initialization of the instance.
+
+        '''
+        # The logger.
+        logger_name = __name__ + "." + self.__class__.__name__
+        self.logger = logging.getLogger(logger_name)
+
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.sock.bind((host, port))
+
+        # The address the socket is bound to.
+        self.address = self.sock.getsockname()
+
+        # The last sequence number and the number of lost packets of each
+        # station.
+        self.last_seq = {}
+        self.n_lost = {}
+
+        # The number of received packets which couldn't be decoded.
+        self.n_invalid = 0
+
+
+    def receive(self, timeout = None):
+        ''' Receive and decode the next packet.
+
+        :return: The decoded packet or None, if no packet was received
+            within the timeout or the received packet is invalid.
+        '''
+        self.sock.settimeout(timeout)
+        try:
+            packet, sender = self.sock.recvfrom(65536)
+        except socket.timeout:
+            return None
+        try:
+            decoded = unpack_packet(packet)
+        except (struct.error, ValueError) as e:
+            # Don't stop receiving on a truncated or foreign datagram.
+            self.n_invalid += 1
+            self.logger.warning("Invalid telemetry packet of %d bytes from %s: %s.",
+                                len(packet), sender, e)
+            return None
+        station_id = '.'.join([decoded['network'], decoded['station'], decoded['location']])
+        last_seq = self.last_seq.get(station_id)
+        if last_seq is not None and decoded['seq'] > last_seq + 1:
+            self.n_lost[station_id] = self.n_lost.get(station_id, 0) + decoded['seq'] - last_seq - 1
+        self.last_seq[station_id] = decoded['seq']
+        decoded['station_id'] = station_id
+        return decoded
+
+
+    def close(self):
+        ''' Close the socket.
+        '''
+        self.sock.close()
+
+
+
+def main(argv = None):
+    ''' Print the received telemetry packets.
+    '''
+    parser = argparse.ArgumentParser(prog = 'mss_record telemetry',
+                                     description = 'Receive and print the telemetry packets of the recorders.')
+    parser.add_argument('--host', type = str, default = '0.0.0.0',
+                        help = 'The address to listen on.')
+    parser.add_argument('--port', type = int, default = 16001,
+                        help = 'The UDP port to listen on.')
+    args = parser.parse_args(argv)
+
+    receiver = TelemetryReceiver(host = args.host, port = args.port)
+    try:
+        while True:
+            packet = receiver.receive()
+            if packet is None:
+                continue
+            channels = ' '.join(['%s %d/%d [%d, %d] %.1f' % (x['name'], x['count'], x['expected'],
+                                                             x['min'], x['max'], x['rms']) for x in packet['channels']])
+            print("%s seq %d time %d clock 0x%x restarts %d lost %d: %s" % (packet['station_id'],
+                                                                           packet['seq'],
+                                                                           packet['time'],
+                                                                           packet['clock_flags'],
+                                                                           packet['n_restarts'],
+                                                                           receiver.n_lost.get(packet['station_id'], 0),
+                                                                           channels))
+    except KeyboardInterrupt:
+        pass
+    finally:
+        receiver.close()
+    return 0
@@ -34,7 +34,8 @@ for line in open('lib/mss_record/__init__.py').readlines():
         exec(line.strip())
 
 # Define the scripts to be processed.
-scripts = ['scripts/mss_record',]
+scripts = ['scripts/mss_record',
+           'scripts/mss_record_hub']
 
 # Get the version from the git repository and write it to the version file.
 version_file = 'lib/mss_record/version.py'
@@ -55,6 +56,7 @@ setuptools.setup(name = 'mss_record',
                  package_dir       = {'': 'lib'},
                  packages          = ['mss_record',
                                       'mss_record.core',
-                                      'mss_record.adc'],
+                                      'mss_record.adc',
+                                      'mss_record.bench'],
                  install_requires  = ['Adafruit-Blinka>=8.12.0'])
 